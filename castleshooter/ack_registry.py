@@ -0,0 +1,116 @@
+import asyncio
+from threading import Event, Lock
+from typing import Any, Optional, Union
+
+
+# How long to wait for an ack before re-sending, until we've seen a round trip on the connection
+INITIAL_ACK_TIMEOUT = 0.2
+MIN_ACK_TIMEOUT = 0.05
+MAX_ACK_TIMEOUT = 2.0
+# How many packet ids back from the newest one handled we remember individually. Senders give up after a few
+# seconds of re-sending, so anything further back than this will never come again.
+HANDLED_PACKET_WINDOW = 1024
+
+
+class RttEstimator:
+    """
+    The smoothed round trip time to the other end of one connection, estimated the way TCP does it (RFC 6298), which
+    decides how long a reliable send waits for an ack before re-sending.
+    """
+
+    def __init__(self) -> None:
+        self.smoothed_rtt: Optional[float] = None
+        self.rtt_variance = 0.0
+        self._lock = Lock()
+
+    def add_sample(self, rtt: float) -> None:
+        with self._lock:
+            if self.smoothed_rtt is None:
+                self.smoothed_rtt = rtt
+                self.rtt_variance = rtt / 2
+            else:
+                self.rtt_variance = 0.75 * self.rtt_variance + 0.25 * abs(self.smoothed_rtt - rtt)
+                self.smoothed_rtt = 0.875 * self.smoothed_rtt + 0.125 * rtt
+
+    def ack_timeout(self) -> float:
+        if self.smoothed_rtt is None:
+            return INITIAL_ACK_TIMEOUT
+        return min(max(self.smoothed_rtt + 4 * self.rtt_variance, MIN_ACK_TIMEOUT), MAX_ACK_TIMEOUT)
+
+
+class AckRegistry:
+    """
+    The packets this process has sent with retry and is still waiting on acks for, keyed by connection and packet id,
+    since every connection numbers its packets itself. Whatever is reading the connection calls ack as soon as it sees
+    one, which wakes the sender up right away, rather than the sender sleeping and then checking whether an ack has
+    turned up.
+    """
+
+    def __init__(self) -> None:
+        self._waiters: dict[tuple[Any, int], Union[Event, tuple[asyncio.Event, asyncio.AbstractEventLoop]]] = {}
+        self._lock = Lock()
+
+    def expect(self, conn: Any, packet_id: int) -> Event:
+        event = Event()
+        with self._lock:
+            self._waiters[conn, packet_id] = event
+        return event
+
+    # Has to be called from the event loop that will wait on the event
+    def aexpect(self, conn: Any, packet_id: int) -> asyncio.Event:
+        event = asyncio.Event()
+        with self._lock:
+            self._waiters[conn, packet_id] = (event, asyncio.get_running_loop())
+        return event
+
+    def forget(self, conn: Any, packet_id: int) -> None:
+        with self._lock:
+            self._waiters.pop((conn, packet_id), None)
+
+    # Returns whether anything was waiting on the ack, which it won't be if this is the ack for a re-send
+    def ack(self, conn: Any, packet_id: int) -> bool:
+        with self._lock:
+            waiter = self._waiters.pop((conn, packet_id), None)
+        if waiter is None:
+            return False
+        if isinstance(waiter, Event):
+            waiter.set()
+        else:
+            event, loop = waiter
+            loop.call_soon_threadsafe(event.set)
+        return True
+
+
+pending_acks = AckRegistry()
+
+
+class HandledPacketWindow:
+    """
+    Which of one connection's packets have been handled, so that a re-send whose ack got lost isn't handled twice.
+    Each connection numbers its packets in order (see packet.py), so this only needs the newest id handled and a
+    bitmap of the size ids before it, and it stays the same size however long the connection lasts. Anything older
+    than the window counts as handled.
+    """
+
+    def __init__(self, size: int = HANDLED_PACKET_WINDOW) -> None:
+        self.size = size
+        self._newest: Optional[int] = None
+        # Bit i is set if newest - i has been handled
+        self._bitmap = 0
+        self._lock = Lock()
+
+    def is_handled(self, packet_id: int) -> bool:
+        with self._lock:
+            if self._newest is None or packet_id > self._newest:
+                return False
+            offset = self._newest - packet_id
+            return offset >= self.size or bool(self._bitmap >> offset & 1)
+
+    def mark_handled(self, packet_id: int) -> None:
+        with self._lock:
+            if self._newest is None or packet_id > self._newest:
+                shift = packet_id - self._newest if self._newest is not None else self.size
+                self._bitmap = ((self._bitmap << shift) | 1) & ((1 << self.size) - 1)
+                self._newest = packet_id
+            elif (offset := self._newest - packet_id) < self.size:
+                self._bitmap |= 1 << offset
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from typing import Any, Optional
+
+import pygame
+
+
+FONT_NAME = 'comicsans'
+# Enough for every string on screen at once, plus whatever's been on it recently
+TEXT_SURFACE_CACHE_SIZE = 512
+
+
+class AssetCache:
+    """
+    Everything the render loop draws that only has to be made once: images loaded from disk, converted for blitting
+    and scaled to each size they're drawn at, fonts by size, and the surfaces text has been rendered to. Rendered
+    text is only kept for the most recently drawn TEXT_SURFACE_CACHE_SIZE strings, since some of it (scores, timers)
+    changes as the game goes on.
+
+    Surfaces from here are shared, so copy one before changing it (its alpha, say). Images can only be loaded once
+    the display has been set up.
+    """
+
+    def __init__(self, text_surface_cache_size: int = TEXT_SURFACE_CACHE_SIZE) -> None:
+        self.text_surface_cache_size = text_surface_cache_size
+        self._images: dict[tuple[str, Optional[tuple[int, int]]], Any] = {}
+        self._fonts: dict[int, Any] = {}
+        self._text_surfaces: OrderedDict[tuple[str, int, tuple[int, int, int]], Any] = OrderedDict()
+
+    def image(self, path: str, size: Optional[tuple[int, int]] = None) -> Any:
+        key = (path, size)
+        if (surface := self._images.get(key)) is None:
+            surface = pygame.image.load(path)
+            if size is not None:
+                surface = pygame.transform.scale(surface, size)
+            surface = surface.convert_alpha()
+            self._images[key] = surface
+        return surface
+
+    def font(self, size: int) -> Any:
+        if (font := self._fonts.get(size)) is None:
+            font = pygame.font.SysFont(FONT_NAME, size)
+            self._fonts[size] = font
+        return font
+
+    def text(self, message: str, size: int, color: tuple[int, int, int] = (0, 0, 0)) -> Any:
+        key = (message, size, color)
+        if (surface := self._text_surfaces.get(key)) is not None:
+            self._text_surfaces.move_to_end(key)
+            return surface
+        surface = self.font(size).render(message, True, color)
+        self._text_surfaces[key] = surface
+        if len(self._text_surfaces) > self.text_surface_cache_size:
+            self._text_surfaces.popitem(last=False)
+        return surface
+
+
+asset_cache = AssetCache()
@@ -0,0 +1,352 @@
+import asyncio
+from itertools import count
+import json
+import socket
+import struct
+import traceback
+from typing import Any, Coroutine, Optional
+import zlib
+from _thread import start_new_thread
+
+from ack_registry import HandledPacketWindow
+from broadcaster import AsyncGameBroadcaster
+from metrics import metrics, serve_metrics
+from command import (
+    Command, aserver_store_player_commands, astore_command, batch_server_store_player_commands, decode_command, decode_commands,
+    forget_server_command_logs, keep_server_command_logs
+)
+from packet import (
+    Packet, PacketFormat, areceive_packets, asend_ack, asend_with_retry, asend_without_retry,
+    record_ack, set_packet_format
+)
+from redis_utils import aflushall, arget, arlisten, aredis_batch, aredis_lock, arset
+from server import (
+    GAME_NAMES_LOCK_REDIS_KEY, LOBBY_MANAGER_SUBSCRIPTION_KEYS, SUBSCRIPTION_KEYS, assign_teams,
+    generate_initial_spawn_command, start_up_game_for_ai, stop_ai_games
+)
+from server_simulation import SERVER_SIMULATION_TICK_RATE, ServerSimulation
+from settings import METRICS_PORT, PORT
+from utils import LOG_CUTOFF, SPECIAL_LOBBY_MANAGER_GAME_NAME
+
+# The same server as server.py, speaking the same protocol, except that every connection, every game's digest
+# broadcast and snapshot creation, and every redis subscription runs as a task on a single event loop rather than as
+# its own thread. Run with `python async_server.py` instead of `python server.py`.
+
+_LOBBY_MANAGER_PAYLOADS = ('join_game', 'leave_game', 'host_game')
+
+
+active_connections_by_client_id_and_game_name: set[tuple[int, str]] = set()
+client_ids_to_game_name: dict[int, str] = {}
+
+
+class AsyncConnection:
+    def __init__(self, id: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.id = id
+        self.reader = reader
+        self.writer = writer
+        self.addr = writer.get_extra_info('peername')
+        # The game whose packets this connection is currently sending
+        self.game_name = SPECIAL_LOBBY_MANAGER_GAME_NAME
+        self.handled_packets = HandledPacketWindow()
+
+    def __repr__(self) -> str:
+        return f"<AsyncConnection {self.id}: {self.addr}>"
+
+
+connections_by_id: dict[int, AsyncConnection] = {}
+# Connections are dropped from connections_by_id once they close, so ids come from a counter rather than from the
+# highest open one, which would hand a closed connection's id (and client id) to the next one
+_connection_ids = count(101)
+broadcasters_by_game_name: dict[str, AsyncGameBroadcaster] = {}
+simulations_by_game_name: dict[str, ServerSimulation] = {}
+forwarding_tasks_by_game_name: dict[str, asyncio.Future] = {}
+# The event loop only keeps weak references to tasks, so we hold on to the ones nobody awaits
+_background_tasks: set[asyncio.Future] = set()
+
+
+def _spawn(coroutine: Coroutine[Any, Any, Any]) -> asyncio.Future:
+    task = asyncio.ensure_future(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+# Returns a dict from game name to whether or not that game has started
+async def _get_game_names() -> dict[str, bool]:
+    return json.loads(await arget('game_names', game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME) or '{}')
+
+
+def _get_broadcaster(game_name: str) -> AsyncGameBroadcaster:
+    if (broadcaster := broadcasters_by_game_name.get(game_name)) is None:
+        broadcaster = AsyncGameBroadcaster(game_name)
+        broadcasters_by_game_name[game_name] = broadcaster
+        _spawn(broadcaster.arun())
+    return broadcaster
+
+
+# Every connection in the lobby hears about changes to the lobby, and every connection in a game hears about changes
+# to that game. There's one redis subscription per game, no matter how many connections are in it, until the game ends.
+def _start_forwarding_changes(game_name: str) -> None:
+    if game_name in forwarding_tasks_by_game_name:
+        return
+
+    async def _handle_change(channel: str, value: Optional[str]) -> None:
+        for connection in list(connections_by_id.values()):
+            if connection.writer.is_closing():
+                continue
+            if game_name == SPECIAL_LOBBY_MANAGER_GAME_NAME or connection.game_name == game_name:
+                _spawn(asend_without_retry(connection.writer, f'{channel}|{value}', client_id=None))
+
+    subscription_keys = SUBSCRIPTION_KEYS if game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME else LOBBY_MANAGER_SUBSCRIPTION_KEYS
+    forwarding_tasks_by_game_name[game_name] = _spawn(arlisten(subscription_keys, _handle_change, game_name=game_name))
+
+
+# Simulating is pure computation over the game's commands, so ticks happen on the default executor to keep them
+# from holding up the event loop
+async def _run_server_simulation(game_name: str) -> None:
+    simulation = ServerSimulation(game_name)
+    simulations_by_game_name[game_name] = simulation
+    while not simulation.stopped:
+        started_at = asyncio.get_running_loop().time()
+        with metrics.timer('simulation_tick_seconds', game=game_name):
+            await asyncio.to_thread(simulation.tick)
+        await asyncio.sleep(max(1 / SERVER_SIMULATION_TICK_RATE - (asyncio.get_running_loop().time() - started_at), 0))
+
+
+async def _subscribe_to_digest(connection: AsyncConnection, game_name: str, for_client_id: int) -> None:
+    await asyncio.sleep(3)
+    if (for_client_id, game_name) in active_connections_by_client_id_and_game_name:
+        _get_broadcaster(game_name).subscribe(connection.writer, for_client_id)
+
+
+def _enter_game(connection: AsyncConnection, game_name: str, client_id: int) -> None:
+    active_connections_by_client_id_and_game_name.add((client_id, game_name))
+    client_ids_to_game_name[client_id] = game_name
+    connection.game_name = game_name
+    _start_forwarding_changes(game_name)
+    _spawn(_subscribe_to_digest(connection, game_name, client_id))
+
+
+def _exit_game(connection: AsyncConnection, game_name: str, client_id: int) -> None:
+    active_connections_by_client_id_and_game_name.discard((client_id, game_name))
+    client_ids_to_game_name[client_id] = SPECIAL_LOBBY_MANAGER_GAME_NAME
+    connection.game_name = SPECIAL_LOBBY_MANAGER_GAME_NAME
+    if (broadcaster := broadcasters_by_game_name.get(game_name)) is not None:
+        broadcaster.unsubscribe(client_id)
+
+
+def _has_players(game_name: str) -> bool:
+    return any(for_game_name == game_name for _, for_game_name in active_connections_by_client_id_and_game_name)
+
+
+# A game is over once every (human) player has left it or lost their connection to it. Everything that was running
+# for it stops, and the server stops keeping its command logs.
+def _end_game(game_name: str) -> None:
+    print(f'Ending game: {game_name}')
+    if (simulation := simulations_by_game_name.pop(game_name, None)) is not None:
+        simulation.stop()
+    if (broadcaster := broadcasters_by_game_name.pop(game_name, None)) is not None:
+        broadcaster.stop()
+    if (forwarding_task := forwarding_tasks_by_game_name.pop(game_name, None)) is not None:
+        forwarding_task.cancel()
+    stop_ai_games(game_name)
+    forget_server_command_logs(game_name)
+
+
+# Takes a player whose connection has dropped out of their game, the same as if they'd left it
+async def _leave_game_on_lost_connection(connection: AsyncConnection, game_name: str) -> None:
+    async with aredis_lock(GAME_NAMES_LOCK_REDIS_KEY, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
+        if (connection.id, game_name) not in active_connections_by_client_id_and_game_name:
+            return
+        _exit_game(connection, game_name, connection.id)
+        players_in_game = json.loads(await arget('active_players', game_name=game_name) or '[]')
+        await arset('active_players', json.dumps([player_info for player_info in players_in_game if player_info[1] != connection.id]), 
+                    game_name=game_name)
+        if not _has_players(game_name):
+            _end_game(game_name)
+
+
+async def _handle_payload_from_client(connection: AsyncConnection, payload: str, packet: Packet, game_name: str) -> bool:
+
+    # Only the lobby manager should care about these packets
+
+    if payload.startswith('join_game') and game_name == SPECIAL_LOBBY_MANAGER_GAME_NAME:
+        async with aredis_lock(GAME_NAMES_LOCK_REDIS_KEY, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
+            _, player_name, game_to_join_name = payload.split('|')
+            assert packet.client_id
+            connection_tup = (packet.client_id, game_to_join_name)
+            if connection_tup not in active_connections_by_client_id_and_game_name and game_to_join_name in await _get_game_names():
+                players_in_game = json.loads(await arget('active_players', game_name=game_to_join_name) or '[]')
+                players_in_game.append([player_name, packet.client_id])
+                _enter_game(connection, game_to_join_name, packet.client_id)
+                await asyncio.sleep(0.02)
+                await arset('active_players', json.dumps(players_in_game), game_name=game_to_join_name)
+        return True
+
+    elif payload.startswith('leave_game') and game_name == SPECIAL_LOBBY_MANAGER_GAME_NAME:
+        async with aredis_lock(GAME_NAMES_LOCK_REDIS_KEY, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
+            _, player_name, game_to_leave_name = payload.split('|')
+            assert packet.client_id
+            connection_tup = (packet.client_id, game_to_leave_name)
+            if connection_tup in active_connections_by_client_id_and_game_name:
+                players_in_game = json.loads(await arget('active_players', game_name=game_to_leave_name) or '[]')
+                players_in_game = [player_info for player_info in players_in_game
+                                   if not (player_info[0] == player_name and player_info[1] == packet.client_id)]
+                _exit_game(connection, game_to_leave_name, packet.client_id)
+                await asyncio.sleep(0.02)
+                await arset('active_players', json.dumps(players_in_game), game_name=game_to_leave_name)
+                if not _has_players(game_to_leave_name):
+                    _end_game(game_to_leave_name)
+        return True
+
+    elif payload.startswith('host_game') and game_name == SPECIAL_LOBBY_MANAGER_GAME_NAME:
+        async with aredis_lock(GAME_NAMES_LOCK_REDIS_KEY, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
+            _, player_name, game_to_host_name = payload.split('|')
+            assert packet.client_id
+            connection_tup = (packet.client_id, game_to_host_name)
+            all_game_names = await _get_game_names()
+            if (connection_tup not in active_connections_by_client_id_and_game_name
+                    and game_to_host_name not in all_game_names):
+                _enter_game(connection, game_to_host_name, packet.client_id)
+                all_game_names[game_to_host_name] = False
+                await asyncio.sleep(0.02)
+                await arset('game_names', json.dumps(all_game_names), game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME)
+                await arset('active_players', json.dumps([[player_name, packet.client_id]]), game_name=game_to_host_name)
+        return True
+
+    # End "Only the lobby manager should care about these packets"
+
+    elif payload.startswith('start_game') and game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME:
+        async with aredis_lock(GAME_NAMES_LOCK_REDIS_KEY, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
+            all_game_names = await _get_game_names()
+            if not all_game_names[game_name]:
+                all_game_names[game_name] = True
+
+                players_in_game = json.loads(await arget('active_players', game_name=game_name) or '[]')
+                client_ids_in_game, client_id_to_team, client_id_to_player_number, red_team, blue_team = assign_teams(players_in_game)
+                # Everything goes in one pipeline, which keeps the publishes in this order
+                async with aredis_batch() as batch:
+                    for client_id in client_ids_in_game:
+                        player_number = client_id_to_player_number[client_id]
+                        batch.rmset({f'team:{client_id}': client_id_to_team[client_id].value,
+                                     f'player_number:{client_id}': player_number,
+                                     f'client_id:{player_number}': client_id}, game_name=game_name)
+                    batch.rmset({'red_team': json.dumps(red_team), 'blue_team': json.dumps(blue_team)}, game_name=game_name)
+                    batch.rset('client_id_to_team', json.dumps({k: v.value for k, v in client_id_to_team.items()}), game_name=game_name)
+                    batch.rset('client_id_to_player_number', json.dumps(client_id_to_player_number), game_name=game_name)
+                    batch.rset('game_started', '1', game_name=game_name)
+                    batch.rset('game_names', json.dumps(all_game_names), game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME)
+                    batch_server_store_player_commands(
+                        batch, {client_id: [generate_initial_spawn_command(client_id, client_id_to_team[client_id])]
+                                for client_id in client_ids_in_game}, game_name=game_name)
+
+                keep_server_command_logs(game_name)
+                _spawn(_run_server_simulation(game_name))
+
+                # AI players run a whole Game of their own, render loop and all, so they still get a thread each
+                for client_id in client_ids_in_game:
+                    if client_id >= 10000:
+                        print(f'Starting up an AI: {client_id_to_player_number[client_id]}')
+                        start_new_thread(start_up_game_for_ai, (client_id, client_id_to_team[client_id], game_name))
+        return True
+
+    elif payload.startswith('command') and game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME:
+        all_game_names = await _get_game_names()
+        if all_game_names[game_name]:
+            _, data = payload.split('|')
+            assert packet.client_id is not None
+            metrics.inc('commands_received_total', game=game_name)
+            await astore_command(decode_command(data), game_name=game_name)
+        return True
+
+    elif payload.startswith('packet_format'):
+        _, raw_packet_format = payload.split('|')
+        set_packet_format(connection.writer, PacketFormat(raw_packet_format))
+        return True
+
+    elif payload.startswith('digest_ack') and game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME:
+        _, raw_version = payload.split('|')
+        assert packet.client_id is not None
+        if (broadcaster := broadcasters_by_game_name.get(game_name)) is not None:
+            broadcaster.ack(packet.client_id, int(raw_version))
+        return True
+
+    elif payload.startswith('all_commands_heartbeat') and game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME:
+        _, data = payload.split('|')
+        assert packet.client_id is not None
+        await aserver_store_player_commands(decode_commands(data), packet.client_id, game_name=game_name)
+
+    return False
+
+
+async def _handle_packet(connection: AsyncConnection, packet: Packet) -> None:
+    metrics.inc('packets_received_total', game=connection.game_name)
+    packet_id = packet.id
+    payload = packet.payload
+    if packet.is_ack:
+        assert packet_id is not None
+        record_ack(connection.writer, packet_id)
+        return
+
+    assert payload is not None
+    game_name = SPECIAL_LOBBY_MANAGER_GAME_NAME if payload.startswith(_LOBBY_MANAGER_PAYLOADS) else connection.game_name
+    if packet_id is None:
+        await _handle_payload_from_client(connection, payload, packet, game_name=game_name)
+        return
+
+    # Want to make sure not to handle the same packet twice due to a re-send, if our ack didn't get through. A
+    # connection's packets are handled one at a time, so nothing else can handle this one in the meantime.
+    if not connection.handled_packets.is_handled(packet_id):
+        if await _handle_payload_from_client(connection, payload, packet, game_name=game_name):
+            await asend_ack(connection.writer, packet_id)
+            connection.handled_packets.mark_handled(packet_id)
+
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    connection_id = next(_connection_ids)
+    connection = AsyncConnection(connection_id, reader, writer)
+    connections_by_id[connection_id] = connection
+    await arset('active_players', ','.join(str(i) for i in connections_by_id.keys()), game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME)
+    print(f'A new client has connected! ID: {connection_id}')
+
+    _spawn(asend_with_retry(writer, f'client_id|{connection_id}'))
+    game_names = await arget('game_names', game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME) or '{}'
+    _spawn(asend_with_retry(writer, f'game_names|{game_names}', delay=0.25))
+
+    try:
+        while True:
+            try:
+                packets = await areceive_packets(reader)
+            except (zlib.error, ValueError, struct.error) as e:
+                print(f'Error decompressing data: {e}')
+                continue
+            for packet in packets:
+                try:
+                    await _handle_packet(connection, packet)
+                except Exception as e:
+                    print(f'Ignoring {str(packet)[:LOG_CUTOFF]} because of exception: {e}')
+                    traceback.print_exc()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        print(f'Connection closed: {connection}')
+    finally:
+        if connection.game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME:
+            await _leave_game_on_lost_connection(connection, connection.game_name)
+        writer.close()
+        del connections_by_id[connection_id]
+        await arset('active_players', ','.join(str(i) for i in connections_by_id.keys()), game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME)
+
+
+async def serve() -> None:
+    await aflushall()
+    _start_forwarding_changes(SPECIAL_LOBBY_MANAGER_GAME_NAME)
+    if METRICS_PORT is not None:
+        serve_metrics(METRICS_PORT)
+    server = await asyncio.start_server(_handle_connection, socket.gethostbyname(socket.gethostname()), PORT,
+                                        reuse_address=True)
+    print('Starting the server!')
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(serve())
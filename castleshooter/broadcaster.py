@@ -0,0 +1,279 @@
+import asyncio
+from enum import Enum
+import json
+from threading import Condition, Lock
+from time import sleep
+from typing import Any, Optional, Union
+from _thread import start_new_thread
+
+from command import CommandLog, aget_commands_by_player, aget_commands_by_projectile, get_commands_by_player, get_commands_by_projectile
+from digest import DigestBuilder, DigestTracker
+from metrics import metrics
+from packet import (
+    PacketFormat, asend_framed_message_without_retry, frame_message_without_retry, get_packet_format, 
+    send_framed_message_without_retry
+)
+from redis_utils import armget, rmget
+
+
+DIGEST_BROADCAST_EVERY = 0.05
+DIGEST_FIELDS = ['most_recent_game_state_snapshot', 'client_id_to_player_number', 'client_id_to_team', 'game_started', 
+                 'authoritative_state']
+DIGEST_ENTITY_FIELDS = {'authoritative_state': ['players', 'projectiles']}
+
+
+class SlowSubscriberPolicy(Enum):
+    # Replace the digest that's still waiting to be written with the newer one
+    COALESCE = 'coalesce'
+    # Leave the digest that's still waiting to be written alone and don't send this tick's at all
+    SKIP = 'skip'
+
+
+class DigestSubscriber:
+    """
+    One connection's subscription to its game's digests. Writes happen on the subscriber's own thread, and there's
+    only ever room for one digest waiting to be written, so a slow socket only ever holds up itself.
+    """
+
+    def __init__(self, conn: Any, client_id: int) -> None:
+        self.conn = conn
+        self.client_id = client_id
+        self.digest_tracker = DigestTracker()
+        self._pending_message: Optional[bytes] = None
+        self._closed = False
+        self._condition = Condition()
+        start_new_thread(self._write_loop, ())
+
+    def packet_format(self) -> PacketFormat:
+        return get_packet_format(self.conn)
+
+    def is_backed_up(self) -> bool:
+        with self._condition:
+            return self._pending_message is not None
+
+    def is_closed(self) -> bool:
+        with self._condition:
+            return self._closed
+
+    # Returns whether an unwritten message was replaced
+    def offer(self, framed_message: bytes) -> bool:
+        with self._condition:
+            replaced = self._pending_message is not None
+            self._pending_message = framed_message
+            self._condition.notify()
+            return replaced
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._condition:
+                while self._pending_message is None and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                framed_message = self._pending_message
+                self._pending_message = None
+            assert framed_message is not None
+            try:
+                send_framed_message_without_retry(self.conn, framed_message)
+            except OSError:
+                self.close()
+                return
+
+
+class AsyncDigestSubscriber:
+    """
+    The same as DigestSubscriber, but for the asyncio server: writes happen on the subscriber's own task instead.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, client_id: int) -> None:
+        self.writer = writer
+        self.client_id = client_id
+        self.digest_tracker = DigestTracker()
+        self._pending_message: Optional[bytes] = None
+        self._closed = False
+        self._message_ready = asyncio.Event()
+        asyncio.ensure_future(self._write_loop())
+
+    def packet_format(self) -> PacketFormat:
+        return get_packet_format(self.writer)
+
+    def is_backed_up(self) -> bool:
+        return self._pending_message is not None
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    # Returns whether an unwritten message was replaced
+    def offer(self, framed_message: bytes) -> bool:
+        replaced = self._pending_message is not None
+        self._pending_message = framed_message
+        self._message_ready.set()
+        return replaced
+
+    def close(self) -> None:
+        self._closed = True
+        self._message_ready.set()
+
+    async def _write_loop(self) -> None:
+        while True:
+            await self._message_ready.wait()
+            self._message_ready.clear()
+            if self._closed:
+                return
+            framed_message = self._pending_message
+            self._pending_message = None
+            if framed_message is None:
+                continue
+            try:
+                await asend_framed_message_without_retry(self.writer, framed_message)
+            except OSError:
+                self.close()
+                return
+
+
+class GameBroadcaster:
+    """
+    Reads a game's command logs and digest fields once per tick and fans the resulting digests out to every
+    subscriber, so that the work of reading redis and building, serializing and compressing each digest is done once
+    per game rather than once per connection. Subscribers that have acked the same digest version share the same bytes.
+
+    on_slow_subscriber decides what happens to a subscriber whose previous digest hasn't been written yet. Since every
+    digest carries everything since the subscriber's last ack, both skipping and coalescing are safe.
+
+    Runs until it's stopped, once its game has ended. Subscribers whose connections have gone are dropped as it goes.
+    """
+
+    def __init__(self, game_name: str, *,
+                 on_slow_subscriber: SlowSubscriberPolicy = SlowSubscriberPolicy.COALESCE,
+                 broadcast_every: float = DIGEST_BROADCAST_EVERY) -> None:
+        self.game_name = game_name
+        self.on_slow_subscriber = on_slow_subscriber
+        self.broadcast_every = broadcast_every
+        self._subscribers_by_client_id: dict[int, Union[DigestSubscriber, AsyncDigestSubscriber]] = {}
+        self._subscribers_lock = Lock()
+        self._digest_builder = DigestBuilder(self._encode_digest, entity_fields=DIGEST_ENTITY_FIELDS)
+        self.stopped = False
+
+    def subscribe(self, conn: Any, client_id: int) -> Union[DigestSubscriber, AsyncDigestSubscriber]:
+        subscriber = self._make_subscriber(conn, client_id)
+        with self._subscribers_lock:
+            if (old_subscriber := self._subscribers_by_client_id.get(client_id)) is not None:
+                old_subscriber.close()
+            self._subscribers_by_client_id[client_id] = subscriber
+        return subscriber
+
+    def unsubscribe(self, client_id: int) -> None:
+        with self._subscribers_lock:
+            subscriber = self._subscribers_by_client_id.pop(client_id, None)
+        if subscriber is not None:
+            subscriber.close()
+
+    def ack(self, client_id: int, version: int) -> None:
+        if (subscriber := self._subscribers_by_client_id.get(client_id)) is not None:
+            subscriber.digest_tracker.ack(version)
+
+    # Stops run (or arun) before its next tick, and every subscriber's writes
+    def stop(self) -> None:
+        self.stopped = True
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers_by_client_id.values())
+            self._subscribers_by_client_id.clear()
+        for subscriber in subscribers:
+            subscriber.close()
+
+    def run(self) -> None:
+        while not self.stopped:
+            self.tick()
+            sleep(self.broadcast_every)
+
+    def tick(self) -> None:
+        if not self._has_subscribers():
+            return
+        self._fan_out(
+            command_logs={
+                'commands_by_player': get_commands_by_player(client_id=None, game_name=self.game_name),
+                'commands_by_projectile': get_commands_by_projectile(client_id=None, game_name=self.game_name),
+            },
+            fields={key: value or '' for key, value in zip(DIGEST_FIELDS, rmget(DIGEST_FIELDS, game_name=self.game_name))},
+        )
+
+    def _make_subscriber(self, conn: Any, client_id: int) -> Union[DigestSubscriber, AsyncDigestSubscriber]:
+        return DigestSubscriber(conn, client_id)
+
+    def _has_subscribers(self) -> bool:
+        return bool(self._subscribers_by_client_id)
+
+    def _fan_out(self, command_logs: dict[str, CommandLog], fields: dict[str, str]) -> None:
+        with self._subscribers_lock:
+            for client_id, subscriber in list(self._subscribers_by_client_id.items()):
+                if subscriber.is_closed():
+                    del self._subscribers_by_client_id[client_id]
+            subscribers = list(self._subscribers_by_client_id.values())
+        with metrics.timer('digest_build_seconds', game=self.game_name):
+            digest_tick = self._digest_builder.start_tick(command_logs, fields)
+            framed_messages = [(subscriber, digest_tick.encoded_digest_for(subscriber.digest_tracker, subscriber.packet_format()))
+                               for subscriber in subscribers
+                               if not (self.on_slow_subscriber == SlowSubscriberPolicy.SKIP and subscriber.is_backed_up())]
+        for subscriber, framed_message in framed_messages:
+            subscriber.offer(framed_message)
+            metrics.inc('digests_sent_total', game=self.game_name)
+            metrics.inc('digest_bytes_total', len(framed_message), game=self.game_name)
+
+    def _encode_digest(self, digest: dict[str, Any], packet_format: PacketFormat) -> bytes:
+        return frame_message_without_retry(f'all_info_digest|{json.dumps(digest)}', client_id=None, packet_format=packet_format)
+
+
+class AsyncGameBroadcaster(GameBroadcaster):
+    """
+    The same as GameBroadcaster, but for the asyncio server: ticks run as a task on the event loop and read redis
+    with the async client.
+    """
+
+    async def arun(self) -> None:
+        while not self.stopped:
+            await self.atick()
+            await asyncio.sleep(self.broadcast_every)
+
+    async def atick(self) -> None:
+        if not self._has_subscribers():
+            return
+        self._fan_out(
+            command_logs={
+                'commands_by_player': await aget_commands_by_player(game_name=self.game_name),
+                'commands_by_projectile': await aget_commands_by_projectile(game_name=self.game_name),
+            },
+            fields={key: value or '' for key, value in zip(DIGEST_FIELDS, await armget(DIGEST_FIELDS, game_name=self.game_name))},
+        )
+
+    def _make_subscriber(self, conn: Any, client_id: int) -> Union[DigestSubscriber, AsyncDigestSubscriber]:
+        return AsyncDigestSubscriber(conn, client_id)
+
+
+broadcasters_by_game_name: dict[str, GameBroadcaster] = {}
+_broadcasters_lock = Lock()
+
+
+def get_broadcaster(game_name: str) -> GameBroadcaster:
+    with _broadcasters_lock:
+        if (broadcaster := broadcasters_by_game_name.get(game_name)) is None:
+            broadcaster = GameBroadcaster(game_name)
+            broadcasters_by_game_name[game_name] = broadcaster
+            start_new_thread(broadcaster.run, ())
+        return broadcaster
+
+
+def find_broadcaster(game_name: str) -> Optional[GameBroadcaster]:
+    with _broadcasters_lock:
+        return broadcasters_by_game_name.get(game_name)
+
+
+def stop_broadcaster(game_name: str) -> None:
+    with _broadcasters_lock:
+        broadcaster = broadcasters_by_game_name.pop(game_name, None)
+    if broadcaster is not None:
+        broadcaster.stop()
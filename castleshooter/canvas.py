@@ -1,5 +1,13 @@
+from typing import Callable, Hashable, Optional
+
 import pygame
 
+
+# How far off the edge of the screen something can be and still have part of itself on it: an arrow's length, a
+# player's target circle and so on
+VIEWPORT_MARGIN = 100
+
+
 class Canvas:
 
     def __init__(self, w: int, h: int, name: str="None"):
@@ -7,13 +15,67 @@ class Canvas:
         self.height = h
         self.screen: pygame.surface.Surface = pygame.display.set_mode((w,h))
         pygame.display.set_caption(name)
+        self._last_dirty_rects: Optional[list[pygame.Rect]] = None
 
-    @staticmethod
-    def update():
-        pygame.display.update()
+    # Pushes the frame to the display. Given dirty_rects, only they and last frame's dirty rects are pushed, which is
+    # only right if everything outside of them was drawn exactly where it was last frame, so pass None whenever the
+    # camera has moved.
+    def update(self, dirty_rects: Optional[list[pygame.Rect]] = None) -> None:
+        if dirty_rects is None or self._last_dirty_rects is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(self._last_dirty_rects + dirty_rects)
+        self._last_dirty_rects = dirty_rects
 
     def get_canvas(self):
         return self.screen
 
     def draw_background(self):
-        self.screen.fill((255,255,255))
\ No newline at end of file
+        self.screen.fill((255,255,255))
+
+
+class Viewport:
+    """
+    The part of the map that's on screen when the camera is at x_offset, y_offset, and VIEWPORT_MARGIN around it.
+    Anything outside of it is skipped when drawing.
+    """
+
+    def __init__(self, x_offset: int, y_offset: int, w: int, h: int, margin: int = VIEWPORT_MARGIN) -> None:
+        self.min_x = x_offset - margin
+        self.min_y = y_offset - margin
+        self.max_x = x_offset + w + margin
+        self.max_y = y_offset + h + margin
+
+    def contains(self, x: float, y: float) -> bool:
+        return self.min_x <= x <= self.max_x and self.min_y <= y <= self.max_y
+
+
+class StaticLayer:
+    """
+    Things drawn over the game that rarely change, like the hearts, the held weapon and the score. They're drawn once
+    onto a transparent surface of their own, which is copied onto every frame until the key they were drawn for
+    changes. Only the rects that were drawn on get copied.
+    """
+
+    def __init__(self, w: int, h: int) -> None:
+        self.surface = pygame.Surface((w, h), pygame.SRCALPHA)
+        self.rects: list[pygame.Rect] = []
+        self._key: Optional[Hashable] = None
+        self._drawn = False
+
+    # draw draws the layer onto the surface it's given and returns the rects it drew on. Returns the rects that look
+    # different now, which is none of them unless the layer had to be redrawn.
+    def update(self, key: Hashable, draw: Callable[[pygame.surface.Surface], list[Optional[pygame.Rect]]]) -> list[pygame.Rect]:
+        if self._drawn and key == self._key:
+            return []
+        old_rects = self.rects
+        self.surface.fill((0, 0, 0, 0))
+        bounds = self.surface.get_rect()
+        self.rects = [rect.clip(bounds) for rect in draw(self.surface) if rect is not None]
+        self._key = key
+        self._drawn = True
+        return old_rects + self.rects
+
+    def blit(self, canvas: pygame.surface.Surface) -> None:
+        for rect in self.rects:
+            canvas.blit(self.surface, rect, rect)
@@ -1,28 +1,33 @@
 from datetime import datetime, timedelta
+from functools import partial
 import zlib
 from announcement import Announcement, get_announcement_idempotency_key_for_command
 from death_reason import DeathReason, death_reason_to_verb
-from command import Command, CommandType, get_commands_by_player, commands_by_player, get_commands_by_projectile, commands_by_projectile
+from command import Command, CommandLog, CommandType, decode_command, encode_commands, get_commands_by_player, commands_by_player, get_commands_by_projectile, commands_by_projectile
 from settings import PORT, SERVER
 import socket
-from typing import Any, Optional
-from redis_utils import rset, rget, redis_lock    
+from typing import Any, Callable, Optional
 from _thread import start_new_thread
 from threading import Thread
-from client_utils import get_player_number_from_client_id
+from client_utils import client_state, get_player_number_from_client_id
 from client_utils import _client as client
 from packet import (
-    Packet, send_ack, send_spawn_command, send_without_retry, packet_ack_redis_key, packet_handled_redis_key, send_with_retry,
-    receive_compressed_message
+    Packet, send_ack, send_spawn_command, send_without_retry, send_with_retry,
+    receive_packets, negotiate_packet_format, record_ack
 )
 import json
 from json.decoder import JSONDecodeError
-from game import Game, GameState, game_state_snapshots, run_spontaneous_game_processes, handle_hp_loss_for_commands
+from game import (
+    AuthoritativeState, Game, GameState, store_authoritative_state, store_game_state_snapshot, handle_hp_loss_for_commands
+)
+from broadcaster import DIGEST_ENTITY_FIELDS, DIGEST_FIELDS
+from digest import DIGEST_HISTORY_LENGTH, apply_entity_field_diff
 from utils import MAX_GAME_STATE_SNAPSHOTS, SNAPSHOTS_CREATED_EVERY, LOG_CUTOFF, MAX_SCORE
 from time import sleep
 import pygame
 from team import Team, flip_team
 from score import score
+from profiler import profiled, profiler
 import traceback
 
 
@@ -41,7 +46,6 @@ def start_up_game(socket: Any) -> None:
     print('Sending the spawn command!')  
     global game
     game = Game(750, 750, client, socket)
-    start_new_thread(run_spontaneous_game_processes, (game,))
     start_new_thread(send_all_commands_heartbeats, (socket,))
     game.run()    
 
@@ -77,133 +81,139 @@ def handle_announcements_for_commands(commands_for_player: list[Command]) -> Non
                     game.add_announcement(Announcement(command_idempotency_key, datetime.now(), message))
 
 
-def handle_client_changes_for_all_commands(commands_by_player: dict[int, list[str]]) -> None:
+def handle_client_changes_for_commands(commands: list[tuple[int, Command]]) -> None:
     game = get_game()
     if game is not None:
-        for client_id, raw_commands in commands_by_player.items():
-            for raw_command in raw_commands:
-                command = Command.from_json(json.loads(raw_command))
-                if command.id not in [c.id for c in game.commands_handled]:
-                    if command.type == CommandType.DIE:
-                        global score
-                        actual_score = score.get()
-                        actual_red_score, actual_blue_score = actual_score
-                        game_over = actual_red_score >= MAX_SCORE or actual_blue_score >= MAX_SCORE
-                        if not game_over:                    
-                            team_to_gain_point = flip_team(Team(rget(f'team:{client_id}', client_id=client.id)))
-                            score.increment(team_to_gain_point, max_delay_seconds=10)
-
-                            game.commands_handled.append(command)
-                            game.commands_handled = [c for c in game.commands_handled if c.time > datetime.now() - timedelta(seconds=20)]
+        for client_id, command in commands:
+            if command.id not in [c.id for c in game.commands_handled]:
+                if command.type == CommandType.DIE:
+                    global score
+                    actual_score = score.get()
+                    actual_red_score, actual_blue_score = actual_score
+                    game_over = actual_red_score >= MAX_SCORE or actual_blue_score >= MAX_SCORE
+                    if not game_over:                    
+                        team_to_gain_point = flip_team(client_state.teams[client_id])
+                        score.increment(team_to_gain_point, max_delay_seconds=10)
+
+                        game.commands_handled.append(command)
+                        game.commands_handled = [c for c in game.commands_handled if c.time > datetime.now() - timedelta(seconds=20)]
 
 
 def _handle_most_recent_game_snapshot(data: str) -> None:
     if not data:
         return
     try:
-        json.loads(data)
-    except JSONDecodeError as e:
+        snap_time = datetime.fromtimestamp(json.loads(data)['time'])
+    except (JSONDecodeError, KeyError, TypeError) as e:
         print(f'Ignoring unparseable snap from server: {data[:LOG_CUTOFF]}')
         return
-    game_state_snapshots.append(data)
-    if len(game_state_snapshots) > MAX_GAME_STATE_SNAPSHOTS:
-        del game_state_snapshots[0]
-
-
-def _handle_commands_by_player(data: str) -> None:
-    raw_commands_by_player = get_commands_by_player(client_id=client.id)
-    raw_commands_by_player_from_server = {int(key): val for key, val in json.loads(data).items()}
-    player_ids_handled: set[int] = set()
-    global commands_by_player
-    for player_id, raw_commands in raw_commands_by_player.items():
-        player_ids_handled.add(player_id)
-        commands_for_player = sorted([Command.from_json(json.loads(c)) for c in raw_commands], 
-                                        key=lambda c: c.time)
-        commands_for_player = [c for c in commands_for_player 
-                                if c.time > datetime.now() - timedelta(seconds=MAX_GAME_STATE_SNAPSHOTS*SNAPSHOTS_CREATED_EVERY)]
-        raw_commands_from_server = raw_commands_by_player_from_server.get(player_id) or []
-        commands_for_player_from_server = sorted([Command.from_json(json.loads(c)) for c in raw_commands_from_server], key=lambda c: c.time)
-        commands_for_player_from_server = [c for c in commands_for_player_from_server 
-                                            if (c.time > datetime.now() - timedelta(seconds=MAX_GAME_STATE_SNAPSHOTS*SNAPSHOTS_CREATED_EVERY)
-                                                and c.id not in [ci.id for ci in commands_for_player])]
-        commands_for_player.extend(commands_for_player_from_server)
-        commands_by_player[player_id] = [json.dumps(c.to_json()) for c in commands_for_player]
-        handle_announcements_for_commands(commands_for_player)
-        handle_hp_loss_for_commands(get_game(), commands_for_player)
-        handle_client_changes_for_all_commands(commands_by_player)    
+    store_game_state_snapshot(data, snap_time, client_id=client.id)
+
 
-    for player_id, raw_commands_from_server in raw_commands_by_player_from_server.items():
-        if player_id in player_ids_handled:
+@profiled('authoritative_state')
+def _handle_authoritative_state(authoritative_state_json: dict) -> None:
+    store_authoritative_state(AuthoritativeState.from_json(authoritative_state_json), client_id=client.id)
+
+
+# A digest only carries what's changed since its base version, the last one the server heard we'd applied, which is
+# usually older than the last one we did apply. So we keep every field (the entity fields as JSON objects) as of each
+# version we've applied, and apply each digest to its own base version.
+_digest_fields_by_version: dict[int, dict[str, Any]] = {}
+# The value of each field we last handled, so that each change is only handled once
+_handled_digest_fields: dict[str, Any] = {}
+
+
+# Returns every field as of the digest's version, or None if it was built against a version we've forgotten
+def _apply_digest_fields(all_info_digest: dict) -> Optional[dict[str, Any]]:
+    base_version = all_info_digest.get('base_version')
+    if base_version is None:
+        fields: dict[str, Any] = {}
+    elif (base_fields := _digest_fields_by_version.get(base_version)) is not None:
+        fields = dict(base_fields)
+    else:
+        return None
+    for key in DIGEST_FIELDS:
+        if key not in all_info_digest:
             continue
-        player_ids_handled.add(player_id)
-        commands_for_player = sorted([Command.from_json(json.loads(c)) for c in raw_commands_from_server], 
-                                        key=lambda c: c.time)                
-        commands_for_player = [c for c in commands_for_player 
-                                if c.time > datetime.now() - timedelta(seconds=MAX_GAME_STATE_SNAPSHOTS*SNAPSHOTS_CREATED_EVERY)]
-        commands_by_player[player_id] = [json.dumps(c.to_json()) for c in commands_for_player]     
-        handle_announcements_for_commands(commands_for_player)   
+        value = all_info_digest[key]
+        if key in DIGEST_ENTITY_FIELDS:
+            value = apply_entity_field_diff(fields.get(key) or {}, json.loads(value), DIGEST_ENTITY_FIELDS[key]) if value else {}
+        fields[key] = value
+    _digest_fields_by_version[all_info_digest['version']] = fields
+    if len(_digest_fields_by_version) > DIGEST_HISTORY_LENGTH:
+        del _digest_fields_by_version[next(iter(_digest_fields_by_version))]
+    return fields
+
+
+def _handle_digest_field(key: str, fields: dict[str, Any], handle: Callable[[Any], None]) -> None:
+    value = fields.get(key)
+    if value and value != _handled_digest_fields.get(key):
+        _handled_digest_fields[key] = value
+        handle(value)
+
+
+def _merge_commands_from_server(command_log: CommandLog, raw_commands_by_entity: dict[str, list[str]]) -> None:
+    cutoff = datetime.now() - timedelta(seconds=MAX_GAME_STATE_SNAPSHOTS*SNAPSHOTS_CREATED_EVERY)
+    for raw_entity_id, raw_commands in raw_commands_by_entity.items():
+        entity_id = int(raw_entity_id)
+        for raw_command in raw_commands:
+            command = decode_command(raw_command)
+            if command.time > cutoff:
+                command_log.add(entity_id, command)
+    command_log.trim(cutoff)
+
+
+# Where we got to in commands_by_player the last time we ran the handlers over it
+_commands_by_player_handled_cursor = 0
+
+
+@profiled('commands_by_player')
+def _handle_commands_by_player(raw_commands_by_player: dict[str, list[str]]) -> None:
+    global _commands_by_player_handled_cursor
+    _merge_commands_from_server(commands_by_player, raw_commands_by_player)
+    new_commands, _commands_by_player_handled_cursor = (commands_by_player.read_since(_commands_by_player_handled_cursor) 
+                                                        or commands_by_player.read_all())
+    new_commands_by_player: dict[int, list[Command]] = {}
+    for player_id, command in new_commands:
+        new_commands_by_player.setdefault(player_id, []).append(command)
+    for commands_for_player in new_commands_by_player.values():
+        handle_announcements_for_commands(commands_for_player)
         handle_hp_loss_for_commands(get_game(), commands_for_player)
-        handle_client_changes_for_all_commands(commands_by_player)    
-
-
-def _handle_commands_by_projectile(data: str) -> None:
-    raw_commands_by_projectile = get_commands_by_projectile(client_id=client.id)
-    raw_commands_by_projectile_from_server = {int(key): val for key, val in json.loads(data).items()}
-    projectile_ids_handled: set[int] = set()
-    global commands_by_projectile
-    for projectile_id, raw_commands in raw_commands_by_projectile.items():
-        projectile_ids_handled.add(projectile_id)
-        commands_for_projectile = sorted([Command.from_json(json.loads(c)) for c in raw_commands], 
-                                        key=lambda c: c.time)
-        commands_for_projectile = [c for c in commands_for_projectile 
-                                if c.time > datetime.now() - timedelta(seconds=MAX_GAME_STATE_SNAPSHOTS*SNAPSHOTS_CREATED_EVERY)]
-        raw_commands_from_server = raw_commands_by_projectile_from_server.get(projectile_id) or []
-        commands_for_projectile_from_server = sorted([Command.from_json(json.loads(c)) for c in raw_commands_from_server], key=lambda c: c.time)
-        commands_for_projectile_from_server = [c for c in commands_for_projectile_from_server 
-                                            if (c.time > datetime.now() - timedelta(seconds=MAX_GAME_STATE_SNAPSHOTS*SNAPSHOTS_CREATED_EVERY)
-                                                and c.id not in [ci.id for ci in commands_for_projectile])]
-        commands_for_projectile.extend(commands_for_projectile_from_server)
-        commands_by_projectile[projectile_id] = [json.dumps(c.to_json()) for c in commands_for_projectile]
-
-    for projectile_id, raw_commands_from_server in raw_commands_by_projectile_from_server.items():
-        if projectile_id in projectile_ids_handled:
-            continue
-        projectile_ids_handled.add(projectile_id)
-        commands_for_projectile = sorted([Command.from_json(json.loads(c)) for c in raw_commands_from_server], 
-                                        key=lambda c: c.time)                
-        commands_for_projectile = [c for c in commands_for_projectile 
-                                if c.time > datetime.now() - timedelta(seconds=MAX_GAME_STATE_SNAPSHOTS*SNAPSHOTS_CREATED_EVERY)]
-        commands_by_projectile[projectile_id] = [json.dumps(c.to_json()) for c in commands_for_projectile]       
+    handle_client_changes_for_commands(new_commands)
+
+
+def _handle_commands_by_projectile(raw_commands_by_projectile: dict[str, list[str]]) -> None:
+    _merge_commands_from_server(commands_by_projectile, raw_commands_by_projectile)
 
 
 def _handle_client_id_to_player_number(data: str) -> None:
     client_id_to_player_number = json.loads(data)
 
-    for client_id, player_number in client_id_to_player_number.items():
-        rset(f'player_number:{client_id}', player_number, client_id=client.id)
-        rset(f'client_id:{player_number}', client_id, client_id=client.id)
+    client_state.set_player_numbers({int(client_id): int(player_number) 
+                                     for client_id, player_number in client_id_to_player_number.items()})
 
     start_new_thread(_start_game_on_delay, tuple([]))    
 
 
 def _handle_client_id_to_team(data: str) -> None:
-    client_id_to_team = json.loads(data)
-    red_team = []
-    blue_team = []
-    for client_id, team in client_id_to_team.items():
-        if team == Team.RED.value:
-            red_team.append(client_id)
-        else:
-            blue_team.append(client_id)
-        rset(f'team:{client_id}', team, client_id=client.id)
-        if int(client_id) == int(client.id):
-            print(f'Setting team to {team}')
-            client.set_team(Team(team))
-    rset(f'red_team', json.dumps(red_team), client_id=client.id)
-    rset(f'blue_team', json.dumps(blue_team), client_id=client.id)
+    client_id_to_team = {int(client_id): Team(team) for client_id, team in json.loads(data).items()}
+    client_state.set_teams(client_id_to_team)
+    if (team := client_id_to_team.get(client.id)) is not None:
+        print(f'Setting team to {team.value}')
+        client.set_team(team)
+
+
+def _handle_active_players(data: str) -> None:
+    try:
+        active_players = json.loads(data)
+    except JSONDecodeError:
+        # The lobby's active players are just a comma-separated list of client ids, which nothing shows
+        return
+    if isinstance(active_players, list):
+        client_state.set_active_players(active_players)
 
 
-def _handle_payload_from_server(payload: str) -> None:
+def _handle_payload_from_server(socket: Any, payload: str) -> None:
     if payload.startswith('client_id|') and client.id is None:
         pass
     else:
@@ -213,10 +223,10 @@ def _handle_payload_from_server(payload: str) -> None:
             _handle_most_recent_game_snapshot(data)
 
         if 'commands_by_player' in key:
-            _handle_commands_by_player(data)
+            _handle_commands_by_player(json.loads(data))
 
         if 'commands_by_projectile' in key:
-            _handle_commands_by_projectile(data)
+            _handle_commands_by_projectile(json.loads(data))
 
         if 'client_id_to_player_number' in key:
             _handle_client_id_to_player_number(data)
@@ -225,25 +235,29 @@ def _handle_payload_from_server(payload: str) -> None:
             _handle_client_id_to_team(data)
 
         if 'active_players' in key:
-            rset('active_players', data, client_id=client.id)
+            _handle_active_players(data)
 
         if 'game_names' in key:
             print(f'Setting game_names to {data}')
-            rset('game_names', data, client_id=client.id)
+            client_state.set_game_names(json.loads(data or '{}'))
 
         if 'all_info_digest' in key:
-            all_info_digest = json.loads(data)
-            if not client.game_started:
-                if (client_id_to_player_number_data := all_info_digest.get('client_id_to_player_number')):
-                    _handle_client_id_to_player_number(client_id_to_player_number_data)
-                if (client_id_to_team_data := all_info_digest.get('client_id_to_team')):
-                    _handle_client_id_to_team(client_id_to_team_data)
+            with profiler.section('digest json'):
+                all_info_digest = json.loads(data)
+            if (digest_fields := _apply_digest_fields(all_info_digest)) is None:
+                # We can't apply this one, and since we don't ack it, the server will send a keyframe soon enough
+                pass
+            elif not client.game_started:
+                _handle_digest_field('client_id_to_player_number', digest_fields, _handle_client_id_to_player_number)
+                _handle_digest_field('client_id_to_team', digest_fields, _handle_client_id_to_team)
             else:
                 print('Handling digest!')
-                # print(f'Most recent game snapshot: {all_info_digest.get("most_recent_game_state_snapshot")}')
-                _handle_most_recent_game_snapshot(all_info_digest.get('most_recent_game_state_snapshot') or '')
-                _handle_commands_by_player(all_info_digest.get('commands_by_player') or '{}')
-                _handle_commands_by_projectile(all_info_digest.get('commands_by_projectile') or '{}')
+                _handle_digest_field('most_recent_game_state_snapshot', digest_fields, _handle_most_recent_game_snapshot)
+                _handle_commands_by_player(all_info_digest.get('commands_by_player') or {})
+                _handle_commands_by_projectile(all_info_digest.get('commands_by_projectile') or {})
+                _handle_digest_field('authoritative_state', digest_fields, _handle_authoritative_state)
+                # The server keeps re-sending whatever we haven't acked, so we only ack digests we've actually applied
+                send_without_retry(socket, f'digest_ack|{all_info_digest["version"]}', client_id=client.id)
 
         if 'game_started' in key:
             # if data == '1':
@@ -251,7 +265,12 @@ def _handle_payload_from_server(payload: str) -> None:
 
             pass
 
-stored_data: list[str] = []
+# Run on the game's thread, at the start of a simulation step
+def _apply_payload_from_server(socket: Any, payload: str) -> None:
+    try:
+        _handle_payload_from_server(socket, payload)
+    except Exception as e:
+        print(f'Ignoring {payload[:LOG_CUTOFF]} because of exception: {e}\n')
 
 
 def _start_game_on_delay():
@@ -259,37 +278,29 @@ def _start_game_on_delay():
     client.set_game_started(True)
 
 
-def _clear_stored_data(stored_data: list[str]) -> None:
-    while stored_data:
-        del stored_data[0]
-
-
 # Returns whether or not it's the client_id packet at the beginning
-def _handle_datum(socket: Any, datum: str, client_id_only: bool = False) -> bool:
-    print(f'received: {datum[:LOG_CUTOFF]}\n')
-    packet = Packet.from_str(datum)
+def _handle_packet(socket: Any, packet: Packet, client_id_only: bool = False) -> bool:
+    print(f'received: {str(packet)[:LOG_CUTOFF]}\n')
     packet_id = packet.id
     payload = packet.payload
     if packet.is_ack:
         assert packet_id is not None
-        # Record in redis that the message has been acked
-        rset(packet_ack_redis_key(packet_id), '1', client_id=client.id)
+        record_ack(socket, packet_id)
     elif packet_id is None:
         assert payload is not None
-        _handle_payload_from_server(payload)
+        client_state.queue_server_update(partial(_apply_payload_from_server, socket, payload))
     else:
         assert payload is not None
-        handled_redis_key = packet_handled_redis_key(packet_id, for_client=None)
         # Want to make sure not to handle the same packet twice due to a re-send, 
         # if our ack didn't get through
-        if not rget(handled_redis_key, client_id=client.id or -1):
+        if not client_state.handled_packets.is_handled(packet_id):
             if client_id_only:
                 if _handle_client_id_packet(payload):
                     return True
             else:
-                _handle_payload_from_server(payload)
+                client_state.queue_server_update(partial(_apply_payload_from_server, socket, payload))
             send_ack(socket, packet_id)
-            rset(handled_redis_key, '1', client_id=client.id or -1)
+            client_state.handled_packets.mark_handled(packet_id)
         else:
             print(f'Ignoring {str(packet)[:LOG_CUTOFF]} because this packet has already been handled\n')
     return False
@@ -297,46 +308,31 @@ def _handle_datum(socket: Any, datum: str, client_id_only: bool = False) -> bool
 
 def listen_for_server_updates(socket: Any, client_id_only: bool = False) -> None:
     while True:
-        global stored_data
         try:
             # 1048576
-            raw_data = receive_compressed_message(socket)
+            packets = receive_packets(socket)
+        except ConnectionError as e:
+            print(f'Lost connection to the server: {e}')
+            return
         except Exception as e:
             print(f'Error decompressing data: {e}')
             traceback.print_exc()
-            raw_data = ''
+            packets = []
             sleep(0.02)
-        for datum in raw_data.split(';'):
-            # Sometimes packets get split by TCP or something, 
-            # so if we fail to process a packet successfully, we store it and instead try processing it concatenated
-            # to the next packet            
-            if datum:
-                try:
-                    if _handle_datum(socket, datum, client_id_only=client_id_only) and client_id_only:
-                        return
-                except Exception as e1:
-                    stored_data.append(datum)
-                    if len(stored_data) > 1:
-                        joint_datum = ''.join(stored_data)
-                        try:
-                            if _handle_datum(socket, ''.join(stored_data), client_id_only=client_id_only) and client_id_only:
-                                return
-                        except Exception as e2:
-                            print(f'Ignoring {joint_datum} because of exception: {e2}\n')
-                        else:
-                            _clear_stored_data(stored_data)
-                    else:
-                        print(f'Ignoring {datum} because of exception: {e1}\n')
-                else:
-                    _clear_stored_data(stored_data)
+        for packet in packets:
+            try:
+                if _handle_packet(socket, packet, client_id_only=client_id_only) and client_id_only:
+                    return
+            except Exception as e:
+                print(f'Ignoring {packet} because of exception: {e}\n')
 
 
 def send_all_commands_heartbeats(socket: Any) -> None:
     while True:
         if client.game_started:
-            commands_for_player = get_commands_by_player(client_id=client.id)[client.id]
+            commands_for_player = get_commands_by_player(client_id=client.id).get(client.id)
 
-            send_with_retry(socket, f'all_commands_heartbeat|{json.dumps(commands_for_player)}', client_id=client.id)
+            send_with_retry(socket, f'all_commands_heartbeat|{encode_commands(commands_for_player)}', client_id=client.id)
 
         sleep(0.25)
 
@@ -359,6 +355,7 @@ def client_main() -> None:
         print('Listening for server updates!')
         thread.join()
         start_new_thread(listen_for_server_updates, (s,))
+        start_new_thread(negotiate_packet_format, (s, client.id))
         start_up_game(s)
     finally:
         print('Closing the socket!!')
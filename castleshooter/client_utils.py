@@ -1,7 +1,10 @@
-from typing import Optional, TYPE_CHECKING
+from itertools import count
+from queue import Empty, SimpleQueue
+from typing import Any, Callable, Optional, TYPE_CHECKING
 if TYPE_CHECKING:
     from team import Team
 
+from ack_registry import HandledPacketWindow
 from redis_utils import rget
 
 
@@ -33,6 +36,69 @@ class Client:
 _client = Client()
 
 
+class ClientState:
+    """
+    What a client knows about the lobby and the game it's in, kept as the types it gets used as, so that the render
+    loop can look things up in plain dicts rather than parsing strings every frame.
+
+    The network thread doesn't touch any of it, or the game, itself: it queues up each of the server's packets and
+    digests as it comes in, and the game applies them all at the start of its next simulation step, so that nothing
+    changes halfway through one.
+
+    The AI players on the server read the same things straight out of the server's storage instead, apart from the
+    command and item id counters, which they share with each other through here.
+    """
+
+    def __init__(self) -> None:
+        self.player_numbers: dict[int, int] = {}
+        self.client_ids: dict[int, int] = {}
+        self.teams: dict[int, 'Team'] = {}
+        self.active_players: list[Any] = []
+        self.game_names: dict[str, bool] = {}
+        self.handled_packets = HandledPacketWindow()
+        self.server_updates: SimpleQueue[Callable[[], None]] = SimpleQueue()
+        self._command_ids = count(2, 2)
+        self._item_ids = count()
+
+    def set_player_numbers(self, player_numbers: dict[int, int]) -> None:
+        self.player_numbers = player_numbers
+        self.client_ids = {player_number: client_id for client_id, player_number in player_numbers.items()}
+
+    def set_teams(self, teams: dict[int, 'Team']) -> None:
+        self.teams = teams
+
+    def team_client_ids(self, team: 'Team') -> list[int]:
+        return [client_id for client_id, client_team in self.teams.items() if client_team == team]
+
+    def set_active_players(self, active_players: list[Any]) -> None:
+        self.active_players = active_players
+
+    def set_game_names(self, game_names: dict[str, bool]) -> None:
+        self.game_names = game_names
+
+    # Can be called from any thread
+    def queue_server_update(self, update: Callable[[], None]) -> None:
+        self.server_updates.put(update)
+
+    # Only called from the game's thread
+    def apply_server_updates(self) -> None:
+        while True:
+            try:
+                update = self.server_updates.get_nowait()
+            except Empty:
+                return
+            update()
+
+    def next_command_id(self) -> int:
+        return next(self._command_ids)
+
+    def next_item_id(self) -> int:
+        return next(self._item_ids)
+
+
+client_state = ClientState()
+
+
 def get_client(ai_client_id: Optional[int] = None, ai_team: Optional['Team'] = None, game_name: Optional[str] = None) -> Client:
     if ai_client_id is None:
         return _client
@@ -48,14 +114,18 @@ def get_client(ai_client_id: Optional[int] = None, ai_team: Optional['Team'] = N
 
 
 def get_player_number_from_client_id(from_client_id: int, *, client_id: Optional[int], game_name: Optional[str] = None) -> int:
-    raw_player_number = rget(f'player_number:{from_client_id}', client_id=client_id if game_name is None else None, game_name=game_name)
+    if game_name is None:
+        return client_state.player_numbers[from_client_id]
+    raw_player_number = rget(f'player_number:{from_client_id}', client_id=None, game_name=game_name)
     assert raw_player_number is not None
     return int(raw_player_number)
 
 
 def get_client_id_from_player_number(player_number: int, *, client_id: int, game_name: Optional[str] = None) -> int:
     assert client_id is not None
-    raw_client_id = rget(f'client_id:{player_number}', client_id=client_id if game_name is None else None, game_name=game_name)
+    if game_name is None:
+        return client_state.client_ids[player_number]
+    raw_client_id = rget(f'client_id:{player_number}', client_id=None, game_name=game_name)
     assert raw_client_id is not None
     return int(raw_client_id)
 
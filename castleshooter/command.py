@@ -1,18 +1,17 @@
-from collections import defaultdict
+import base64
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
 from enum import Enum
 import json
+import struct
+from threading import Lock
 
-from typing import Optional
-from redis_utils import redis_lock, rget, rset
+from typing import Any, Mapping, Optional
+from redis_utils import RedisBatch, arlog_append, arlog_read, rlog_append, rlog_read
 
 from utils import MAX_GAME_STATE_SNAPSHOTS, SNAPSHOTS_CREATED_EVERY, to_optional_int, remove_nones
 
 
-commands_by_player: dict[int, list[str]] = defaultdict(list)
-commands_by_projectile: dict[int, list[str]] = defaultdict(list)
-
-
 class CommandType(Enum):
     MOVE = 'move'
     SPAWN = 'spawn'
@@ -56,56 +55,384 @@ class Command():
                                        'client_id': d.get('client_id')}))
 
 
-def get_commands_by_player(*, client_id: Optional[int] = None, game_name: Optional[str] = None) -> dict[int, list[str]]:
+class CommandLog:
+    """
+    The commands for each player (or each projectile), kept sorted by time and deduplicated by their packed bytes.
+    Command ids can't be used for that, since each client numbers its own, and a player's log also holds commands
+    other clients issued about them (a LOSE_HP from whoever hit them, say).
+
+    Every command that gets added is also recorded in an append-only journal, so that readers can keep a cursor
+    and ask for just the commands that were added since they last looked.
+    """
+
+    def __init__(self) -> None:
+        self._commands: dict[int, list[Command]] = {}
+        self._times: dict[int, list[datetime]] = {}
+        self._packed_commands: dict[int, list[bytes]] = {}
+        self._packed_command_sets: dict[int, set[bytes]] = {}
+        self._journal: list[tuple[int, Command]] = []
+        self._journal_offset = 0
+        self._lock = Lock()
+
+    # packed_command can be passed if the command has already been packed, to save packing it again
+    def add(self, entity_id: int, command: Command, packed_command: Optional[bytes] = None) -> bool:
+        if packed_command is None:
+            packed_command = pack_command(command)
+        with self._lock:
+            packed_command_set = self._packed_command_sets.setdefault(entity_id, set())
+            if packed_command in packed_command_set:
+                return False
+            packed_command_set.add(packed_command)
+            times = self._times.setdefault(entity_id, [])
+            index = bisect_right(times, command.time)
+            times.insert(index, command.time)
+            self._commands.setdefault(entity_id, []).insert(index, command)
+            self._packed_commands.setdefault(entity_id, []).insert(index, packed_command)
+            self._journal.append((entity_id, command))
+            return True
+
+    def get(self, entity_id: int) -> list[Command]:
+        with self._lock:
+            return list(self._commands.get(entity_id) or [])
+
+    def items(self) -> list[tuple[int, list[Command]]]:
+        with self._lock:
+            return [(entity_id, list(commands)) for entity_id, commands in self._commands.items()]
+
+    def cursor(self) -> int:
+        with self._lock:
+            return self._journal_offset + len(self._journal)
+
+    # Returns every command along with the cursor to pass to read_since next time
+    def read_all(self) -> tuple[list[tuple[int, Command]], int]:
+        with self._lock:
+            return ([(entity_id, command) for entity_id, commands in self._commands.items() for command in commands],
+                    self._journal_offset + len(self._journal))
+
+    # Returns None if the journal has already been trimmed past the cursor
+    def read_since(self, cursor: int) -> Optional[tuple[list[tuple[int, Command]], int]]:
+        with self._lock:
+            if cursor < self._journal_offset:
+                return None
+            return self._journal[cursor - self._journal_offset:], self._journal_offset + len(self._journal)
+
+    def trim(self, before: datetime) -> None:
+        with self._lock:
+            for entity_id in list(self._commands.keys()):
+                times = self._times[entity_id]
+                index = bisect_left(times, before)
+                if index == 0:
+                    continue
+                self._packed_command_sets[entity_id].difference_update(self._packed_commands[entity_id][:index])
+                del self._commands[entity_id][:index]
+                del self._packed_commands[entity_id][:index]
+                del times[:index]
+                if not times:
+                    del self._commands[entity_id]
+                    del self._times[entity_id]
+                    del self._packed_commands[entity_id]
+                    del self._packed_command_sets[entity_id]
+            journal_entries_to_drop = 0
+            while journal_entries_to_drop < len(self._journal) and self._journal[journal_entries_to_drop][1].time < before:
+                journal_entries_to_drop += 1
+            del self._journal[:journal_entries_to_drop]
+            self._journal_offset += journal_entries_to_drop
+
+
+commands_by_player = CommandLog()
+commands_by_projectile = CommandLog()
+
+
+# Compact binary encoding for commands, used both for storing them in redis and for sending them over the wire. Every
+# command starts with a fixed header, followed by its client id if it has one and then its data, packed according to
+# its type's layout below. A command whose data doesn't fit its type's layout (or whose type doesn't have one) is
+# packed as JSON instead, so anything that round-trips through to_json/from_json round-trips through this too.
+COMMAND_CODEC_VERSION = 1
+# codec version, flags, command type, command id, time in microseconds since the epoch
+_COMMAND_HEADER = struct.Struct('!BBBIq')
+_COMMAND_FLAG_HAS_CLIENT_ID = 1
+_COMMAND_FLAG_HAS_DATA = 2
+_COMMAND_FLAG_JSON = 4
+_INT = struct.Struct('!i')
+_NO_STRING = 0xFF
+# Only ever append to CommandType, since its order gives the type codes
+_COMMAND_TYPES = list(CommandType)
+_COMMAND_TYPE_CODES = {command_type: code for code, command_type in enumerate(_COMMAND_TYPES)}
+# Each field is an int, a str, an optional_str or an int_list
+_COMMAND_DATA_LAYOUTS: dict[CommandType, list[tuple[str, str]]] = {
+    CommandType.MOVE: [('x', 'int'), ('y', 'int')],
+    CommandType.SPAWN: [('x', 'int'), ('y', 'int'), ('team', 'str')],
+    CommandType.SPAWN_PROJECTILE: [('id', 'int'), ('source_x', 'int'), ('source_y', 'int'), ('dest_x', 'int'), ('dest_y', 'int'),
+                                   ('type', 'str'), ('player_id', 'int'), ('friends', 'int_list')],
+    CommandType.TURN: [('dir', 'optional_str')],
+    CommandType.EAT_ARROW: [('arrow_start_x', 'int'), ('arrow_start_y', 'int'), ('arrow_end_x', 'int'), ('arrow_end_y', 'int'),
+                            ('player_id', 'int')],
+    CommandType.REMOVE_PROJECTILE: [('projectile_id', 'int')],
+    CommandType.DIE: [('killer_id', 'int'), ('verb', 'str')],
+    CommandType.LOSE_HP: [('killer_id', 'int'), ('verb', 'str'), ('hp', 'int')],
+    CommandType.TELEPORT: [('x', 'int'), ('y', 'int')],
+    CommandType.SET_SPEED: [('speed', 'int')],
+}
+
+
+def _check_int(value: Any) -> int:
+    # bools are ints too, but they wouldn't come back out as bools
+    if type(value) is not int:
+        raise ValueError(f'{value!r} is not an int')
+    return value
+
+
+def _pack_string(value: Any) -> bytes:
+    if not isinstance(value, str):
+        raise ValueError(f'{value!r} is not a str')
+    raw_value = bytes(value, 'utf-8')
+    if len(raw_value) >= _NO_STRING:
+        raise ValueError(f'{value!r} is too long')
+    return bytes([len(raw_value)]) + raw_value
+
+
+def _pack_field(kind: str, value: Any) -> bytes:
+    if kind == 'int':
+        return _INT.pack(_check_int(value))
+    elif kind == 'str':
+        return _pack_string(value)
+    elif kind == 'optional_str':
+        return bytes([_NO_STRING]) if value is None else _pack_string(value)
+    else:
+        if not isinstance(value, list) or len(value) > 255:
+            raise ValueError(f'{value!r} is not a short list')
+        return bytes([len(value)]) + b''.join(_INT.pack(_check_int(item)) for item in value)
+
+
+def _unpack_field(kind: str, packed: bytes, offset: int) -> tuple[Any, int]:
+    if kind == 'int':
+        return _INT.unpack_from(packed, offset)[0], offset + _INT.size
+    length = packed[offset]
+    offset += 1
+    if kind == 'int_list':
+        end = offset + length * _INT.size
+        return list(struct.unpack_from(f'!{length}i', packed, offset)), end
+    if length == _NO_STRING and kind == 'optional_str':
+        return None, offset
+    return packed[offset:offset + length].decode(), offset + length
+
+
+def _to_microseconds(time: datetime) -> int:
+    return round(datetime.timestamp(time) * 1_000_000)
+
+
+def _pack_command_compactly(command: Command) -> bytes:
+    layout = _COMMAND_DATA_LAYOUTS.get(command.type)
+    flags = 0
+    packed_client_id = b''
+    packed_data: list[bytes] = []
+    if command.client_id is not None:
+        flags |= _COMMAND_FLAG_HAS_CLIENT_ID
+        packed_client_id = _INT.pack(_check_int(command.client_id))
+    if command.data is not None:
+        if layout is None or set(command.data.keys()) != {key for key, _ in layout}:
+            raise ValueError(f'{command.data} does not fit the layout for {command.type}')
+        flags |= _COMMAND_FLAG_HAS_DATA
+        packed_data = [_pack_field(kind, command.data[key]) for key, kind in layout]
+    header = _COMMAND_HEADER.pack(COMMAND_CODEC_VERSION, flags, _COMMAND_TYPE_CODES[command.type],
+                                  _check_int(command.id), _to_microseconds(command.time))
+    return header + packed_client_id + b''.join(packed_data)
+
+
+def pack_command(command: Command) -> bytes:
+    try:
+        return _pack_command_compactly(command)
+    except (ValueError, struct.error):
+        return bytes([COMMAND_CODEC_VERSION, _COMMAND_FLAG_JSON]) + bytes(json.dumps(command.to_json()), 'utf-8')
+
+
+def unpack_command(packed: bytes) -> Command:
+    # Commands stored before there was a compact encoding are plain JSON
+    if packed[:1] == b'{':
+        return Command.from_json(json.loads(packed))
+    if packed[1] & _COMMAND_FLAG_JSON:
+        return Command.from_json(json.loads(packed[2:]))
+    _, flags, type_code, command_id, time_in_microseconds = _COMMAND_HEADER.unpack_from(packed)
+    command_type = _COMMAND_TYPES[type_code]
+    offset = _COMMAND_HEADER.size
+    client_id: Optional[int] = None
+    data: Optional[dict] = None
+    if flags & _COMMAND_FLAG_HAS_CLIENT_ID:
+        client_id = _INT.unpack_from(packed, offset)[0]
+        offset += _INT.size
+    if flags & _COMMAND_FLAG_HAS_DATA:
+        data = {}
+        for key, kind in _COMMAND_DATA_LAYOUTS[command_type]:
+            data[key], offset = _unpack_field(kind, packed, offset)
+    return Command(id=command_id, type=command_type, time=datetime.fromtimestamp(time_in_microseconds / 1_000_000),
+                   **remove_nones({'data': data, 'client_id': client_id}))
+
+
+# The text form of a packed command, for anywhere a command has to go inside a string: packet payloads and digests.
+# base64 never produces a '{', so plain JSON commands from before the compact encoding can still be told apart.
+def encode_command(command: Command) -> str:
+    return base64.b64encode(pack_command(command)).decode()
+
+
+def decode_command(raw_command: str) -> Command:
+    if raw_command.startswith('{'):
+        return Command.from_json(json.loads(raw_command))
+    return unpack_command(base64.b64decode(raw_command))
+
+
+def encode_commands(commands: list[Command]) -> str:
+    return ','.join(encode_command(command) for command in commands)
+
+
+def decode_commands(raw_commands: str) -> list[Command]:
+    if raw_commands.startswith('['):
+        return [Command.from_json(raw_command) for raw_command in json.loads(raw_commands)]
+    return [decode_command(raw_command) for raw_command in raw_commands.split(',') if raw_command]
+
+
+COMMAND_LOG_MAX_AGE = timedelta(seconds=30)
+
+
+# The server keeps a decoded copy of each redis log around, so that reading it only has to decode the entries that
+# weren't there last time
+_server_command_logs: dict[tuple[str, str], tuple[CommandLog, dict[int, set[bytes]]]] = {}
+# The games whose logs are kept: the ones that have started and haven't ended yet. Anything still running for a game
+# once it's ended (an AI player's last frame, say) reads its logs without keeping them, so that they can't come back
+# after they've been forgotten, and this only ever holds the games in progress.
+_kept_game_names: set[str] = set()
+_server_command_logs_lock = Lock()
+
+
+def _merge_server_command_log(log_name: str, raw_commands_by_entity: dict[int, list[bytes]], *, game_name: str) -> CommandLog:
+    with _server_command_logs_lock:
+        command_log_and_known_raw_commands: tuple[CommandLog, dict[int, set[bytes]]] = (CommandLog(), {})
+        if game_name in _kept_game_names:
+            command_log_and_known_raw_commands = _server_command_logs.setdefault((log_name, game_name), command_log_and_known_raw_commands)
+        command_log, known_raw_commands_by_entity = command_log_and_known_raw_commands
+        for entity_id, raw_commands in raw_commands_by_entity.items():
+            known_raw_commands = known_raw_commands_by_entity.get(entity_id) or set()
+            for raw_command in raw_commands:
+                if raw_command not in known_raw_commands:
+                    command_log.add(entity_id, unpack_command(raw_command), raw_command)
+            known_raw_commands_by_entity[entity_id] = set(raw_commands)
+        for entity_id in list(known_raw_commands_by_entity.keys()):
+            if entity_id not in raw_commands_by_entity:
+                del known_raw_commands_by_entity[entity_id]
+        command_log.trim(datetime.now() - COMMAND_LOG_MAX_AGE)
+    return command_log
+
+
+# Called once a game has started, to keep its logs from then on
+def keep_server_command_logs(game_name: str) -> None:
+    with _server_command_logs_lock:
+        _kept_game_names.add(game_name)
+
+
+# Called once a game has ended, to stop keeping its logs
+def forget_server_command_logs(game_name: str) -> None:
+    with _server_command_logs_lock:
+        _kept_game_names.discard(game_name)
+        for log_name in ['commands_by_player', 'commands_by_projectile']:
+            _server_command_logs.pop((log_name, game_name), None)
+
+
+def _read_server_command_log(log_name: str, *, game_name: str) -> CommandLog:
+    return _merge_server_command_log(log_name, rlog_read(log_name, game_name=game_name), game_name=game_name)
+
+
+async def _aread_server_command_log(log_name: str, *, game_name: str) -> CommandLog:
+    return _merge_server_command_log(log_name, await arlog_read(log_name, game_name=game_name), game_name=game_name)
+
+
+def get_commands_by_player(*, client_id: Optional[int] = None, game_name: Optional[str] = None) -> CommandLog:
     if client_id is not None:
         return commands_by_player
     else:
-        return {int(key): val for key, val in json.loads(rget('commands_by_player', client_id=None, game_name=game_name) or '{}').items()}
+        assert game_name is not None
+        return _read_server_command_log('commands_by_player', game_name=game_name)
 
 
-def get_commands_by_projectile(*, client_id: Optional[int] = None, game_name: Optional[str] = None) -> dict[int, list[str]]:
+def get_commands_by_projectile(*, client_id: Optional[int] = None, game_name: Optional[str] = None) -> CommandLog:
     if client_id is not None:
         return commands_by_projectile
     else:
-        return {int(key): val for key, val in json.loads(rget('commands_by_projectile', client_id=None, game_name=game_name) or '{}').items()}    
+        assert game_name is not None
+        return _read_server_command_log('commands_by_projectile', game_name=game_name)
+
+
+async def aget_commands_by_player(*, game_name: str) -> CommandLog:
+    return await _aread_server_command_log('commands_by_player', game_name=game_name)
+
+
+async def aget_commands_by_projectile(*, game_name: str) -> CommandLog:
+    return await _aread_server_command_log('commands_by_projectile', game_name=game_name)
+
+
+def _get_server_log_entries(commands: list[Command]) -> dict[bytes, float]:
+    return {pack_command(command): datetime.timestamp(command.time) for command in commands}
+
+
+def _get_server_log_trim_before() -> float:
+    return datetime.timestamp(datetime.now() - COMMAND_LOG_MAX_AGE)
+
+
+def _server_append_commands(commands: list[Command], *, log_name: str, entity_id: int, game_name: str) -> None:
+    rlog_append(log_name, entity_id, _get_server_log_entries(commands), trim_before=_get_server_log_trim_before(), game_name=game_name)
+
+
+async def _aserver_append_commands(commands: list[Command], *, log_name: str, entity_id: int, game_name: str) -> None:
+    await arlog_append(log_name, entity_id, _get_server_log_entries(commands), trim_before=_get_server_log_trim_before(), game_name=game_name)
+
+
+# Returns None if the server shouldn't store the command
+def _get_server_log_name_and_entity_id(command: Command) -> Optional[tuple[str, int]]:
+    if command.time < datetime.now() - timedelta(seconds=2):
+        return None
+    is_projectile_command = (command.type in PROJECTILE_COMMAND_TYPES)
+    entity_id = command.data['projectile_id'] if is_projectile_command else command.client_id  # type: ignore
+    assert entity_id is not None
+    return 'commands_by_projectile' if is_projectile_command else 'commands_by_player', entity_id
 
 
 def store_command(command: Command, *, for_client: int, 
                   client_id: Optional[int] = None,
                   game_name: Optional[str] = None) -> None:
-    command_str = json.dumps(command.to_json())
     is_projectile_command = (command.type in PROJECTILE_COMMAND_TYPES)
-    global commands_by_player
     if client_id is not None:
         if is_projectile_command:
             assert command.data
-            commands_by_projectile[command.data['projectile_id']].append(command_str)
+            commands_by_projectile.add(command.data['projectile_id'], command)
         else:
-            commands_by_player[for_client].append(command_str)
+            commands_by_player.add(for_client, command)
     else:
-        if command.time < datetime.now() - timedelta(seconds=2):
-            return
-        commands = get_commands_by_projectile(client_id=None, game_name=game_name) if is_projectile_command else get_commands_by_player(client_id=None, game_name=game_name)
-        command_id = command.data['projectile_id'] if is_projectile_command else command.client_id  # type: ignore
-        with redis_lock(f'add_command_for_player_redis_key_{command_id}', client_id=None, game_name=game_name):
-            assert command_id is not None
-            if command_id in commands:
-                l = commands[command_id]
-                commands[command_id] = [c for c in l if datetime.fromtimestamp(json.loads(c)['time']) > datetime.now() - timedelta(seconds=30)]
-                commands[command_id].append(command_str)
-            else:
-                commands[command_id] = [command_str]
-            rset('commands_by_projectile' if is_projectile_command else 'commands_by_player', json.dumps(commands), client_id=None, game_name=game_name)
-
-
-def server_store_player_commands(command_strs: list[str], for_client_id: int, game_name: str) -> None:
-    commands_by_player = get_commands_by_player(client_id=None, game_name=game_name)
-    command_strs_for_player = commands_by_player.get(for_client_id) or []
-    with redis_lock(f'add_command_for_player_redis_key_{for_client_id}', client_id=None, game_name=game_name):
-        commands_for_player = [json.loads(c) for c in command_strs_for_player]
-        command_strs_for_player = [cs for cs, c in zip(command_strs_for_player, commands_for_player) if datetime.fromtimestamp(c['time']) > datetime.now() - timedelta(seconds=30)]
-        existing_cids = [c['id'] for c in commands_for_player]
-        command_strs_for_player.extend([c for c in command_strs if json.loads(c)['id'] not in existing_cids])
-        commands_by_player[for_client_id] = command_strs_for_player
-        rset('commands_by_player', json.dumps(commands_by_player), client_id=None, game_name=game_name)
-    
\ No newline at end of file
+        assert game_name is not None
+        if (log_name_and_entity_id := _get_server_log_name_and_entity_id(command)) is not None:
+            log_name, entity_id = log_name_and_entity_id
+            _server_append_commands([command], log_name=log_name, entity_id=entity_id, game_name=game_name)
+
+
+# Can only be called from the server
+async def astore_command(command: Command, *, game_name: str) -> None:
+    if (log_name_and_entity_id := _get_server_log_name_and_entity_id(command)) is not None:
+        log_name, entity_id = log_name_and_entity_id
+        await _aserver_append_commands([command], log_name=log_name, entity_id=entity_id, game_name=game_name)
+
+
+# Commands that are already in the player's log are stored under the same sorted set member, so re-sent commands
+# are deduplicated by redis
+def server_store_player_commands(commands: list[Command], for_client_id: int, game_name: str) -> None:
+    _server_append_commands(commands, log_name='commands_by_player', entity_id=for_client_id, game_name=game_name)
+
+
+async def aserver_store_player_commands(commands: list[Command], for_client_id: int, game_name: str) -> None:
+    await _aserver_append_commands(commands, log_name='commands_by_player', entity_id=for_client_id, game_name=game_name)
+
+
+# Queues each player's commands to be appended to their log when the batch is flushed, so that storing commands for
+# any number of players takes one round trip
+def batch_server_store_player_commands(batch: RedisBatch, commands_by_player: Mapping[int, list[Command]], *,
+                                       game_name: str) -> None:
+    trim_before = _get_server_log_trim_before()
+    for client_id, commands in commands_by_player.items():
+        batch.rlog_append('commands_by_player', client_id, _get_server_log_entries(commands), trim_before=trim_before,
+                          game_name=game_name)
@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+import json
+from typing import Any, Callable, Mapping, Optional
+
+from command import Command, CommandLog, encode_command
+from packet import PacketFormat
+
+
+DIGEST_KEYFRAME_INTERVAL = timedelta(seconds=5)
+DIGEST_HISTORY_LENGTH = 100
+
+
+def commands_to_json(commands: list[tuple[int, Command]]) -> dict[int, list[str]]:
+    commands_by_entity: dict[int, list[str]] = {}
+    for entity_id, command in commands:
+        commands_by_entity.setdefault(entity_id, []).append(encode_command(command))
+    return commands_by_entity
+
+
+# Entity fields are JSON objects holding collections of entities by id. A digest only carries the entities that have
+# changed since its base version, along with the ids of all of them so that the client can drop the ones that are gone.
+def diff_entity_field(base_value: str, value: str, collections: list[str]) -> str:
+    base = json.loads(base_value) if base_value else {}
+    current = json.loads(value)
+    diff = {key: field_value for key, field_value in current.items() if key not in collections}
+    for collection in collections:
+        base_entities = base.get(collection) or {}
+        entities = current.get(collection) or {}
+        diff[collection] = {'changed': {entity_id: entity for entity_id, entity in entities.items() if base_entities.get(entity_id) != entity},
+                            'ids': list(entities)}
+    return json.dumps(diff)
+
+
+def apply_entity_field_diff(value: dict, diff: dict, collections: list[str]) -> dict:
+    new_value = {key: field_value for key, field_value in diff.items() if key not in collections}
+    for collection in collections:
+        entities = value.get(collection) or {}
+        changed = diff[collection]['changed']
+        new_value[collection] = {entity_id: changed[entity_id] if entity_id in changed else entities[entity_id]
+                                 for entity_id in diff[collection]['ids'] if entity_id in changed or entity_id in entities}
+    return new_value
+
+
+class DigestTracker:
+    """
+    Keeps track of the most recent digest version one connection has acknowledged receiving. Every digest carries
+    everything that's changed since the version it was built against, so having applied that version means the client
+    is up to date as of it, and lost or skipped digests cost nothing but a slightly bigger next one.
+    """
+
+    def __init__(self) -> None:
+        self.acked_version: Optional[int] = None
+        self.last_keyframe_at: Optional[datetime] = None
+
+    def ack(self, version: int) -> None:
+        if self.acked_version is None or version > self.acked_version:
+            self.acked_version = version
+
+    def needs_keyframe(self) -> bool:
+        return self.last_keyframe_at is None or self.last_keyframe_at < datetime.now() - DIGEST_KEYFRAME_INTERVAL
+
+
+class DigestBuilder:
+    """
+    Builds the all_info_digest for every connection to one game. Each tick gets a new version, and we remember the
+    command log cursors and field values as of each recent version, so that every connection that has acked the same
+    version can be sent the exact same digest: the commands past that version's cursors, and the fields whose values
+    have changed since. A connection whose acked version we've forgotten, or that's due for a keyframe (every
+    DIGEST_KEYFRAME_INTERVAL, in case the client has lost track of something), gets everything.
+
+    The client has usually applied newer digests than the one it last acked by the time a digest arrives, and a field
+    that has changed and then changed back since the base version isn't in the digest at all, so every digest says
+    which version it's based on, and the client applies it to its copy of that version rather than to its latest.
+
+    encode turns a digest into whatever will be written to connections using the given packet format, and is only
+    called once per distinct digest and packet format per tick. entity_fields maps the fields that hold entities to
+    the names of their collections, and those fields are sent as diffs (see diff_entity_field).
+    """
+
+    def __init__(self, encode: Callable[[dict[str, Any], PacketFormat], bytes], *, 
+                 entity_fields: Optional[Mapping[str, list[str]]] = None) -> None:
+        self._encode = encode
+        self._entity_fields = entity_fields or {}
+        self._next_version = 1
+        self._history: dict[int, tuple[dict[str, int], dict[str, str]]] = {}
+
+    def start_tick(self, command_logs: dict[str, CommandLog], fields: dict[str, str]) -> 'DigestTick':
+        version = self._next_version
+        self._next_version += 1
+        # Every digest built this tick includes at least everything up to these cursors
+        cursors = {log_name: command_log.cursor() for log_name, command_log in command_logs.items()}
+        self._history[version] = (cursors, fields)
+        if len(self._history) > DIGEST_HISTORY_LENGTH:
+            del self._history[min(self._history.keys())]
+        return DigestTick(version, command_logs, fields, self._history, self._encode, self._entity_fields)
+
+
+class DigestTick:
+    def __init__(self, version: int, command_logs: dict[str, CommandLog], fields: dict[str, str],
+                 history: dict[int, tuple[dict[str, int], dict[str, str]]],
+                 encode: Callable[[dict[str, Any], PacketFormat], bytes], entity_fields: Mapping[str, list[str]]) -> None:
+        self.version = version
+        self._command_logs = command_logs
+        self._fields = fields
+        self._history = history
+        self._encode = encode
+        self._entity_fields = entity_fields
+        self._digests_by_base_version: dict[Optional[int], dict[str, Any]] = {}
+        self._encoded_digests: dict[tuple[Optional[int], PacketFormat], bytes] = {}
+
+    def encoded_digest_for(self, digest_tracker: DigestTracker, packet_format: PacketFormat) -> bytes:
+        base_version = digest_tracker.acked_version
+        if digest_tracker.needs_keyframe() or base_version not in self._history:
+            base_version = None
+            digest_tracker.last_keyframe_at = datetime.now()
+        if base_version not in self._digests_by_base_version:
+            self._digests_by_base_version[base_version] = self._build(base_version)
+        if (base_version, packet_format) not in self._encoded_digests:
+            self._encoded_digests[(base_version, packet_format)] = self._encode(self._digests_by_base_version[base_version], packet_format)
+        return self._encoded_digests[(base_version, packet_format)]
+
+    def num_distinct_digests(self) -> int:
+        return len(self._digests_by_base_version)
+
+    def _build(self, base_version: Optional[int]) -> dict[str, Any]:
+        keyframe = base_version is None
+        base_cursors, base_fields = self._history[base_version] if base_version is not None else ({}, {})
+        digest: dict[str, Any] = {'version': self.version, 'base_version': base_version, 'keyframe': keyframe}
+        for log_name, command_log in self._command_logs.items():
+            commands_since_base = None if keyframe else command_log.read_since(base_cursors.get(log_name, 0))
+            commands, _ = commands_since_base if commands_since_base is not None else command_log.read_all()
+            digest[log_name] = commands_to_json(commands)
+        for key, value in self._fields.items():
+            if not keyframe and base_fields.get(key) == value:
+                continue
+            if key in self._entity_fields and value:
+                digest[key] = diff_entity_field(base_fields.get(key) or '', value, self._entity_fields[key])
+            else:
+                digest[key] = value
+        return digest
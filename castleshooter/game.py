@@ -13,16 +13,16 @@ from flashlight_utils import FLASHLIGHT_COLOR, get_unit_vector_from_player_to_mo
 from weapon import Weapon, weapon_to_pygame_image, DAGGER_RANGE
 from death_reason import DeathReason, death_reason_to_verb
 from command import get_commands_by_projectile
-from packet import send_eat_arrow_command, send_remove_projectile_command, send_die_command, send_spawn_command, send_with_retry
-from projectile import projectile_intersects_player, draw_arrow, ARROW_COLOR
+from packet import send_die_command, send_spawn_command, send_with_retry
+from projectile import draw_arrow, ARROW_COLOR
 from projectile import generate_projectile_id, Projectile, ProjectileType
 from direction import determine_direction_from_keyboard, to_optional_direction
-from command import Command, CommandType, get_commands_by_player
+from command import Command, CommandLog, CommandType, get_commands_by_player
 
-from redis_utils import redis_lock, rget, rset
+from redis_utils import redis_lock, rget, rring_at_or_before, rring_push, rset
 from player import Player, BASE_MAX_HP
-from canvas import Canvas
-from client_utils import Client, get_player_number_from_client_id, get_client_id_from_player_number, get_client
+from canvas import Canvas, StaticLayer, Viewport
+from client_utils import Client, client_state, get_player_number_from_client_id, get_client_id_from_player_number, get_client
 from direction import direction_to_unit_vector
 
 from packet import (
@@ -32,7 +32,7 @@ from packet import (
 from json.decoder import JSONDecodeError
 
 from utils import (
-    MAX_GAME_STATE_SNAPSHOTS, LOG_CUTOFF, draw_text_centered_on_rectangle, GAME_HEIGHT, GAME_WIDTH, 
+    MAX_GAME_STATE_SNAPSHOTS, MAX_SERVER_GAME_STATE_SNAPSHOTS, LOG_CUTOFF, draw_text_centered_on_rectangle, GAME_HEIGHT, GAME_WIDTH, 
     clamp, clamp_to_game_x, clamp_to_game_y, MAX_SCORE, draw_text_list, logs, generate_random_unit_vector
 )
 from item import Item, ItemCategory, ItemType, generate_next_item_id
@@ -40,13 +40,36 @@ from time import sleep
 import time
 from team import Team, team_to_color, rotate_team, flip_team, get_true_teams
 from garb import Garb, garb_to_pygame_image, garb_max_age
+from asset_cache import asset_cache
+from profiler import profiled, profiler
+from settings import PROFILE_TRACE_PATH
 from score import score
 from enum import Enum
 from ai_personality import AiPersonality
+from snapshot_ring import SnapshotRing
+from state_buffer import StateBuffer
+from spatial_grid import SpatialGrid
+from integrator import MIN_BATCH_SIZE, PlayerArrays, ProjectileArrays, can_move_in_batch
 
 
 ITEM_GENERATION_RATE = 2.0
 
+# The simulation (server updates, working out where everything is, input and the AI) runs in steps this long, however
+# long frames take to draw, and frames are drawn partway between the last two steps
+SIMULATION_STEP = timedelta(seconds=1 / 60)
+FRAME_RATE = 60
+# If drawing falls further behind than this many steps, the rest are skipped rather than all run at once
+MAX_SIMULATION_STEPS_PER_FRAME = 5
+
+AUTHORITATIVE_STATE_BUFFER_SIZE = 32
+# Other players and their arrows are drawn this far in the past, so that there's almost always an authoritative state
+# on either side of the moment being drawn to interpolate between
+RENDER_DELAY = timedelta(milliseconds=250)
+# When a new authoritative state puts our own player somewhere other than where we'd predicted, they're eased over to
+# where they should be over this long, unless it's further than RECONCILIATION_SNAP_DISTANCE, when they just jump there
+RECONCILIATION_SMOOTHING = timedelta(milliseconds=100)
+RECONCILIATION_SNAP_DISTANCE = 100
+
 SHIFT_KEYS = [pygame.K_RSHIFT, pygame.K_LSHIFT]
 NUMBER_KEYS = {1: pygame.K_1, 
                2: pygame.K_2, 
@@ -58,16 +81,6 @@ NUMBER_KEYS = {1: pygame.K_1,
                8: pygame.K_8}
 
 
-def run_spontaneous_game_processes(game: 'Game') -> None:
-    # This doesn't run for AI players for now
-    client = get_client()
-    while True:
-        if time.time() % 0.1 < 0.01 and time.time() % 0.01 >= 0.0 and client.game_started:
-            if random.random() < ITEM_GENERATION_RATE * 0.1 and len(game.items) < 20:
-                generate_item(client, game)
-        sleep(0.01)
-
-
 def generate_item(client: Client, game: 'Game') -> None:
     next_item_id = generate_next_item_id(client_id=client.id)
     random_number_1 = random.random()
@@ -120,12 +133,151 @@ class GameState:
                          time=datetime.fromtimestamp(d['time']))
 
 
-def handle_commands_for_ai(game: Optional['Game'], commands_by_player: dict[int, list[str]]) -> None:
+class AuthoritativeState:
+    """
+    The server simulation's view of the world as of time: every entity as of the last command that was run for it
+    (its anchor), along with that command's time. Entities only change here when a command is run for them, so the
+    digest only has to carry the ones that did, and anyone can work out where everything is at a later time by moving
+    each anchor forward, without replaying any commands.
+    """
+
+    def __init__(self, time: datetime, player_anchors: dict[int, tuple[Player, datetime]],
+                 projectile_anchors: dict[int, tuple[Projectile, datetime]]) -> None:
+        self.time = time
+        self.player_anchors = player_anchors
+        self.projectile_anchors = projectile_anchors
+
+    def to_json(self) -> dict:
+        return {
+            'time': datetime.timestamp(self.time),
+            'players': {str(client_id): {'player': player.to_json(), 'anchor_time': datetime.timestamp(anchor_time)}
+                        for client_id, (player, anchor_time) in self.player_anchors.items()},
+            'projectiles': {str(projectile_id): {'projectile': projectile.to_json(), 'anchor_time': datetime.timestamp(anchor_time)}
+                            for projectile_id, (projectile, anchor_time) in self.projectile_anchors.items()},
+        }
+
+    @classmethod
+    def from_json(cls, d: dict) -> 'AuthoritativeState':
+        return AuthoritativeState(
+            time=datetime.fromtimestamp(d['time']),
+            player_anchors={int(client_id): (Player.from_json(p['player']), datetime.fromtimestamp(p['anchor_time']))
+                            for client_id, p in d['players'].items()},
+            projectile_anchors={int(projectile_id): (Projectile.from_json(p['projectile']), datetime.fromtimestamp(p['anchor_time']))
+                                for projectile_id, p in d['projectiles'].items()},
+        )
+
+    # If owned_by is passed, only that player and their projectiles are included
+    def game_state_at(self, end_time: datetime, *, owned_by: Optional[int] = None) -> GameState:
+        players: list[Player] = []
+        for client_id, (player, anchor_time) in self.player_anchors.items():
+            if owned_by is None or client_id == owned_by:
+                player = player.copy()
+                _move_player(player, prev_time=anchor_time, next_time=end_time)
+                players.append(player)
+        projectiles: list[Projectile] = []
+        for projectile, anchor_time in self.projectile_anchors.values():
+            if owned_by is not None and projectile.player_id != owned_by:
+                continue
+            if (moved_projectile := _move_projectile(projectile.copy(), prev_time=anchor_time, next_time=end_time)) is not None:
+                projectiles.append(moved_projectile)
+        return GameState(players=players, projectiles=projectiles, time=end_time)
+
+
+class StateInterpolator:
+    """
+    Works out where everything was at a moment between two authoritative states, by moving each entity to where it
+    was at both states' times and interpolating between the two. Those positions only change when the two states do,
+    so they're kept between frames. Anything that's gone by the later state is just moved forward from the earlier
+    one, and anything that's new in it isn't drawn until the moment being drawn catches up with it.
+    """
+
+    def __init__(self) -> None:
+        self._states: Optional[tuple[AuthoritativeState, AuthoritativeState]] = None
+        self._start_state = GameState([], [])
+        self._end_players: dict[int, Player] = {}
+        self._end_projectiles: dict[int, Projectile] = {}
+
+    def game_state_at(self, render_time: datetime, before: Optional[AuthoritativeState], 
+                      after: Optional[AuthoritativeState]) -> GameState:
+        if before is None:
+            assert after is not None
+            return after.game_state_at(after.time)
+        if after is None:
+            return before.game_state_at(render_time)
+        if self._states is None or self._states[0] is not before or self._states[1] is not after:
+            self._states = (before, after)
+            self._start_state = before.game_state_at(before.time)
+            end_state = after.game_state_at(after.time)
+            self._end_players = {player.client_id: player for player in end_state.players}
+            self._end_projectiles = {projectile.id: projectile for projectile in end_state.projectiles}
+        fraction = (render_time - before.time) / (after.time - before.time)
+
+        players: list[Player] = []
+        for start_player in self._start_state.players:
+            if (end_player := self._end_players.get(start_player.client_id)) is not None:
+                player = start_player.copy()
+                player.x = int(start_player.x + (end_player.x - start_player.x) * fraction)
+                player.y = int(start_player.y + (end_player.y - start_player.y) * fraction)
+            else:
+                anchor_player, anchor_time = before.player_anchors[start_player.client_id]
+                player = anchor_player.copy()
+                _move_player(player, prev_time=anchor_time, next_time=render_time)
+            players.append(player)
+
+        projectiles: list[Projectile] = []
+        for start_projectile in self._start_state.projectiles:
+            projectile: Optional[Projectile]
+            if (end_projectile := self._end_projectiles.get(start_projectile.id)) is not None:
+                # Copying a projectile puts it back where it started, so the position always has to be set
+                projectile = start_projectile.copy()
+                projectile.x = int(start_projectile.x + (end_projectile.x - start_projectile.x) * fraction)
+                projectile.y = int(start_projectile.y + (end_projectile.y - start_projectile.y) * fraction)
+            else:
+                anchor_projectile, anchor_time = before.projectile_anchors[start_projectile.id]
+                projectile = _move_projectile(anchor_projectile.copy(), prev_time=anchor_time, next_time=render_time)
+            if projectile is not None:
+                projectiles.append(projectile)
+
+        return GameState(players=players, projectiles=projectiles, time=render_time)
+
+
+# Where everything was fraction of the way from one simulation step to the next. Anything that's only in one of the
+# steps, or that jumped further than RECONCILIATION_SNAP_DISTANCE between them (a teleport, say), is just drawn where
+# the later step has it.
+def lerp_game_states(start: GameState, end: GameState, fraction: float) -> GameState:
+    start_players = {player.client_id: player for player in start.players}
+    start_projectiles = {projectile.id: projectile for projectile in start.projectiles}
+
+    players: list[Player] = []
+    for end_player in end.players:
+        start_player = start_players.get(end_player.client_id)
+        if (start_player is not None 
+                and sqrt((end_player.x - start_player.x)**2 + (end_player.y - start_player.y)**2) < RECONCILIATION_SNAP_DISTANCE):
+            player = end_player.copy()
+            player.x = int(start_player.x + (end_player.x - start_player.x) * fraction)
+            player.y = int(start_player.y + (end_player.y - start_player.y) * fraction)
+            players.append(player)
+        else:
+            players.append(end_player)
+
+    projectiles: list[Projectile] = []
+    for end_projectile in end.projectiles:
+        if (start_projectile := start_projectiles.get(end_projectile.id)) is not None:
+            # Copying a projectile puts it back where it started, so the position always has to be set
+            projectile = end_projectile.copy()
+            projectile.x = int(start_projectile.x + (end_projectile.x - start_projectile.x) * fraction)
+            projectile.y = int(start_projectile.y + (end_projectile.y - start_projectile.y) * fraction)
+            projectiles.append(projectile)
+        else:
+            projectiles.append(end_projectile)
+
+    return GameState(players=players, projectiles=projectiles, time=start.time + (end.time - start.time) * fraction)
+
+
+def handle_commands_for_ai(game: Optional['Game'], commands_by_player: CommandLog) -> None:
     if game is not None:
         client = get_client(ai_client_id=game.client.id, ai_team=game.client.team, game_name=game.client.game_name)
-        commands_by_player = get_commands_by_player(client_id=None, game_name=game.client.game_name)
-        for client_id, raw_commands_for_player in commands_by_player.items():
-            commands_for_player = [Command.from_json(json.loads(c)) for c in raw_commands_for_player]
+        for client_id, commands_for_player in commands_by_player.items():
             if client_id == client.id:
                 handle_hp_loss_for_commands(game, commands_for_player,
                                             ai_client_id=game.client.id, ai_team=game.client.team, game_name=game.client.game_name)
@@ -184,6 +336,13 @@ class Game:
         self.players: dict[int, Player] = {}
         self.player: Optional[Player] = None
         self.canvas = Canvas(self.width, self.height, "Testing...") if ai_client_id is None else None
+        self.running = True
+        # The game as of the last two simulation steps, which frames are drawn between
+        self.simulation_time = datetime.now()
+        self.game_state = GameState([], [])
+        self.previous_game_state = self.game_state
+        self.hud_layer = StaticLayer(self.width, self.height) if ai_client_id is None else None
+        self.last_camera: Optional[tuple[int, int]] = None
         self.announcements: list[Announcement] = []
         self.commands_handled: list[Command] = []
         self.target: Optional[Player] = None
@@ -194,6 +353,13 @@ class Game:
         self.player_name_input = ''
         self.game_name_input = ''
         self.lobby_input_focus: Optional[LobbyInputFocus] = None
+        self.simulator = GameSimulator()
+        self.interpolator = StateInterpolator()
+        # The authoritative state our own player was last predicted from, and how far off that prediction turned out
+        # to be when a newer one arrived
+        self.predicted_from: Optional[AuthoritativeState] = None
+        self.prediction_error: tuple[float, float] = (0.0, 0.0)
+        self.prediction_error_at = datetime.now()
 
         self.ai_personality: Optional[AiPersonality] = ai_personality
         self.ai_last_changed_target_at = datetime.now()
@@ -206,74 +372,115 @@ class Game:
     def run(self):
         print('Running the game!')
         clock = pygame.time.Clock()
-        run = True
         if self.player_number < 0:
             print(f'Uh oh, my player number is {self.player_number}, which is messed up')
-        
-        while run:
+
+        self.simulation_time = datetime.now()
+        while self.running:
             if self.client.ai:
+                # AI players don't draw anything, so they just step whenever they wake up
                 sleep(0.1)
-            clock.tick(60)
-
-            if self.player_number < 0:
-                self.player_number = self.client.id if self.client.id is not None else -1
+                self.step(datetime.now())
                 continue
+            clock.tick(FRAME_RATE)
+
+            now = datetime.now()
+            steps = 0
+            while self.running and now - self.simulation_time >= SIMULATION_STEP:
+                if steps == MAX_SIMULATION_STEPS_PER_FRAME:
+                    # Everything is worked out from the time rather than from the step before, so the steps we're too
+                    # far behind to run can just be skipped
+                    self.simulation_time = now - (now - self.simulation_time) % SIMULATION_STEP
+                    break
+                self.simulation_time += SIMULATION_STEP
+                self.step(self.simulation_time)
+                steps += 1
+
+            self.render((now - self.simulation_time) / SIMULATION_STEP)
+            profiler.end_frame()
+
+        # AI players share the server's process, and stop when their game ends
+        if not self.client.ai:
+            if profiler.enabled:
+                profiler.dump(PROFILE_TRACE_PATH)
+            pygame.quit()
+
+    # One step of the simulation, as of now: applies whatever the server has sent since the last step, works out where
+    # everything is, and handles input (or runs the AI) and everything else that can change the game
+    @profiled('step')
+    def step(self, now: datetime) -> None:
+        if self.player_number < 0:
+            self.player_number = self.client.id if self.client.id is not None else -1
+            return
 
-            # print(f'game started: {client.game_started}')
-
-            if self.client.game_name is not None and self.client.game_started:
-                game_state = infer_game_state(client_id=self.client.id if not self.client.ai else None, game_name=self.client.game_name if self.client.ai else None)
-                for player in game_state.players:
-                    if player.client_id == self.client.id:
-                        if self.player is not None:
-                            self.player.update_info_from_inferred_game_state(player)
-                        else:
-                            self.player = player
-            else:
-                game_state = GameState([], [])
-
-            client_player = self.player
-            canvas = None
-            if not self.client.ai:
-                assert self.canvas
-                self.canvas.draw_background()
-                canvas = self.canvas.get_canvas()
-            target = self.target
-            game_items = self.items.copy()
-            x_offset: Optional[int] = None
-            y_offset: Optional[int] = None
-
-            if self.client.game_name is not None and self.client.game_started:
-                if not self.player_numbers_to_putative_teams and self.client.team:
-                    # Initial team info: two independent 75% chance of being enemy
-                    true_teams = get_true_teams(client_id=None if self.client.ai else self.client.id, game_name=self.client.game_name, exclude_my_client_id=self.client.id)
-                    if random.random() < 1 / 16:
-                        enemies = random.sample(true_teams[self.client.team], 2)
-                    elif random.random() < 7 / 16:
-                        enemies = [*random.sample(true_teams[flip_team(self.client.team)], 1),
-                                   *random.sample(true_teams[self.client.team], 1)]
+        if not self.client.ai:
+            with profiler.section('server updates'):
+                client_state.apply_server_updates()
+
+        # print(f'game started: {client.game_started}')
+
+        if self.client.game_name is not None and self.client.game_started:
+            client_id = self.client.id if not self.client.ai else None
+            game_name = self.client.game_name if self.client.ai else None
+            with profiler.section('inference'):
+                if (game_state_from_server := self.game_state_from_authoritative_states(now, client_id=client_id, game_name=game_name)) is not None:
+                    game_state = game_state_from_server
+                else:
+                    game_state = self.simulator.infer_game_state(end_time=now, client_id=client_id, game_name=game_name)
+            for player in game_state.players:
+                if player.client_id == self.client.id:
+                    if self.player is not None:
+                        self.player.update_info_from_inferred_game_state(player)
                     else:
-                        enemies = random.sample(true_teams[flip_team(self.client.team)], 2)
-                    for enemy in enemies:
-                        self.player_numbers_to_putative_teams[enemy] = flip_team(self.client.team)
-
-                if client_player is not None:
-                    if self.client.ai:
-
-                        # Begin AI player instructions
+                        self.player = player
+        else:
+            game_state = GameState([], [], time=now)
+        self.previous_game_state = self.game_state
+        self.game_state = game_state
 
+        client_player = self.player
+        target = self.target
+        # Rebuilt every step, for everything below that looks for players or items near somewhere
+        player_grid = SpatialGrid(game_state.players)
+        item_grid = SpatialGrid(self.items.values())
+
+        if self.client.game_name is not None and self.client.game_started:
+            if not self.player_numbers_to_putative_teams and self.client.team:
+                # Initial team info: two independent 75% chance of being enemy
+                true_teams = get_true_teams(client_id=None if self.client.ai else self.client.id, game_name=self.client.game_name, exclude_my_client_id=self.client.id)
+                if random.random() < 1 / 16:
+                    enemies = random.sample(true_teams[self.client.team], 2)
+                elif random.random() < 7 / 16:
+                    enemies = [*random.sample(true_teams[flip_team(self.client.team)], 1),
+                               *random.sample(true_teams[self.client.team], 1)]
+                else:
+                    enemies = random.sample(true_teams[flip_team(self.client.team)], 2)
+                for enemy in enemies:
+                    self.player_numbers_to_putative_teams[enemy] = flip_team(self.client.team)
+
+            # This doesn't run for AI players for now
+            if not self.client.ai and random.random() < ITEM_GENERATION_RATE * SIMULATION_STEP.total_seconds() and len(self.items) < 20:
+                generate_item(self.client, self)
+
+            if client_player is not None:
+                if self.client.ai:
+
+                    # Begin AI player instructions
+
+                    with profiler.section('ai'):
                         assert self.ai_personality
                         for player in game_state.players:
                             if self.ai_target_id == player.client_id:
                                 self.target = player
                         if self.ai_last_changed_target_at < datetime.now() - timedelta(seconds=5):
-                            targets = [player for player in game_state.players if (
+                            best_distance = sqrt((self.target.x - client_player.x)**2 + (self.target.y - client_player.y)**2) if self.target is not None else 10000000
+                            # Nobody further away than our current target could replace it
+                            targets = [player for player in player_grid.query_radius(client_player.x, client_player.y, best_distance) if (
                                                     player.client_id != self.client.id 
                                                     and (player_team := self.player_numbers_to_putative_teams.get(get_player_number_from_client_id(player.client_id, client_id=None, game_name=self.client.game_name))) != self.client.team
                                                     and (self.ai_personality.aggressive or player_team is not None)
                                                 )]
                             random.shuffle(targets)
-                            best_distance = sqrt((self.target.x - client_player.x)**2 + (self.target.y - client_player.y)**2) if self.target is not None else 10000000
                             for target in targets:
                                 distance = sqrt((target.x - client_player.x)**2 + (target.y - client_player.y)**2)
                                 if distance < best_distance and random.random() < 0.75:
@@ -291,7 +498,7 @@ class Game:
                             else:
                                 client_player.weapon = None
                             self.ai_last_changed_weapons_at = datetime.now()
-                        
+                    
                         def _move_randomly(client_player: Player) -> None:
                             change_to_destination_unit_vector_x, change_to_destination_unit_vector_y = generate_random_unit_vector()
                             change_to_destination_distance = 10
@@ -299,7 +506,7 @@ class Game:
                                                         int(change_to_destination_distance * change_to_destination_unit_vector_y))
                             last_destination = self.ai_last_destination or (client_player.x, client_player.y)
                             new_destination = (change_to_destination[0] + last_destination[0], change_to_destination[1] + last_destination[1])
-                            
+                        
                             send_move_command(None, new_destination[0], new_destination[1], client_id=self.client.id, game_name=self.client.game_name)
                             self.ai_last_destination = new_destination
 
@@ -337,15 +544,16 @@ class Game:
 
                         handle_commands_for_ai(self, get_commands_by_player(client_id=None, game_name=self.client.game_name))
 
-                        # End AI player instructions
-                                
-                    else:
-                        x_offset = int(client_player.x - self.width / 2)
-                        y_offset = int(client_player.y - self.height / 2)                
+                    # End AI player instructions
+                            
+                else:
+                    x_offset = int(client_player.x - self.width / 2)
+                    y_offset = int(client_player.y - self.height / 2)                
+                    with profiler.section('input'):
                         for event in pygame.event.get():
                             pressed = pygame.key.get_pressed()
                             if event.type == pygame.QUIT:
-                                run = False
+                                self.running = False
 
                             if event.type == pygame.MOUSEBUTTONDOWN:
                                 assert self.client.id is not None
@@ -366,8 +574,10 @@ class Game:
                                         elif client_player.weapon == Weapon.FLASHLIGHT:
                                             mouse_x, mouse_y = pygame.mouse.get_pos()
                                             triangle = get_flashlight_triangle(client_player.x, client_player.y, mouse_x + x_offset, mouse_y + y_offset)
-                                            
-                                            for player in game_state.players:
+                                        
+                                            triangle_xs = [point[0] for point in triangle]
+                                            triangle_ys = [point[1] for point in triangle]
+                                            for player in player_grid.query_box(min(triangle_xs), min(triangle_ys), max(triangle_xs), max(triangle_ys)):
                                                 if point_in_triangle((player.x, player.y), triangle):
                                                     self.player_numbers_to_putative_teams[player.player_number] = player.team
 
@@ -388,7 +598,7 @@ class Game:
                                                 send_set_speed_command(self.s, 300, client_id=self.client.id)
                                             elif client_player.garb == Garb.ARMOR and old_garb != Garb.ARMOR:
                                                 client_player.hp += 1
-                                            
+                                        
                                             if old_garb == Garb.BOOTS and client_player.garb != Garb.BOOTS:
                                                 send_set_speed_command(self.s, 200, client_id=self.client.id)
                                             elif old_garb == Garb.ARMOR and client_player.garb != Garb.ARMOR:
@@ -414,216 +624,227 @@ class Game:
                                         self.player_numbers_to_putative_teams[number_pressed] = rotate_team(self.player_numbers_to_putative_teams.get(number_pressed), self.client.team)
 
                                 elif event.key == pygame.K_ESCAPE:
-                                    run = False
-
-                        self.target = None
-                        min_distance = DAGGER_RANGE
-                        if client_player.weapon == Weapon.DAGGER:
-                            for possible_target in game_state.players:
-                                if possible_target.client_id != client_player.client_id and self.player_numbers_to_putative_teams.get(possible_target.player_number) != self.client.team:
-                                    distance = sqrt((possible_target.x - client_player.x)**2 + (possible_target.y - client_player.y)**2)
-                                    if distance < min_distance:
-                                        self.target = possible_target
-                                        min_distance = distance 
-
-                        self.item_target = None
-                        min_distance = DAGGER_RANGE                    
-                        for possible_item_target in game_items.values():
-                            distance = sqrt((possible_item_target.x - client_player.x)**2 + (possible_item_target.y - client_player.y)**2)
-                            if distance < min_distance:
-                                self.item_target = possible_item_target
-                                min_distance = distance 
-
-                    for projectile in game_state.projectiles:
-                        if projectile_intersects_player(projectile, client_player) and not self.client.id in projectile.friends:
-                            if projectile.type == ProjectileType.ARROW:
-                                start_of_arrow_x, start_of_arrow_y = projectile.get_start_of_arrow()
-                                send_eat_arrow_command(self.s,
-                                                    start_of_arrow_x - client_player.x,
-                                                    start_of_arrow_y - client_player.y,
-                                                    projectile.x - client_player.x,
-                                                    projectile.y - client_player.y,
-                                                    client_id=self.client.id,
-                                                    game_name=self.client.game_name)
-                                send_remove_projectile_command(self.s, projectile.id, client_id=self.client.id, game_name=self.client.game_name)
-                                client_player.hp -= 1
-                                verb = death_reason_to_verb(DeathReason.ARROW)
-                                self.maybe_die(client_player, verb, projectile.player_id)                                
-
-                elif not self.client.ai:
-                    for event in pygame.event.get():
-                        if event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN:
-                            assert self.client.team
-                            send_spawn_command(self.s, random.randint(1, GAME_WIDTH - 1), random.randint(1, GAME_HEIGHT - 1), self.client.team, client_id=self.client.id)
-
-                elif self.ai_last_gave_command_at < datetime.now() - timedelta(milliseconds=500):
-                    # An AI player is dead, and needs to send a spawn command
-                    assert self.client.team
-                    send_spawn_command(self.s, random.randint(1, GAME_WIDTH - 1), random.randint(1, GAME_HEIGHT - 1), self.client.team, client_id=self.client.id, game_name=self.client.game_name)
-                    self.ai_last_gave_command_at = datetime.now()
-        
-            elif self.client.game_name is None and not self.client.game_started and not self.client.ai:
-                for event in pygame.event.get():
-                    if event.type == pygame.KEYDOWN:
-                        key_name = pygame.key.name(event.key)
-                        if len(key_name) == 1 and key_name in 'abcdefghijklmnopqrstuvwxyz':
-                            if self.lobby_input_focus == LobbyInputFocus.GAME_NAME_INPUT:
-                                self.game_name_input += key_name
-                            elif self.lobby_input_focus == LobbyInputFocus.PLAYER_NAME_INPUT:
-                                self.player_name_input += key_name
-                            elif key_name == 'j' and self.game_name_input in json.loads(rget('game_names', client_id=self.client.id) or '{}'):
-                                send_with_retry(self.s, f'join_game|{self.player_name_input}|{self.game_name_input}', client_id=self.client.id)
-                                self.client.set_game_name(self.game_name_input)
-                            elif key_name == 'h':
-                                send_with_retry(self.s, f'host_game|{self.player_name_input}|{self.game_name_input}', client_id=self.client.id)
-                                self.client.set_game_name(self.game_name_input)
-                        elif key_name == 'backspace':
-                            if self.lobby_input_focus == LobbyInputFocus.GAME_NAME_INPUT:
-                                self.game_name_input = self.game_name_input[:-1]
-                            elif self.lobby_input_focus == LobbyInputFocus.PLAYER_NAME_INPUT:
-                                self.player_name_input = self.player_name_input[:-1]
-                    elif event.type == pygame.MOUSEBUTTONDOWN:
-                        mouse_x = event.pos[0]
-                        mouse_y = event.pos[1]
-                        if mouse_x > 200 and mouse_x < 400 and mouse_y > 0 and mouse_y < 50:
-                            self.lobby_input_focus = LobbyInputFocus.PLAYER_NAME_INPUT
-                        elif mouse_x > 200 and mouse_x < 400 and mouse_y > 50 and mouse_y < 100:
-                            self.lobby_input_focus = LobbyInputFocus.GAME_NAME_INPUT
-                        else:
-                            self.lobby_input_focus = None
-
-            elif self.client.game_name is not None and not self.client.game_started and not self.client.ai:
-                for event in pygame.event.get():
-                    if event.type == pygame.KEYDOWN and event.key == pygame.K_s:
-                        send_with_retry(self.s, f'start_game', client_id=self.client.id)
-
-            # for input in [pygame.K_RIGHT, pygame.K_LEFT, pygame.K_UP, pygame.K_DOWN]:
-            #     if keys[input]:
-            #         self.player.move(input)
-            #         self.player.make_valid_position(self.width, self.height)
-            #         self.send_data()
-
-            # Update Canvas
-            if not self.client.ai:
-                assert canvas
-                if client_player is not None:
-                    x_offset = int(client_player.x - self.width / 2)
-                    y_offset = int(client_player.y - self.height / 2)
+                                    self.running = False
 
-                if client_player is not None and (client_player.weapon == Weapon.BOW or client_player.weapon == Weapon.FLASHLIGHT):
-                    x_offset = int(client_player.x - self.width / 2)
-                    y_offset = int(client_player.y - self.height / 2)
-                    mouse_x, mouse_y = pygame.mouse.get_pos()
-                    vector_from_player_to_mouse = (mouse_x - client_player.x + x_offset, mouse_y - client_player.y + y_offset)
-                    vector_from_player_to_mouse_mag = math.sqrt(vector_from_player_to_mouse[0]**2 + vector_from_player_to_mouse[1]**2)
-                    unit_vector_from_player_to_mouse = (vector_from_player_to_mouse[0] / (vector_from_player_to_mouse_mag + 0.00001),
-                                                        vector_from_player_to_mouse[1] / (vector_from_player_to_mouse_mag + 0.00001))
-                    
-                    if client_player.weapon == Weapon.BOW:
-                        unit_vector_from_player_to_mouse = get_unit_vector_from_player_to_mouse(client_player.x - x_offset, client_player.y - y_offset, mouse_x, mouse_y)
-                        arrow_size = 50
-                        arrow_x = unit_vector_from_player_to_mouse[0] * arrow_size + client_player.x - x_offset
-                        arrow_y = unit_vector_from_player_to_mouse[1] * arrow_size + client_player.y - y_offset
-                        draw_arrow(canvas, ARROW_COLOR, (client_player.x - x_offset, client_player.y - y_offset), (arrow_x, arrow_y))
-                
-                    elif client_player.weapon == Weapon.FLASHLIGHT:
-                        triangle = get_flashlight_triangle(client_player.x - x_offset, client_player.y - y_offset, mouse_x, mouse_y)
-                        pygame.draw.polygon(canvas, FLASHLIGHT_COLOR, triangle, width=0)
-
-                if client_player is not None and x_offset is not None and y_offset is not None:
-                    for player in game_state.players:
-                        putative_player_team = player.team if player.client_id == self.client.id else self.player_numbers_to_putative_teams.get(player.player_number)
-                        player.draw(canvas, x_offset, y_offset, putative_player_team)
-                        if target is not None and client_player is not None and player.client_id != client_player.client_id and player.client_id == target.client_id:
-                            pygame.draw.circle(canvas, (0,0,0), (player.x - x_offset, player.y - y_offset), 40, width=2)
-                    for item in game_items.values():
-                        item.draw(canvas, x_offset, y_offset)
-
-                    if self.item_target is not None:
-                        if self.item_target.category == ItemCategory.WEAPON and client_player is not None and client_player.weapon is not None:
-                            color = (255, 0, 0)
-                        elif self.item_target.category == ItemCategory.GARB and client_player is not None and client_player.garb is not None:
-                            color = (255, 0, 0)
-                        else:
-                            color = (0, 0, 0)
-                        pygame.draw.circle(canvas, color, (self.item_target.x - x_offset, self.item_target.y - y_offset), 40, width = 2)
-
-                    for projectile in game_state.projectiles:
-                        projectile.draw(canvas, x_offset, y_offset)
-
-                if client_player is not None and client_player.garb is not None and client_player.garb_picked_up_at is not None:
-                    current_time = datetime.now()
-                    if client_player.garb_picked_up_at + garb_max_age(client_player.garb) < current_time:
-                        old_garb = client_player.garb
-                        client_player.garb = None
-                        client_player.garb_picked_up_at = None
-                        if old_garb == Garb.BOOTS:
-                            send_set_speed_command(self.s, 200, client_id=self.client.id)
-                        elif old_garb == Garb.ARMOR:
-                            client_player.hp -= 1
-
-                if self.client.game_name is not None and self.client.game_started:
-                    delayed_score = score.get()
-                    actual_score = score.get(actual=True)
-                    actual_red_score, actual_blue_score = actual_score
-                    game_over = actual_red_score >= MAX_SCORE or actual_blue_score >= MAX_SCORE
-
-                    self.draw_health_state(canvas)
-                    self.draw_announcements(canvas)
-                    self.draw_big_text(canvas, actual_score, game_over)
-                    self.draw_weapon_and_ammo(canvas)
-                    self.draw_player_numbers_to_putative_teams(canvas)
-                    self.draw_garb(canvas)
-                    self.draw_score(canvas, delayed_score, actual_score, game_over)
-                    if client_player is not None:
-                        x_offset = int(client_player.x - self.width / 2)
-                        y_offset = int(client_player.y - self.height / 2)
-                        self.draw_edges_of_map(canvas, x_offset, y_offset)
-
-                elif self.client.game_name is None:
-                    game_names = json.loads(rget('game_names', client_id=self.client.id) or '{}')
-                    if not game_names:
-                        draw_text_centered_on_rectangle(canvas, 'No games available.', 0, 0, self.width, self.height, 35)
+                    self.target = None
+                    if client_player.weapon == Weapon.DAGGER:
+                        self.target = player_grid.nearest(client_player.x, client_player.y, DAGGER_RANGE, 
+                                                          lambda possible_target: (possible_target.client_id != self.client.id 
+                                                                                   and self.player_numbers_to_putative_teams.get(possible_target.player_number) != self.client.team))
+
+                    self.item_target = item_grid.nearest(client_player.x, client_player.y, DAGGER_RANGE)
+
+
+            elif not self.client.ai:
+                for event in pygame.event.get():
+                    if event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN:
+                        assert self.client.team
+                        send_spawn_command(self.s, random.randint(1, GAME_WIDTH - 1), random.randint(1, GAME_HEIGHT - 1), self.client.team, client_id=self.client.id)
+
+            elif self.ai_last_gave_command_at < datetime.now() - timedelta(milliseconds=500):
+                # An AI player is dead, and needs to send a spawn command
+                assert self.client.team
+                send_spawn_command(self.s, random.randint(1, GAME_WIDTH - 1), random.randint(1, GAME_HEIGHT - 1), self.client.team, client_id=self.client.id, game_name=self.client.game_name)
+                self.ai_last_gave_command_at = datetime.now()
+    
+        elif self.client.game_name is None and not self.client.game_started and not self.client.ai:
+            for event in pygame.event.get():
+                if event.type == pygame.KEYDOWN:
+                    key_name = pygame.key.name(event.key)
+                    if len(key_name) == 1 and key_name in 'abcdefghijklmnopqrstuvwxyz':
+                        if self.lobby_input_focus == LobbyInputFocus.GAME_NAME_INPUT:
+                            self.game_name_input += key_name
+                        elif self.lobby_input_focus == LobbyInputFocus.PLAYER_NAME_INPUT:
+                            self.player_name_input += key_name
+                        elif key_name == 'j' and self.game_name_input in client_state.game_names:
+                            send_with_retry(self.s, f'join_game|{self.player_name_input}|{self.game_name_input}', client_id=self.client.id)
+                            self.client.set_game_name(self.game_name_input)
+                        elif key_name == 'h':
+                            send_with_retry(self.s, f'host_game|{self.player_name_input}|{self.game_name_input}', client_id=self.client.id)
+                            self.client.set_game_name(self.game_name_input)
+                    elif key_name == 'backspace':
+                        if self.lobby_input_focus == LobbyInputFocus.GAME_NAME_INPUT:
+                            self.game_name_input = self.game_name_input[:-1]
+                        elif self.lobby_input_focus == LobbyInputFocus.PLAYER_NAME_INPUT:
+                            self.player_name_input = self.player_name_input[:-1]
+                elif event.type == pygame.MOUSEBUTTONDOWN:
+                    mouse_x = event.pos[0]
+                    mouse_y = event.pos[1]
+                    if mouse_x > 200 and mouse_x < 400 and mouse_y > 0 and mouse_y < 50:
+                        self.lobby_input_focus = LobbyInputFocus.PLAYER_NAME_INPUT
+                    elif mouse_x > 200 and mouse_x < 400 and mouse_y > 50 and mouse_y < 100:
+                        self.lobby_input_focus = LobbyInputFocus.GAME_NAME_INPUT
                     else:
-                        draw_text_list(canvas, ['Current games:', '', *game_names.keys()], 200, 300, 200, 50, 35)
-
-                    draw_text_centered_on_rectangle(canvas, 'Your name:', 0, 0, 200, 50, 25)
-                    draw_text_centered_on_rectangle(canvas, 'Game name:', 0, 50, 200, 50, 25)
-                    draw_text_centered_on_rectangle(canvas, 'Press J to join', 0, 100, 200, 50, 25)
-                    draw_text_centered_on_rectangle(canvas, 'Press H to host', 0, 150, 200, 50, 25)
-                    draw_text_centered_on_rectangle(canvas, self.player_name_input, 200, 0, 200, 50, 25)
-                    draw_text_centered_on_rectangle(canvas, self.game_name_input, 200, 50, 200, 50, 25)
-                    pygame.draw.rect(canvas, (255,0,0) if self.lobby_input_focus == LobbyInputFocus.PLAYER_NAME_INPUT else (0,0,0), (200, 0, 200, 50), width=2)
-                    pygame.draw.rect(canvas, (255,0,0) if self.lobby_input_focus == LobbyInputFocus.GAME_NAME_INPUT else (0,0,0), (200, 50, 200, 50), width=2)
-
-                elif self.client.game_name is not None and not self.client.game_started:
-                    active_players = json.loads(rget('active_players', client_id=self.client.id) or '[]')
-                    if not active_players:
-                        draw_text_centered_on_rectangle(canvas, 'No players in game.', 0, 0, self.width, self.height, 35)
+                        self.lobby_input_focus = None
+
+        elif self.client.game_name is not None and not self.client.game_started and not self.client.ai:
+            for event in pygame.event.get():
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_s:
+                    send_with_retry(self.s, f'start_game', client_id=self.client.id)
+
+        if (not self.client.ai and client_player is not None and client_player.garb is not None 
+                and client_player.garb_picked_up_at is not None):
+            if client_player.garb_picked_up_at + garb_max_age(client_player.garb) < now:
+                old_garb = client_player.garb
+                client_player.garb = None
+                client_player.garb_picked_up_at = None
+                if old_garb == Garb.BOOTS:
+                    send_set_speed_command(self.s, 200, client_id=self.client.id)
+                elif old_garb == Garb.ARMOR:
+                    client_player.hp -= 1
+
+        # for input in [pygame.K_RIGHT, pygame.K_LEFT, pygame.K_UP, pygame.K_DOWN]:
+        #     if keys[input]:
+        #         self.player.move(input)
+        #         self.player.make_valid_position(self.width, self.height)
+        #         self.send_data()
+
+    # Draws everything fraction of the way from the second to last simulation step to the last one
+    @profiled('render')
+    def render(self, fraction: float) -> None:
+        assert self.canvas
+        self.canvas.draw_background()
+        canvas = self.canvas.get_canvas()
+        game_state = lerp_game_states(self.previous_game_state, self.game_state, fraction)
+        client_player = self.player
+        target = self.target
+        player_grid = SpatialGrid(game_state.players)
+        projectile_grid = SpatialGrid(game_state.projectiles)
+        item_grid = SpatialGrid(self.items.values())
+        x_offset: Optional[int] = None
+        y_offset: Optional[int] = None
+        # Everything drawn this frame that isn't on the static layer, so that only it has to be pushed to the
+        # display, if the camera hasn't moved
+        drawn: list[Optional[pygame.Rect]] = []
+        camera: Optional[tuple[int, int]] = None
+        if client_player is not None:
+            # The camera follows our own player where they're drawn, between the steps, rather than where the last
+            # step left them
+            own_player = next((player for player in game_state.players if player.client_id == self.client.id), client_player)
+            player_x, player_y = own_player.x, own_player.y
+            x_offset = int(player_x - self.width / 2)
+            y_offset = int(player_y - self.height / 2)
+            camera = (x_offset, y_offset)
+
+        if client_player is not None and (client_player.weapon == Weapon.BOW or client_player.weapon == Weapon.FLASHLIGHT):
+            x_offset = int(player_x - self.width / 2)
+            y_offset = int(player_y - self.height / 2)
+            mouse_x, mouse_y = pygame.mouse.get_pos()
+            vector_from_player_to_mouse = (mouse_x - player_x + x_offset, mouse_y - player_y + y_offset)
+            vector_from_player_to_mouse_mag = math.sqrt(vector_from_player_to_mouse[0]**2 + vector_from_player_to_mouse[1]**2)
+            unit_vector_from_player_to_mouse = (vector_from_player_to_mouse[0] / (vector_from_player_to_mouse_mag + 0.00001),
+                                                vector_from_player_to_mouse[1] / (vector_from_player_to_mouse_mag + 0.00001))
+            
+            if client_player.weapon == Weapon.BOW:
+                unit_vector_from_player_to_mouse = get_unit_vector_from_player_to_mouse(player_x - x_offset, player_y - y_offset, mouse_x, mouse_y)
+                arrow_size = 50
+                arrow_x = unit_vector_from_player_to_mouse[0] * arrow_size + player_x - x_offset
+                arrow_y = unit_vector_from_player_to_mouse[1] * arrow_size + player_y - y_offset
+                drawn.append(draw_arrow(canvas, ARROW_COLOR, (player_x - x_offset, player_y - y_offset), (arrow_x, arrow_y)))
+        
+            elif client_player.weapon == Weapon.FLASHLIGHT:
+                triangle = get_flashlight_triangle(player_x - x_offset, player_y - y_offset, mouse_x, mouse_y)
+                drawn.append(pygame.draw.polygon(canvas, FLASHLIGHT_COLOR, triangle, width=0))
+
+        if client_player is not None and x_offset is not None and y_offset is not None:
+            # Most of the map is off screen, so only what's near the screen gets drawn
+            with profiler.section('draw entities'):
+                viewport = Viewport(x_offset, y_offset, self.width, self.height)
+                for player in player_grid.query_box(viewport.min_x, viewport.min_y, viewport.max_x, viewport.max_y):
+                    putative_player_team = player.team if player.client_id == self.client.id else self.player_numbers_to_putative_teams.get(player.player_number)
+                    drawn.append(player.draw(canvas, x_offset, y_offset, putative_player_team))
+                    if target is not None and client_player is not None and player.client_id != client_player.client_id and player.client_id == target.client_id:
+                        drawn.append(pygame.draw.circle(canvas, (0,0,0), (player.x - x_offset, player.y - y_offset), 40, width=2))
+                for item in item_grid.query_box(viewport.min_x, viewport.min_y, viewport.max_x, viewport.max_y):
+                    drawn.append(item.draw(canvas, x_offset, y_offset))
+
+                if self.item_target is not None:
+                    if self.item_target.category == ItemCategory.WEAPON and client_player is not None and client_player.weapon is not None:
+                        color = (255, 0, 0)
+                    elif self.item_target.category == ItemCategory.GARB and client_player is not None and client_player.garb is not None:
+                        color = (255, 0, 0)
                     else:
-                        draw_text_list(canvas, ['Players in game:', '', *[str(player[0]) for player in active_players]], 200, 300, 200, 50, 35)
-                    game_names = json.loads(rget('game_names', client_id=self.client.id) or '{}')
-
-                assert self.canvas
-                self.canvas.update()
+                        color = (0, 0, 0)
+                    drawn.append(pygame.draw.circle(canvas, color, (self.item_target.x - x_offset, self.item_target.y - y_offset), 40, width = 2))
+
+                for projectile in projectile_grid.query_box(viewport.min_x, viewport.min_y, viewport.max_x, viewport.max_y):
+                    drawn.append(projectile.draw(canvas, x_offset, y_offset))
+
+        if self.client.game_name is not None and self.client.game_started:
+            delayed_score = score.get()
+            actual_score = score.get(actual=True)
+            actual_red_score, actual_blue_score = actual_score
+            game_over = actual_red_score >= MAX_SCORE or actual_blue_score >= MAX_SCORE
+
+            hud_key = (client_player.hp if client_player is not None else None, 
+                       client_player.weapon if client_player is not None else None, 
+                       client_player.ammo if client_player is not None else None, 
+                       client_player.garb if client_player is not None else None, 
+                       tuple(self.player_numbers_to_putative_teams.items()), delayed_score, actual_score, game_over)
+            assert self.hud_layer
+            drawn.extend(self.hud_layer.update(hud_key, lambda layer: [
+                self.draw_health_state(layer),
+                self.draw_big_text(layer, actual_score, game_over),
+                self.draw_weapon_and_ammo(layer),
+                self.draw_player_numbers_to_putative_teams(layer),
+                self.draw_garb(layer),
+                self.draw_score(layer, delayed_score, actual_score, game_over),
+            ]))
+            self.hud_layer.blit(canvas)
+            drawn.extend(self.draw_announcements(canvas))
+            drawn.append(self.draw_garb_timer(canvas))
+            if client_player is not None:
+                x_offset = int(player_x - self.width / 2)
+                y_offset = int(player_y - self.height / 2)
+                self.draw_edges_of_map(canvas, x_offset, y_offset)
+
+        elif self.client.game_name is None:
+            game_names = client_state.game_names
+            if not game_names:
+                draw_text_centered_on_rectangle(canvas, 'No games available.', 0, 0, self.width, self.height, 35)
+            else:
+                draw_text_list(canvas, ['Current games:', '', *game_names.keys()], 200, 300, 200, 50, 35)
+
+            draw_text_centered_on_rectangle(canvas, 'Your name:', 0, 0, 200, 50, 25)
+            draw_text_centered_on_rectangle(canvas, 'Game name:', 0, 50, 200, 50, 25)
+            draw_text_centered_on_rectangle(canvas, 'Press J to join', 0, 100, 200, 50, 25)
+            draw_text_centered_on_rectangle(canvas, 'Press H to host', 0, 150, 200, 50, 25)
+            draw_text_centered_on_rectangle(canvas, self.player_name_input, 200, 0, 200, 50, 25)
+            draw_text_centered_on_rectangle(canvas, self.game_name_input, 200, 50, 200, 50, 25)
+            pygame.draw.rect(canvas, (255,0,0) if self.lobby_input_focus == LobbyInputFocus.PLAYER_NAME_INPUT else (0,0,0), (200, 0, 200, 50), width=2)
+            pygame.draw.rect(canvas, (255,0,0) if self.lobby_input_focus == LobbyInputFocus.GAME_NAME_INPUT else (0,0,0), (200, 50, 200, 50), width=2)
+
+        elif self.client.game_name is not None and not self.client.game_started:
+            active_players = client_state.active_players
+            if not active_players:
+                draw_text_centered_on_rectangle(canvas, 'No players in game.', 0, 0, self.width, self.height, 35)
+            else:
+                draw_text_list(canvas, ['Players in game:', '', *[str(player[0]) for player in active_players]], 200, 300, 200, 50, 35)
 
-        pygame.quit()
+        drawn.append(profiler.draw_overlay(canvas, 25, 100))
+        camera_still = camera is not None and camera == self.last_camera
+        with profiler.section('display update'):
+            self.canvas.update([rect for rect in drawn if rect is not None] if camera_still else None)
+        self.last_camera = camera
 
-    def draw_health_state(self, canvas: Any) -> None:
+    @profiled('draw_health_state')
+    def draw_health_state(self, canvas: Any) -> Optional[pygame.Rect]:
         client_player = self.player
         if client_player is None:
-            return
+            return None
         current_x = 25
         current_y = 25
+        rects = []
         for i in range(max(BASE_MAX_HP, client_player.hp)):
             if i >= client_player.hp:
-                image_surface = pygame.image.load('assets/empty_heart.png').convert_alpha()
+                image_surface = asset_cache.image('assets/empty_heart.png')
             elif i >= BASE_MAX_HP:
-                image_surface = pygame.image.load('assets/blue_heart.png').convert_alpha()
+                image_surface = asset_cache.image('assets/blue_heart.png')
             else:
-                image_surface = pygame.image.load('assets/heart.png').convert_alpha()
-            canvas.blit(image_surface, (current_x, current_y))
+                image_surface = asset_cache.image('assets/heart.png')
+            rects.append(canvas.blit(image_surface, (current_x, current_y)))
             current_x += 75
+        return rects[0].unionall(rects[1:]) if rects else None
 
     def maybe_die(self, client_player: Player, verb: str, killer_id: int) -> bool:
         if client_player.hp <= 0:
@@ -635,6 +856,65 @@ class Game:
             return True
         return False
 
+    # Everything but our own player and arrows is interpolated between the authoritative states from RENDER_DELAY
+    # ago. AI players don't draw anything, so they just go by the latest state.
+    def game_state_from_authoritative_states(self, now: datetime, *, client_id: Optional[int], 
+                                             game_name: Optional[str]) -> Optional[GameState]:
+        if (latest_state := get_authoritative_state(client_id=client_id, game_name=game_name)) is None:
+            return None
+        if client_id is None:
+            game_state = latest_state.game_state_at(now)
+        else:
+            render_time = now - RENDER_DELAY
+            game_state = self.interpolator.game_state_at(render_time, *authoritative_states.around(render_time))
+        own_state = self.predict_own_state(latest_state, now, client_id=client_id, game_name=game_name)
+        if client_id is not None:
+            self.reconcile(own_state, latest_state, now, client_id=client_id, game_name=game_name)
+        game_state.players = [player for player in game_state.players if player.client_id != self.client.id] + own_state.players
+        game_state.projectiles = ([projectile for projectile in game_state.projectiles if projectile.player_id != self.client.id] 
+                                  + own_state.projectiles)
+        return game_state
+
+    # Our own player and arrows as of now: the server's view of them, run through the commands we've given since
+    # the server simulation last got to them, so that we don't have to wait a round trip to see them
+    def predict_own_state(self, authoritative_state: 'AuthoritativeState', now: datetime, *, client_id: Optional[int], 
+                          game_name: Optional[str]) -> GameState:
+        own_state = authoritative_state.game_state_at(now, owned_by=self.client.id)
+        own_commands = [command for command in get_commands_by_player(client_id=client_id, game_name=game_name).get(self.client.id)
+                        if authoritative_state.time < command.time <= now]
+        if own_commands:
+            player, anchor_time = authoritative_state.player_anchors.get(self.client.id) or (None, authoritative_state.time)
+            player_number = get_player_number_from_client_id(self.client.id, client_id=client_id, game_name=game_name)
+            own_player = _run_commands_for_player(anchor_time, player.copy() if player is not None else None, own_commands, 
+                                                  self.client.id, player_number, own_state.projectiles, 
+                                                  client_id=client_id, end_time=now, game_name=game_name)
+            own_state.players = [own_player] if own_player is not None else []
+        return own_state
+
+    # When a newer authoritative state arrives, whatever the older one had wrong about our own player shows up as a
+    # difference between the two predictions, which is eased out over RECONCILIATION_SMOOTHING instead of jumping
+    def reconcile(self, own_state: GameState, latest_state: 'AuthoritativeState', now: datetime, *, client_id: Optional[int], 
+                  game_name: Optional[str]) -> None:
+        if latest_state is not self.predicted_from:
+            if self.predicted_from is not None and own_state.players:
+                previous_own_players = self.predict_own_state(self.predicted_from, now, client_id=client_id, game_name=game_name).players
+                remaining_error_x, remaining_error_y = self.remaining_prediction_error(now)
+                if previous_own_players:
+                    error_x = previous_own_players[0].x - own_state.players[0].x + remaining_error_x
+                    error_y = previous_own_players[0].y - own_state.players[0].y + remaining_error_y
+                    self.prediction_error = ((error_x, error_y) if sqrt(error_x**2 + error_y**2) < RECONCILIATION_SNAP_DISTANCE 
+                                             else (0.0, 0.0))
+                    self.prediction_error_at = now
+            self.predicted_from = latest_state
+        error_x, error_y = self.remaining_prediction_error(now)
+        for player in own_state.players:
+            player.x = clamp_to_game_x(player.x + int(error_x))
+            player.y = clamp_to_game_y(player.y + int(error_y))
+
+    def remaining_prediction_error(self, now: datetime) -> tuple[float, float]:
+        remaining = max(1 - (now - self.prediction_error_at) / RECONCILIATION_SMOOTHING, 0.0)
+        return self.prediction_error[0] * remaining, self.prediction_error[1] * remaining
+
     def shoot_bow(self, client_player: Player, dest_x: int, dest_y: int) -> None:
         unit_vector_from_player_to_mouse = get_unit_vector_from_player_to_mouse(client_player.x, client_player.y, dest_x, dest_y)
         arrow_distance = 400
@@ -663,10 +943,11 @@ class Game:
         self.announcements.append(annoucement)
         self.announcements = self.announcements[-5:]        
 
-    def draw_announcements(self, canvas: Any) -> None:
+    @profiled('draw_announcements')
+    def draw_announcements(self, canvas: Any) -> list[pygame.Rect]:
         current_x = 25
         current_y = self.height - 150
-        font = pygame.font.SysFont("comicsans", 25)
+        rects = []
         self.announcements = [a for a in self.announcements if a.time > datetime.now() - timedelta(seconds=15)]
         self.announcements = self.announcements[-5:]
 
@@ -679,30 +960,37 @@ class Game:
                 opacity = 0.0
             else:
                 opacity = 1 - (datetime.now() - announcement.time - timedelta(seconds=10)).total_seconds()/5.0
-            text = font.render(announcement.message, True, (0, 0, 0))
-            text.set_alpha(int(255 * opacity))
-            canvas.blit(text, (current_x, current_y))
+            text = asset_cache.text(announcement.message, 25)
+            if opacity < 1.0:
+                # The cached surface is shared, so it's only faded on a copy
+                text = text.copy()
+                text.set_alpha(int(255 * opacity))
+            rects.append(canvas.blit(text, (current_x, current_y)))
             current_y += 25
+        return rects
 
-    def draw_big_text(self, canvas: Any, actual_score: tuple[int, int], game_over: bool) -> None:
+    @profiled('draw_big_text')
+    def draw_big_text(self, canvas: Any, actual_score: tuple[int, int], game_over: bool) -> Optional[pygame.Rect]:
         if game_over:
             red_score, blue_score = actual_score
             winner = 'The red team' if red_score > blue_score else 'The blue team'
-            draw_text_centered_on_rectangle(canvas, f'Game over. {winner} wins.', 0, 0, self.width, self.height, 35)
+            return draw_text_centered_on_rectangle(canvas, f'Game over. {winner} wins.', 0, 0, self.width, self.height, 35)
 
         elif self.player is None:
-            draw_text_centered_on_rectangle(canvas, 'You died. Press enter to respawn.', 0, 0, self.width, self.height, 35)
+            return draw_text_centered_on_rectangle(canvas, 'You died. Press enter to respawn.', 0, 0, self.width, self.height, 35)
             # font = pygame.font.SysFont("comicsans", 35)
             # text = font.render('You died. Press enter to respawn.', True, (0, 0, 0))
             # canvas.blit(text, (120, 350))
+        return None
 
-    def draw_weapon_and_ammo(self, canvas: Any) -> None:
+    @profiled('draw_weapon_and_ammo')
+    def draw_weapon_and_ammo(self, canvas: Any) -> Optional[pygame.Rect]:
         client_player = self.player
         if client_player and client_player.weapon:
             current_x = self.width - 110
             current_y = self.height - 110
-            image_surface = pygame.transform.scale(weapon_to_pygame_image(client_player.weapon), (100, 100)).convert_alpha()
-            canvas.blit(image_surface, (current_x, current_y))
+            image_surface = weapon_to_pygame_image(client_player.weapon, (100, 100))
+            rect = canvas.blit(image_surface, (current_x, current_y))
 
             arrow_bottom = self.height - 55
             arrow_top = self.height - 85
@@ -710,62 +998,101 @@ class Game:
             if client_player.weapon == Weapon.BOW:
                 for _ in range(client_player.ammo):
                     current_x -= 30
-                    draw_arrow(canvas, ARROW_COLOR, (current_x, arrow_bottom), (current_x, arrow_top))
+                    rect.union_ip(draw_arrow(canvas, ARROW_COLOR, (current_x, arrow_bottom), (current_x, arrow_top)))
+            return rect
+        return None
 
-    def draw_garb(self, canvas: Any) -> None:
+    @profiled('draw_garb')
+    def draw_garb(self, canvas: Any) -> Optional[pygame.Rect]:
         client_player = self.player
         if client_player and client_player.garb and client_player.garb_picked_up_at:
-            current_x = self.width - 110
-            current_y = self.height - 240
-            image_surface = pygame.transform.scale(garb_to_pygame_image(client_player.garb), (100, 100)).convert_alpha()
-            canvas.blit(image_surface, (current_x, current_y))
-            self.draw_timer(canvas, client_player.garb_picked_up_at, client_player.garb_picked_up_at + garb_max_age(client_player.garb),
-                            current_x - 50, current_y)
+            image_surface = garb_to_pygame_image(client_player.garb, (100, 100))
+            return canvas.blit(image_surface, (self.width - 110, self.height - 240))
+        return None
+
+    # Drawn every frame, unlike the garb itself, since it runs down
+    @profiled('draw_garb_timer')
+    def draw_garb_timer(self, canvas: Any) -> Optional[pygame.Rect]:
+        client_player = self.player
+        if client_player and client_player.garb and client_player.garb_picked_up_at:
+            return self.draw_timer(canvas, client_player.garb_picked_up_at, client_player.garb_picked_up_at + garb_max_age(client_player.garb),
+                                   self.width - 160, self.height - 240)
+        return None
 
-    def draw_timer(self, canvas: Any, start_time: datetime, end_time: datetime, timer_x: int, timer_y: int) -> None:
+    def draw_timer(self, canvas: Any, start_time: datetime, end_time: datetime, timer_x: int, timer_y: int) -> Optional[pygame.Rect]:
         current_time = datetime.now()
         timer_width = 25
         timer_height = 100
         if current_time > start_time and current_time < end_time:
-            pygame.draw.rect(canvas, (0,0,0), (timer_x, timer_y, timer_width, timer_height), width=2)
+            rect = pygame.draw.rect(canvas, (0,0,0), (timer_x, timer_y, timer_width, timer_height), width=2)
             fraction_of_time_run_down = (current_time - start_time) / (end_time - start_time)
             pygame.draw.rect(canvas, (0,128,0), (timer_x, timer_y + int(fraction_of_time_run_down * timer_height), 
                                                  timer_width, int((1.0 - fraction_of_time_run_down) * timer_height)))
+            return rect
+        return None
 
-    def draw_player_numbers_to_putative_teams(self, canvas: Any) -> None:
+    @profiled('draw_player_numbers_to_putative_teams')
+    def draw_player_numbers_to_putative_teams(self, canvas: Any) -> Optional[pygame.Rect]:
         current_x = self.width - 70
         current_y = 70
+        rects = []
 
         for player_number in range(1, 9):
             client_id = get_client_id_from_player_number(player_number, client_id=self.client.id)
             if client_id == self.client.id:
                 continue
             pygame.draw.circle(canvas, (0,0,0), (current_x, current_y), 25, width=2)
-            pygame.draw.circle(canvas, team_to_color(self.player_numbers_to_putative_teams.get(player_number)), (current_x, current_y), 25)
+            rects.append(pygame.draw.circle(canvas, team_to_color(self.player_numbers_to_putative_teams.get(player_number)), (current_x, current_y), 25))
             draw_text_centered_on_rectangle(canvas, str(player_number), current_x, current_y, 0, 0, 25)        
             current_y += 60    
+        return rects[0].unionall(rects[1:]) if rects else None
 
+    @profiled('draw_edges_of_map')
     def draw_edges_of_map(self, canvas: Any, x_offset: int, y_offset: int) -> None:
         pygame.draw.line(canvas, (0,0,0), (-x_offset, -y_offset), (self.game_width-x_offset, -y_offset), width=3)
         pygame.draw.line(canvas, (0,0,0), (-x_offset, -y_offset), (-x_offset, self.game_height-y_offset), width=3)
         pygame.draw.line(canvas, (0,0,0), (self.game_width-x_offset, -y_offset), (self.game_width-x_offset, self.game_height-y_offset), width=3)
         pygame.draw.line(canvas, (0,0,0), (-x_offset, self.game_height-y_offset), (self.game_width-x_offset, self.game_height-y_offset), width=3)
 
-    def draw_score(self, canvas: Any, delayed_score: tuple[int, int], actual_score: tuple[int, int], game_over: bool) -> None:
+    @profiled('draw_score')
+    def draw_score(self, canvas: Any, delayed_score: tuple[int, int], actual_score: tuple[int, int], game_over: bool) -> pygame.Rect:
         score = actual_score if game_over else delayed_score
-        draw_score_centered_on_rectangle(canvas, score[0], score[1], 0, 0, self.width, 200, 35)
+        return draw_score_centered_on_rectangle(canvas, score[0], score[1], 0, 0, self.width, 200, 35)
+
+
+# The snapshots the client has been sent by the server. The server's own live in redis.
+game_state_snapshots = SnapshotRing(MAX_GAME_STATE_SNAPSHOTS)
+_initial_game_state = GameState([], [])
+game_state_snapshots.add(json.dumps(_initial_game_state.to_json()), _initial_game_state.time)
+
+
+def store_game_state_snapshot(raw_snap: str, time: datetime, *, client_id: Optional[int] = None, 
+                              game_name: Optional[str] = None) -> None:
+    if client_id is not None:
+        game_state_snapshots.add(raw_snap, time)
+    else:
+        assert game_name is not None
+        rring_push('game_state_snapshots', raw_snap, datetime.timestamp(time), capacity=MAX_SERVER_GAME_STATE_SNAPSHOTS, 
+                   game_name=game_name)
 
 
-game_state_snapshots: list[str] = [json.dumps(GameState([], []).to_json())]
+# Clients keep the authoritative states from the server's digests here, rather than in redis
+authoritative_states: StateBuffer[AuthoritativeState] = StateBuffer(AUTHORITATIVE_STATE_BUFFER_SIZE)
 
 
-def get_game_state_snapshots(*, client_id: Optional[int] = None, game_name: Optional[str] = None) -> list[str]:
+def store_authoritative_state(state: AuthoritativeState, *, client_id: Optional[int] = None, 
+                              game_name: Optional[str] = None) -> None:
     if client_id is not None:
-        return game_state_snapshots
+        authoritative_states.add(state)
     else:
-        return (json.loads(raw_game_state_snapshots)
-                if (raw_game_state_snapshots := rget('game_state_snapshots', client_id=None, game_name=game_name)) is not None
-                else [json.dumps(GameState([], [], time=datetime.now() - timedelta(seconds=2)).to_json())])
+        rset('authoritative_state', json.dumps(state.to_json()), client_id=None, game_name=game_name)
+
+
+def get_authoritative_state(*, client_id: Optional[int], game_name: Optional[str]) -> Optional[AuthoritativeState]:
+    if client_id is not None:
+        return authoritative_states.latest()
+    raw_state = rget('authoritative_state', client_id=None, game_name=game_name)
+    return AuthoritativeState.from_json(json.loads(raw_state)) if raw_state else None
 
 
 def _move_projectile(projectile: Optional[Projectile], *, prev_time: datetime, next_time: datetime) -> Optional[Projectile]:
@@ -831,6 +1158,8 @@ def _move_player(player: Optional[Player], *, prev_time: datetime, next_time: da
         player.y = clamp_to_game_y(player.y + int(unit_vector_y * distance_traveled))
 
 
+# If spawned_projectiles is passed, newly spawned projectiles are collected there along with their spawn time, rather
+# than being run forward to end_time and added to all_projectiles
 def _run_commands_for_player(starting_time: datetime, player: Optional[Player], 
                              commands_for_player: list[Command], 
                              player_client_id: int,
@@ -839,11 +1168,12 @@ def _run_commands_for_player(starting_time: datetime, player: Optional[Player],
                              *,
                              client_id: Optional[int],
                              end_time: Optional[datetime] = None,
-                             game_name: Optional[str] = None) -> Optional[Player]:
+                             game_name: Optional[str] = None,
+                             spawned_projectiles: Optional[list[tuple[Projectile, datetime]]] = None) -> Optional[Player]:
     if end_time is None:
         end_time = datetime.now()
     current_time = starting_time
-    raw_commands_by_projectile = get_commands_by_projectile(client_id=client_id, game_name=game_name)    
+    commands_by_projectile: Optional[CommandLog] = None
     for command in commands_for_player:
         if player is None and command.type != CommandType.SPAWN:
             continue
@@ -870,10 +1200,13 @@ def _run_commands_for_player(starting_time: datetime, player: Optional[Player],
             assert command.data is not None
             projectile: Optional[Projectile] = Projectile.from_json(command.data)
             assert projectile
-            projectile_id = projectile.id            
-            raw_commands_for_projectile = raw_commands_by_projectile.get(projectile_id) or []
-            commands_for_projectile = sorted([Command.from_json(json.loads(c)) for c in raw_commands_for_projectile], 
-                                        key=lambda c: c.time)            
+            if spawned_projectiles is not None:
+                spawned_projectiles.append((projectile, command.time))
+                current_time = command.time
+                continue
+            if commands_by_projectile is None:
+                commands_by_projectile = get_commands_by_projectile(client_id=client_id, game_name=game_name)
+            commands_for_projectile = commands_by_projectile.get(projectile.id)
             projectile = _run_commands_for_projectile(command.time, projectile, commands_for_projectile, projectile.id, end_time)
             if projectile and projectile.id not in [p.id for p in all_projectiles]:
                 all_projectiles.append(projectile)
@@ -910,20 +1243,24 @@ def lists_are_equal(l1: list[str], l2: list[str]) -> bool:
     return True
 
 
+# The closest snapshot at or before end_time, since everything after the snapshot has to be replayed. A snapshot is
+# only taken once no more commands can arrive from before its time, so it's always safe to start from.
+def _get_raw_snap_to_run_forward_from(*, end_time: datetime, client_id: Optional[int], game_name: Optional[str]) -> str:
+    if client_id is not None:
+        raw_snap = game_state_snapshots.at_or_before(end_time)
+    else:
+        assert game_name is not None
+        raw_snap = rring_at_or_before('game_state_snapshots', datetime.timestamp(end_time), game_name=game_name)
+    return raw_snap or json.dumps(GameState([], [], time=datetime.now() - timedelta(seconds=2)).to_json())
+
+
 def infer_game_state(*, end_time: Optional[datetime] = None, client_id: Optional[int] = None, game_name: Optional[str] = None) -> GameState:
     if end_time is None:
         end_time = datetime.now()
-    raw_snaps = get_game_state_snapshots(client_id=client_id, game_name=game_name)
-    assert len(raw_snaps) > 0
-    if client_id is not None:
-        raw_snap_to_run_forward_from = raw_snaps[-1]
-    else:
-        raw_snap_to_run_forward_from = raw_snaps[0]
+    raw_snap_to_run_forward_from = _get_raw_snap_to_run_forward_from(end_time=end_time, client_id=client_id, game_name=game_name)
     snap_to_run_forward_from = GameState.from_json(json.loads(raw_snap_to_run_forward_from))
-    raw_commands_by_player = get_commands_by_player(client_id=client_id, game_name=game_name)
-    raw_commands_by_projectile = get_commands_by_projectile(client_id=client_id, game_name=game_name)
-    # if client_id is not None and game_name is None:
-    #     print(raw_commands_by_player[client_id])
+    commands_by_player = get_commands_by_player(client_id=client_id, game_name=game_name)
+    commands_by_projectile = get_commands_by_projectile(client_id=client_id, game_name=game_name)
     player_ids_commands_have_been_run_for: set[int] = set()
     final_players: list[Player] = []
     player: Optional[Player] = None
@@ -932,9 +1269,7 @@ def infer_game_state(*, end_time: Optional[datetime] = None, client_id: Optional
     for projectile in snap_to_run_forward_from.projectiles:
         assert projectile is not None
         projectile_id = projectile.id
-        raw_commands_for_projectile = raw_commands_by_projectile.get(projectile_id) or []
-        commands_for_projectile = sorted([Command.from_json(json.loads(c)) for c in raw_commands_for_projectile], 
-                                     key=lambda c: c.time)
+        commands_for_projectile = commands_by_projectile.get(projectile_id)
         new_projectile = _run_commands_for_projectile(snap_to_run_forward_from.time, projectile.copy(), commands_for_projectile, 
                                                   projectile_id, end_time=end_time)
         if new_projectile and new_projectile.id not in [p.id for p in all_projectiles]:
@@ -945,20 +1280,16 @@ def infer_game_state(*, end_time: Optional[datetime] = None, client_id: Optional
         player_client_id = player.client_id
         player_number = player.player_number
         player_ids_commands_have_been_run_for.add(player_client_id)
-        raw_commands_for_player = raw_commands_by_player.get(player_client_id) or []
-        commands_for_player = sorted([Command.from_json(json.loads(c)) for c in raw_commands_for_player], 
-                                     key=lambda c: c.time)
+        commands_for_player = commands_by_player.get(player_client_id)
         player = _run_commands_for_player(snap_to_run_forward_from.time, player.copy(), commands_for_player, player_client_id, player_number,
                                           all_projectiles, client_id=client_id, end_time=end_time, game_name=game_name)
         if player:
             final_players.append(player)
 
-    for player_client_id, raw_commands_for_player in raw_commands_by_player.items():
+    for player_client_id, commands_for_player in commands_by_player.items():
         if player_client_id in player_ids_commands_have_been_run_for:
             continue
         player_ids_commands_have_been_run_for.add(player_client_id)
-        commands_for_player = sorted([Command.from_json(json.loads(c)) for c in raw_commands_for_player], 
-                                     key=lambda c: c.time)        
         player_number = get_player_number_from_client_id(player_client_id, client_id=client_id, game_name=game_name)                                     
         player = _run_commands_for_player(snap_to_run_forward_from.time, None, commands_for_player, player_client_id, player_number,
                                           all_projectiles, client_id=client_id, end_time=end_time, game_name=game_name)
@@ -968,19 +1299,239 @@ def infer_game_state(*, end_time: Optional[datetime] = None, client_id: Optional
     return GameState(players=final_players, projectiles=all_projectiles, time=end_time)
 
 
-num_snaps_inferred = 0
+class GameSimulator:
+    """
+    Infers the game state the same way infer_game_state does, but remembers where it got to last time, so that
+    each call only has to run the commands that have been added to the command logs since then.
+
+    For every entity we keep an anchor: its state as of the last command that was run for it. Movement is always
+    integrated from the anchor in one step (exactly as a full replay would), so the result matches infer_game_state.
+    We only replay everything from the snapshot when the snapshot changes or when we're asked about an earlier time
+    than before. A command that lands at or before the last time we inferred (as remote commands nearly always do,
+    having come over the network) only rewinds the player it's for, who gets replayed from the snapshot on their own.
+    """
+
+    def __init__(self) -> None:
+        self._client_id: Optional[int] = None
+        self._game_name: Optional[str] = None
+        self._raw_snap: Optional[str] = None
+        self._snap_time = datetime.now()
+        self._end_time: Optional[datetime] = None
+        self._snap_players: dict[int, Player] = {}
+        self._player_anchors: dict[int, tuple[Optional[Player], datetime]] = {}
+        self._projectile_anchors: dict[int, tuple[Projectile, datetime]] = {}
+        # The projectiles each player has spawned since the snapshot, which go if the player gets rewound
+        self._projectiles_spawned_by: dict[int, set[int]] = {}
+        self._player_numbers: dict[int, int] = {}
+        self._commands_by_player: Optional[CommandLog] = None
+        self._commands_by_projectile: Optional[CommandLog] = None
+        self._commands_by_player_cursor = 0
+        self._commands_by_projectile_cursor = 0
+        # Commands we've read from the logs that aren't due yet
+        self._pending_player_commands: list[tuple[int, Command]] = []
+        self._pending_projectile_commands: list[tuple[int, Command]] = []
+        # The anchors as arrays, when there are enough entities to be worth moving all at once. Rebuilt whenever the
+        # anchors change.
+        self._player_arrays: Optional[PlayerArrays] = None
+        self._projectile_arrays: Optional[ProjectileArrays] = None
+        self._arrays_are_stale = True
+
+    def _reset(self, raw_snap: str, commands_by_player: CommandLog, commands_by_projectile: CommandLog) -> None:
+        snap = GameState.from_json(json.loads(raw_snap))
+        self._raw_snap = raw_snap
+        self._snap_time = snap.time
+        self._end_time = None
+        self._snap_players = {player.client_id: player for player in snap.players}
+        self._player_anchors = {player.client_id: (player.copy(), snap.time) for player in snap.players}
+        self._projectile_anchors = {projectile.id: (projectile, snap.time) for projectile in snap.projectiles}
+        self._projectiles_spawned_by = {}
+        self._player_numbers = {player.client_id: player.player_number for player in snap.players}
+        self._commands_by_player = commands_by_player
+        self._commands_by_projectile = commands_by_projectile
+        self._pending_player_commands, self._commands_by_player_cursor = commands_by_player.read_all()
+        self._pending_projectile_commands, self._commands_by_projectile_cursor = commands_by_projectile.read_all()
+        self._arrays_are_stale = True
+
+    # Returns False if one of the logs has been trimmed past our cursor
+    def _read_new_commands(self) -> bool:
+        assert self._commands_by_player is not None and self._commands_by_projectile is not None
+        new_player_commands = self._commands_by_player.read_since(self._commands_by_player_cursor)
+        new_projectile_commands = self._commands_by_projectile.read_since(self._commands_by_projectile_cursor)
+        if new_player_commands is None or new_projectile_commands is None:
+            return False
+        self._pending_player_commands.extend(new_player_commands[0])
+        self._commands_by_player_cursor = new_player_commands[1]
+        self._pending_projectile_commands.extend(new_projectile_commands[0])
+        self._commands_by_projectile_cursor = new_projectile_commands[1]
+        return True
+
+    # Splits the pending commands into the ones due by end_time (grouped by entity and sorted by time) and the ones
+    # that are still pending, along with the entities that have a command that should already have been run by the
+    # last inference
+    def _take_due_commands(self, pending_commands: list[tuple[int, Command]], 
+                           end_time: datetime) -> tuple[dict[int, list[Command]], list[tuple[int, Command]], set[int]]:
+        due_commands_by_entity: dict[int, list[Command]] = {}
+        still_pending_commands: list[tuple[int, Command]] = []
+        late_entity_ids: set[int] = set()
+        for entity_id, command in pending_commands:
+            if command.time > end_time:
+                still_pending_commands.append((entity_id, command))
+            elif command.time >= self._snap_time:
+                if self._end_time is not None and command.time <= self._end_time:
+                    late_entity_ids.add(entity_id)
+                due_commands_by_entity.setdefault(entity_id, []).append(command)
+        for commands in due_commands_by_entity.values():
+            commands.sort(key=lambda c: c.time)
+        return due_commands_by_entity, still_pending_commands, late_entity_ids
+
+    def _advance_player(self, player_client_id: int, commands_for_player: list[Command], end_time: datetime, *, 
+                        client_id: Optional[int], game_name: Optional[str]) -> None:
+        player, anchor_time = self._player_anchors.get(player_client_id) or (None, self._snap_time)
+        if player_client_id not in self._player_numbers:
+            self._player_numbers[player_client_id] = get_player_number_from_client_id(player_client_id, client_id=client_id, game_name=game_name)
+        spawned_projectiles: list[tuple[Projectile, datetime]] = []
+        last_command_time = commands_for_player[-1].time
+        player = _run_commands_for_player(anchor_time, player, commands_for_player, player_client_id, 
+                                          self._player_numbers[player_client_id], [], client_id=client_id, 
+                                          end_time=last_command_time, game_name=game_name, 
+                                          spawned_projectiles=spawned_projectiles)
+        self._player_anchors[player_client_id] = (player, last_command_time)
+        assert self._commands_by_projectile is not None
+        for projectile, spawned_at in spawned_projectiles:
+            if projectile.id in self._projectile_anchors:
+                continue
+            # A rewound player can spawn a projectile whose removal we've already been through
+            if any(command.type == CommandType.REMOVE_PROJECTILE and spawned_at <= command.time <= end_time
+                   for command in self._commands_by_projectile.get(projectile.id)):
+                continue
+            self._projectile_anchors[projectile.id] = (projectile, spawned_at)
+            self._projectiles_spawned_by.setdefault(player_client_id, set()).add(projectile.id)
+
+    # Replays a single player from the snapshot, with every command of theirs up to end_time, including the ones that
+    # have already been run
+    def _rewind_player(self, player_client_id: int, end_time: datetime, *, client_id: Optional[int], 
+                       game_name: Optional[str]) -> None:
+        assert self._commands_by_player is not None
+        for projectile_id in self._projectiles_spawned_by.pop(player_client_id, set()):
+            self._projectile_anchors.pop(projectile_id, None)
+        snap_player = self._snap_players.get(player_client_id)
+        if snap_player is None:
+            self._player_anchors.pop(player_client_id, None)
+        else:
+            self._player_anchors[player_client_id] = (snap_player.copy(), self._snap_time)
+        commands_for_player = [command for command in self._commands_by_player.get(player_client_id) 
+                               if self._snap_time <= command.time <= end_time]
+        if commands_for_player:
+            self._advance_player(player_client_id, commands_for_player, end_time, client_id=client_id, game_name=game_name)
+
+    def _advance_players(self, due_commands_by_player: dict[int, list[Command]], late_player_ids: set[int], 
+                         end_time: datetime, *, client_id: Optional[int], game_name: Optional[str]) -> None:
+        for player_client_id, commands_for_player in due_commands_by_player.items():
+            if player_client_id in late_player_ids:
+                self._rewind_player(player_client_id, end_time, client_id=client_id, game_name=game_name)
+            else:
+                self._advance_player(player_client_id, commands_for_player, end_time, client_id=client_id, game_name=game_name)
+
+    # Late projectile commands don't need a rewind: removing a projectile any time before now leaves it removed now
+    def _advance_projectiles(self, due_commands_by_projectile: dict[int, list[Command]]) -> None:
+        for projectile_id, commands_for_projectile in due_commands_by_projectile.items():
+            if projectile_id not in self._projectile_anchors:
+                continue
+            _, anchor_time = self._projectile_anchors[projectile_id]
+            if any(command.type == CommandType.REMOVE_PROJECTILE and command.time >= anchor_time for command in commands_for_projectile):
+                del self._projectile_anchors[projectile_id]
+
+    def infer_game_state(self, *, end_time: Optional[datetime] = None, client_id: Optional[int] = None, 
+                         game_name: Optional[str] = None) -> GameState:
+        if end_time is None:
+            end_time = datetime.now()
+        raw_snap = _get_raw_snap_to_run_forward_from(end_time=end_time, client_id=client_id, game_name=game_name)
+        commands_by_player = get_commands_by_player(client_id=client_id, game_name=game_name)
+        commands_by_projectile = get_commands_by_projectile(client_id=client_id, game_name=game_name)
+        if (raw_snap != self._raw_snap or (client_id, game_name) != (self._client_id, self._game_name)
+                or commands_by_player is not self._commands_by_player or commands_by_projectile is not self._commands_by_projectile
+                or (self._end_time is not None and end_time < self._end_time)):
+            self._client_id = client_id
+            self._game_name = game_name
+            self._reset(raw_snap, commands_by_player, commands_by_projectile)
+        elif not self._read_new_commands():
+            self._reset(raw_snap, commands_by_player, commands_by_projectile)
+
+        due_commands_by_player, self._pending_player_commands, late_player_ids = self._take_due_commands(
+            self._pending_player_commands, end_time)
+        due_commands_by_projectile, self._pending_projectile_commands, _ = self._take_due_commands(
+            self._pending_projectile_commands, end_time)
+        if due_commands_by_player or due_commands_by_projectile:
+            self._arrays_are_stale = True
+
+        self._advance_players(due_commands_by_player, late_player_ids, end_time, client_id=client_id, game_name=game_name)
+        self._advance_projectiles(due_commands_by_projectile)
+        self._end_time = end_time
+
+        if self._arrays_are_stale:
+            self._rebuild_arrays()
+        return GameState(players=self._move_players(end_time), projectiles=self._move_projectiles(end_time), time=end_time)
+
+    # Every entity's anchor as of the last inference
+    def authoritative_state(self) -> AuthoritativeState:
+        assert self._end_time is not None
+        return AuthoritativeState(self._end_time, 
+                                  {client_id: (player, anchor_time) for client_id, (player, anchor_time) in self._player_anchors.items()
+                                   if player is not None},
+                                  dict(self._projectile_anchors))
+
+    def _rebuild_arrays(self) -> None:
+        player_anchors = [(player, anchor_time) for player, anchor_time in self._player_anchors.values() if player is not None]
+        self._player_arrays = (PlayerArrays([player for player, _ in player_anchors], [anchor_time for _, anchor_time in player_anchors])
+                               if len(player_anchors) >= MIN_BATCH_SIZE and all(can_move_in_batch(player) for player, _ in player_anchors)
+                               else None)
+        projectile_anchors = list(self._projectile_anchors.values())
+        self._projectile_arrays = (ProjectileArrays([projectile for projectile, _ in projectile_anchors], 
+                                                    [anchor_time for _, anchor_time in projectile_anchors])
+                                   if len(projectile_anchors) >= MIN_BATCH_SIZE and all(can_move_in_batch(projectile) for projectile, _ in projectile_anchors)
+                                   else None)
+        self._arrays_are_stale = False
+
+    def _move_players(self, end_time: datetime) -> list[Player]:
+        players: list[Player] = []
+        for player, anchor_time in self._player_anchors.values():
+            if player is not None:
+                player = player.copy()
+                if self._player_arrays is None:
+                    _move_player(player, prev_time=anchor_time, next_time=end_time)
+                players.append(player)
+        if self._player_arrays is not None:
+            for player, x, y in zip(players, *self._player_arrays.positions_at(end_time)):
+                player.x = x
+                player.y = y
+        return players
+
+    def _move_projectiles(self, end_time: datetime) -> list[Projectile]:
+        projectile_anchors = list(self._projectile_anchors.items())
+        positions = (self._projectile_arrays.positions_at(end_time) if self._projectile_arrays is not None 
+                     else [None] * len(projectile_anchors))
+        projectiles: list[Projectile] = []
+        for (projectile_id, (anchor_projectile, anchor_time)), position in zip(projectile_anchors, positions):
+            projectile: Optional[Projectile] = anchor_projectile.copy()
+            if self._projectile_arrays is None:
+                projectile = _move_projectile(projectile, prev_time=anchor_time, next_time=end_time)
+            elif position is None:
+                projectile = None
+            else:
+                assert projectile is not None
+                projectile.x, projectile.y = position
+            if projectile is None:
+                # Projectiles only ever get closer to their destination, so this one is gone for good
+                del self._projectile_anchors[projectile_id]
+                self._arrays_are_stale = True
+            else:
+                projectiles.append(projectile)
+        return projectiles
+
 
-        
 def infer_and_store_game_state_snap(game_name: str) -> None:
-    global num_snaps_inferred
-    num_snaps_inferred += 1
-    game_state_snapshots: list[str] = get_game_state_snapshots(game_name=game_name)
     new_snapshot = infer_game_state(client_id=None, end_time=datetime.now() - timedelta(seconds=3), game_name=game_name)
     # print(f'New snapshot: {new_snapshot.to_json()}')
-    game_state_snapshots.append(json.dumps(new_snapshot.to_json()))
-    if num_snaps_inferred % 8 == 0:
-        print(f'Culling snapshots: {len(game_state_snapshots)}')
-        game_state_snapshots = [s for s in game_state_snapshots if datetime.now() - datetime.fromtimestamp(json.loads(s)['time']) < timedelta(seconds=7)]
-        print(f'Culling snapshots: {len(game_state_snapshots)}')        
-    rset('game_state_snapshots', json.dumps(game_state_snapshots), client_id=None, game_name=game_name)
-    rset('most_recent_game_state_snapshot', json.dumps(new_snapshot.to_json()), client_id=None, game_name=game_name)
+    raw_new_snapshot = json.dumps(new_snapshot.to_json())
+    store_game_state_snapshot(raw_new_snapshot, new_snapshot.time, game_name=game_name)
+    rset('most_recent_game_state_snapshot', raw_new_snapshot, client_id=None, game_name=game_name)
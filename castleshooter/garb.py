@@ -1,8 +1,8 @@
 from datetime import timedelta
-from typing import Any
+from typing import Any, Optional
 
 from enum import Enum
-import pygame
+from asset_cache import asset_cache
 
 
 DAGGER_RANGE = 100
@@ -13,11 +13,11 @@ class Garb(Enum):
     ARMOR = 'armor'
 
 
-def garb_to_pygame_image(garb: Garb) -> Any:
+def garb_to_pygame_image(garb: Garb, size: Optional[tuple[int, int]] = None) -> Any:
     if garb == Garb.BOOTS:
-        return pygame.image.load('assets/boots.png')
+        return asset_cache.image('assets/boots.png', size)
     elif garb == Garb.ARMOR:
-        return pygame.image.load('assets/armor.png')
+        return asset_cache.image('assets/armor.png', size)
     else:
         raise Exception('Not implemented')
 
@@ -2,9 +2,8 @@ from typing import Any, Optional
 
 from enum import Enum
 from typing import TYPE_CHECKING
-import pygame
 import json
-from redis_utils import rget, rset
+from client_utils import client_state
 from weapon import weapon_to_pygame_image, Weapon
 from garb import garb_to_pygame_image, Garb
 if TYPE_CHECKING:
@@ -35,20 +34,15 @@ class Item:
         self.category = category
         self.type = type
 
-    def draw(self, canvas: Any, x_offset: int, y_offset: int) -> None:
+    def draw(self, canvas: Any, x_offset: int, y_offset: int) -> Any:
         if self.category == ItemCategory.WEAPON:
-            image_surface = pygame.transform.scale(weapon_to_pygame_image(Weapon(self.type.value)), (50, 50)).convert_alpha()
+            image_surface = weapon_to_pygame_image(Weapon(self.type.value), (50, 50))
         elif self.category == ItemCategory.GARB:
-            image_surface = pygame.transform.scale(garb_to_pygame_image(Garb(self.type.value)), (50, 50)).convert_alpha()
+            image_surface = garb_to_pygame_image(Garb(self.type.value), (50, 50))
         else:
             raise Exception('Not implemented')
-        canvas.blit(image_surface, (self.x - x_offset - 25, self.y - y_offset - 25))        
-
-
-NEXT_ITEM_ID_REDIS_KEY = 'next_item_id'
+        return canvas.blit(image_surface, (self.x - x_offset - 25, self.y - y_offset - 25))        
 
 
 def generate_next_item_id(*, client_id: Optional[int]) -> int:
-    next_item_id = int(rget(NEXT_ITEM_ID_REDIS_KEY, client_id=client_id) or '0')
-    rset(NEXT_ITEM_ID_REDIS_KEY, next_item_id + 1, client_id=client_id)
-    return next_item_id
+    return client_state.next_item_id()
@@ -0,0 +1,242 @@
+import asyncio
+from bisect import bisect_left, bisect_right
+from contextlib import asynccontextmanager, contextmanager
+from queue import Queue
+from threading import Lock, RLock
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Mapping, Optional, Union
+
+from storage_backend import BatchOp, StorageBackend
+
+
+Message = tuple[str, Optional[str]]
+
+
+class _SortedSet:
+    """
+    A sorted set the way redis orders one, by score and then by member. Scores and members are kept as parallel lists
+    in that order, the way SnapshotRing keeps its snapshots, so adding a member and finding the members at or before a
+    score are binary searches rather than sorts, and trimming the lowest-scored members is one slice.
+    """
+
+    def __init__(self) -> None:
+        self._scores: list[float] = []
+        self._members: list[Any] = []
+        self._score_by_member: dict[Any, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def members(self) -> list[Any]:
+        return list(self._members)
+
+    def score(self, member: Any) -> Optional[float]:
+        return self._score_by_member.get(member)
+
+    def _index(self, member: Any, score: float) -> int:
+        return bisect_left(self._members, member, bisect_left(self._scores, score), bisect_right(self._scores, score))
+
+    # Moves the member to its new score if it's already in the set. Returns whether it was new.
+    def add(self, member: Any, score: float) -> bool:
+        old_score = self._score_by_member.get(member)
+        if old_score == score:
+            return False
+        if old_score is not None:
+            index = self._index(member, old_score)
+            del self._scores[index]
+            del self._members[index]
+        index = self._index(member, score)
+        self._scores.insert(index, score)
+        self._members.insert(index, member)
+        self._score_by_member[member] = score
+        return old_score is None
+
+    def _remove_lowest(self, count: int) -> None:
+        for member in self._members[:count]:
+            del self._score_by_member[member]
+        del self._scores[:count]
+        del self._members[:count]
+
+    def trim_before(self, score: float) -> None:
+        self._remove_lowest(bisect_left(self._scores, score))
+
+    def trim_to(self, capacity: int) -> None:
+        self._remove_lowest(max(len(self._members) - capacity, 0))
+
+    # The last member at or below score, or the lowest one if they're all above it
+    def at_or_before(self, score: float) -> Optional[Any]:
+        if not self._members:
+            return None
+        return self._members[max(bisect_right(self._scores, score) - 1, 0)]
+
+
+class MemoryBackend(StorageBackend):
+    """
+    Keeps everything in this process's memory, for when one server process is all there is: no network hops, no
+    serialization, and nothing to run alongside it. One lock makes every operation (and every batch) atomic, pub/sub
+    hands messages straight to the listening threads' queues, and locks are plain thread locks.
+
+    Logs and rings are _SortedSets, which stay sorted as they're written, so reading one never has to sort it.
+    """
+
+    def __init__(self) -> None:
+        self._lock = RLock()
+        self._values: dict[str, str] = {}
+        self._sorted_sets: dict[str, _SortedSet] = {}
+        self._subscribers: dict[str, list[Union[Queue[Message], tuple[asyncio.Queue[Message], asyncio.AbstractEventLoop]]]] = {}
+        self._key_locks: dict[str, Lock] = {}
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._values.get(key)
+
+    def mget(self, keys: list[str]) -> list[Optional[str]]:
+        with self._lock:
+            return [self._values.get(key) for key in keys]
+
+    def set_and_publish(self, key: str, value: str) -> bool:
+        with self._lock:
+            self.publish(key, value)
+            self._values[key] = value
+        return True
+
+    def mset_and_publish(self, values: Mapping[str, str]) -> None:
+        with self._lock:
+            for key, value in values.items():
+                self.publish(key, value)
+            self._values.update(values)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            value = int(self._values.get(key) or 0) + 1
+            self._values[key] = str(value)
+            return value
+
+    def publish(self, channel: str, value: Optional[str]) -> int:
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel) or [])
+        for subscriber in subscribers:
+            if isinstance(subscriber, Queue):
+                subscriber.put((channel, value))
+            else:
+                queue, loop = subscriber
+                loop.call_soon_threadsafe(queue.put_nowait, (channel, value))
+        return len(subscribers)
+
+    def set(self, key: str, value: str) -> bool:
+        with self._lock:
+            self._values[key] = value
+        return True
+
+    def mset(self, values: Mapping[str, str]) -> bool:
+        with self._lock:
+            self._values.update(values)
+        return True
+
+    # Every batch is a transaction, since everything happens under the one lock
+    def run_batch(self, ops: list[BatchOp], *, transaction: bool) -> list[Any]:
+        with self._lock:
+            return [self._run_batch_op(op, args) for op, args in ops]
+
+    def _run_batch_op(self, op: str, args: tuple[Any, ...]) -> Any:
+        if op == 'log_append':
+            *log_append_args, trim_before = args
+            return self.log_append(*log_append_args, trim_before=trim_before)
+        return getattr(self, op)(*args)
+
+    def log_append(self, log_key: str, index_key: str, entity_id: int, entries: Mapping[bytes, float], *,
+                   trim_before: float) -> int:
+        with self._lock:
+            log = self._sorted_sets.setdefault(log_key, _SortedSet())
+            num_added = sum(log.add(entry, entry_time) for entry, entry_time in entries.items())
+            self._trim_before(log_key, trim_before)
+            index = self._sorted_sets.setdefault(index_key, _SortedSet())
+            latest_time = max(entries.values())
+            index_time = index.score(entity_id)
+            if index_time is None or index_time <= latest_time:
+                index.add(entity_id, latest_time)
+            self._trim_before(index_key, trim_before)
+            if num_added > 0:
+                self.publish(index_key, str(entity_id))
+            return num_added
+
+    def _trim_before(self, key: str, trim_before: float) -> None:
+        sorted_set = self._sorted_sets[key]
+        sorted_set.trim_before(trim_before)
+        if not sorted_set:
+            del self._sorted_sets[key]
+
+    def _sorted_members(self, key: str) -> list[Any]:
+        sorted_set = self._sorted_sets.get(key)
+        return sorted_set.members() if sorted_set is not None else []
+
+    def log_read(self, index_key: str, log_key_for: Callable[[int], str]) -> dict[int, list[bytes]]:
+        with self._lock:
+            entries_by_entity_id = {entity_id: self._sorted_members(log_key_for(entity_id)) for entity_id in self._sorted_members(index_key)}
+        return {entity_id: entries for entity_id, entries in entries_by_entity_id.items() if entries}
+
+    def ring_push(self, key: str, value: str, score: float, *, capacity: int) -> None:
+        with self._lock:
+            ring = self._sorted_sets.setdefault(key, _SortedSet())
+            ring.add(value, score)
+            ring.trim_to(capacity)
+
+    def ring_at_or_before(self, key: str, score: float) -> Optional[str]:
+        with self._lock:
+            ring = self._sorted_sets.get(key)
+            return ring.at_or_before(score) if ring is not None else None
+
+    def _subscribe(self, channels: list[str], subscriber: Union[Queue[Message], tuple[asyncio.Queue[Message], asyncio.AbstractEventLoop]]) -> None:
+        with self._lock:
+            for channel in channels:
+                self._subscribers.setdefault(channel, []).append(subscriber)
+
+    def _unsubscribe(self, channels: list[str], subscriber: Union[Queue[Message], tuple[asyncio.Queue[Message], asyncio.AbstractEventLoop]]) -> None:
+        with self._lock:
+            for channel in channels:
+                self._subscribers[channel].remove(subscriber)
+
+    def listen(self, channels: list[str], callback: Callable[[str, Optional[str]], None],
+               break_when: Optional[Callable[[], bool]] = None) -> None:
+        queue: Queue[Message] = Queue()
+        self._subscribe(channels, queue)
+        try:
+            while True:
+                callback(*queue.get())
+                if break_when is not None and break_when():
+                    break
+        finally:
+            self._unsubscribe(channels, queue)
+
+    def _key_lock(self, key: str) -> Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, Lock())
+
+    @contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        with self._key_lock(key):
+            yield
+
+    def flushall(self) -> None:
+        with self._lock:
+            self._values.clear()
+            self._sorted_sets.clear()
+
+    # Has to be called from the event loop that will run the callback
+    async def alisten(self, channels: list[str], callback: Callable[[str, Optional[str]], Awaitable[None]]) -> None:
+        subscriber = (asyncio.Queue[Message](), asyncio.get_running_loop())
+        self._subscribe(channels, subscriber)
+        try:
+            while True:
+                await callback(*await subscriber[0].get())
+        finally:
+            self._unsubscribe(channels, subscriber)
+
+    # Waiting for the lock happens on the default executor, so that it doesn't hold up the event loop
+    @asynccontextmanager
+    async def alock(self, key: str) -> AsyncIterator[None]:
+        lock = self._key_lock(key)
+        await asyncio.to_thread(lock.acquire)
+        try:
+            yield
+        finally:
+            lock.release()
@@ -0,0 +1,147 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from time import perf_counter
+from typing import Iterator, Optional
+from _thread import start_new_thread
+
+
+# Upper bounds, in seconds, of the buckets every histogram counts observations into
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Everything the server records, and what it means. Anything recorded has to be in one of these.
+COUNTERS = {
+    'packets_received_total': 'Packets received from clients, by game',
+    'commands_received_total': 'Commands received from clients, by game',
+    'packets_sent_total': 'Packets sent, acks included, not counting digests',
+    'bytes_sent_total': 'Bytes sent, not counting digests',
+    'bytes_received_total': 'Bytes received',
+    'packet_resends_total': 'Packets sent again because no ack came in time',
+    'packets_unacked_total': 'Packets that were never acked, after every attempt',
+    'digests_sent_total': 'Digests handed to subscribers to send, by game',
+    'digest_bytes_total': 'Bytes of digests handed to subscribers to send, by game',
+}
+HISTOGRAMS = {
+    'ack_rtt_seconds': 'Time from sending a packet to getting its ack, for packets acked on the first attempt',
+    'storage_op_seconds': 'Time taken by each storage operation, by op',
+    'lock_wait_seconds': 'Time spent waiting for a storage lock, by key',
+    'snapshot_inference_seconds': 'Time taken to infer and store a game state snapshot, by game',
+    'simulation_tick_seconds': 'Time taken by a server simulation tick, by game',
+    'digest_build_seconds': 'Time taken to build and encode a tick of digests for every subscriber, by game',
+}
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, extra: Optional[tuple[str, str]] = None) -> str:
+    pairs = [*labels, extra] if extra is not None else list(labels)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+class Histogram:
+    """
+    How many observations fell into each of DURATION_BUCKETS (and above the last one), along with their count and
+    sum, so that percentiles and means can be worked out from them later.
+    """
+
+    def __init__(self) -> None:
+        self.bucket_counts = [0] * (len(DURATION_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect_left(DURATION_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """
+    Counters and histograms for the server, each kept separately for every set of labels (game, op and so on) it's
+    recorded with. They only ever go up, from when the server started, and are read in the Prometheus text format
+    from the endpoint serve_metrics starts. Recording one is a dict update under a lock, so it can go anywhere.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._counters: dict[tuple[str, Labels], float] = {}
+        self._histograms: dict[tuple[str, Labels], Histogram] = {}
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        assert name in COUNTERS, name
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        assert name in HISTOGRAMS, name
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if (histogram := self._histograms.get(key)) is None:
+                histogram = Histogram()
+                self._histograms[key] = histogram
+            histogram.observe(value)
+
+    # Observes how long the block took, in seconds, awaits inside it included
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        started_at = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - started_at, **labels)
+
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(histogram.bucket_counts), histogram.count, histogram.sum)
+                          for key, histogram in self._histograms.items()}
+        lines: list[str] = []
+        for name, help in COUNTERS.items():
+            lines.extend([f'# HELP {name} {help}', f'# TYPE {name} counter'])
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append(f'{name}{_format_labels(labels)} {value:g}')
+        for name, help in HISTOGRAMS.items():
+            lines.extend([f'# HELP {name} {help}', f'# TYPE {name} histogram'])
+            for (histogram_name, labels), (bucket_counts, count, total) in sorted(histograms.items()):
+                if histogram_name != name:
+                    continue
+                cumulative_count = 0
+                for bound, bucket_count in zip([*map(str, DURATION_BUCKETS), '+Inf'], bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append(f'{name}_bucket{_format_labels(labels, ("le", bound))} {cumulative_count}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {total:g}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes would otherwise print a line each
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+# Serves the metrics at http://localhost:<port>/metrics on a thread of its own. Only listens on localhost, so it's
+# only reachable from the machine the server is on.
+def serve_metrics(port: int) -> ThreadingHTTPServer:
+    http_server = ThreadingHTTPServer(('localhost', port), _MetricsRequestHandler)
+    start_new_thread(http_server.serve_forever, ())
+    return http_server
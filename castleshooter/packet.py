@@ -1,23 +1,60 @@
-from contextlib import nullcontext
+import asyncio
 from datetime import datetime
 from decimal import Decimal
+from enum import Enum
+from itertools import count
 import random
-from typing import Any, Optional
+import struct
+from threading import Lock
+from typing import Any, Iterator, Optional
+from weakref import WeakKeyDictionary
 import zlib
 import gevent
 from team import Team
 from death_reason import DeathReason
 from projectile import ProjectileType
-from settings import TEST_LAG, DROP_CHANCE
+from settings import TEST_LAG, DROP_CHANCE, USE_BINARY_PACKETS
 from direction import Direction
-from command import Command, CommandType, store_command
-from redis_utils import redis_lock, rget, rset, rlisten
-from utils import to_optional_int
-from time import sleep
+from command import Command, CommandType, encode_command, store_command
+from client_utils import client_state
+from redis_utils import rlisten
+from utils import LOG_CUTOFF, to_optional_int
+from ack_registry import MAX_ACK_TIMEOUT, RttEstimator, pending_acks
+from metrics import metrics
+from time import monotonic, sleep, time
 import json
 from _thread import start_new_thread
 
 
+class PacketFormat(Enum):
+    # id||client_id||key|data; packets, zlib-compressed a whole message at a time
+    TEXT = 'text'
+    # Packets with a struct-packed header, see Packet.to_bytes
+    BINARY = 'binary'
+
+
+BINARY_PACKET_VERSION = 1
+# version, packet type and flags, packet id, client id, payload key code. The version byte doubles as the marker that
+# tells a binary message apart from a zlib-compressed text one, since zlib data never starts with it. The payload's
+# data is whatever's left of the frame after the key.
+_BINARY_PACKET_HEADER = struct.Struct('!BBIIB')
+_BINARY_PACKET_TYPE_DATA = 0
+_BINARY_PACKET_TYPE_ACK = 1
+_BINARY_PACKET_FLAG_HAS_DATA = 0x10
+_BINARY_PACKET_FLAG_COMPRESSED = 0x20
+_BINARY_PACKET_NO_ID = 0xFFFFFFFF
+# Payload keys that get sent often enough to be worth a one-byte code; any other key is sent as a length-prefixed
+# string after the header instead. Only ever append to this list, since both ends need to agree on it.
+BINARY_PAYLOAD_KEYS = [
+    'command', 'all_commands_heartbeat', 'digest_ack', 'all_info_digest', 'active_players', 'game_names', 'client_id',
+    'join_game', 'leave_game', 'host_game', 'start_game', 'packet_format',
+]
+_BINARY_PAYLOAD_KEY_CODES = {key: code for code, key in enumerate(BINARY_PAYLOAD_KEYS)}
+_BINARY_PAYLOAD_KEY_LITERAL = 0xFF
+# Compressing anything smaller than this is never worth it
+BINARY_PACKET_COMPRESSION_THRESHOLD = 64
+
+
 class Packet:
     # Packets with a None id do not need an ack
     def __init__(self, *, id: Optional[int] = None, 
@@ -52,94 +89,278 @@ class Packet:
             packet_id, client_id, payload = packet_str.split('||')
             return Packet(id=int(packet_id), client_id=to_optional_int(client_id), payload=payload)
 
+    # The payload's key and data are stored separately, so reading them back never has to split a string, and the
+    # data is only compressed when that actually makes it smaller
+    def to_bytes(self) -> bytes:
+        packet_type_and_flags = _BINARY_PACKET_TYPE_ACK if self.is_ack else _BINARY_PACKET_TYPE_DATA
+        key, data = '', b''
+        if self.payload is not None:
+            key, separator, raw_data = self.payload.partition('|')
+            data = bytes(raw_data, 'utf-8')
+            if separator:
+                packet_type_and_flags |= _BINARY_PACKET_FLAG_HAS_DATA
+        if len(data) >= BINARY_PACKET_COMPRESSION_THRESHOLD and len(compressed_data := zlib.compress(data)) < len(data):
+            data = compressed_data
+            packet_type_and_flags |= _BINARY_PACKET_FLAG_COMPRESSED
+        key_code = _BINARY_PAYLOAD_KEY_CODES.get(key, _BINARY_PAYLOAD_KEY_LITERAL)
+        literal_key = b''
+        if key_code == _BINARY_PAYLOAD_KEY_LITERAL:
+            raw_key = bytes(key, 'utf-8')
+            literal_key = bytes([len(raw_key)]) + raw_key
+        return _BINARY_PACKET_HEADER.pack(BINARY_PACKET_VERSION, packet_type_and_flags,
+                                          self.id if self.id is not None else _BINARY_PACKET_NO_ID,
+                                          self.client_id if self.client_id is not None else _BINARY_PACKET_NO_ID,
+                                          key_code) + literal_key + data
+
+    @classmethod
+    def from_bytes(cls, packet_bytes: bytes) -> 'Packet':
+        version, packet_type_and_flags, packet_id, client_id, key_code = _BINARY_PACKET_HEADER.unpack_from(packet_bytes)
+        if version != BINARY_PACKET_VERSION:
+            raise ValueError(f'Unknown binary packet version {version}')
+        optional_packet_id = packet_id if packet_id != _BINARY_PACKET_NO_ID else None
+        if packet_type_and_flags & 0x0F == _BINARY_PACKET_TYPE_ACK:
+            return Packet(is_ack=True, id=optional_packet_id)
+        data_start = _BINARY_PACKET_HEADER.size
+        if key_code == _BINARY_PAYLOAD_KEY_LITERAL:
+            key_length = packet_bytes[data_start]
+            payload = packet_bytes[data_start + 1:data_start + 1 + key_length].decode()
+            data_start += 1 + key_length
+        else:
+            payload = BINARY_PAYLOAD_KEYS[key_code]
+        if packet_type_and_flags & _BINARY_PACKET_FLAG_HAS_DATA:
+            data = packet_bytes[data_start:]
+            if packet_type_and_flags & _BINARY_PACKET_FLAG_COMPRESSED:
+                data = zlib.decompress(data)
+            payload = f'{payload}|{data.decode()}'
+        return Packet(id=optional_packet_id, client_id=client_id if client_id != _BINARY_PACKET_NO_ID else None, 
+                      payload=payload)
+
     def __repr__(self) -> str:
         return f'<Packet {self.id}: {self.to_str()}>'
 
 
-def _generate_next_packet_id(client_id: Optional[int], game_name: Optional[str] = None) -> int:
-    with redis_lock('generate_next_packet_id_redis_lock', client_id=client_id, game_name=game_name) if client_id is None else nullcontext():
-        next_packet_id = int(rget('last_packet_id', client_id=client_id, game_name=game_name) or '0') + 1
-        rset('last_packet_id', next_packet_id, client_id=client_id, game_name=game_name)
-    return next_packet_id
+# Every connection numbers its own packets, so that the ids the other end sees are dense and in order, which its
+# HandledPacketWindow relies on. A process-wide counter would interleave every connection's (and every thread's)
+# packets, leaving a re-send more than the window behind the newest id on a busy server. Each connection counts up
+# from the clock, to stay clear of the ids an earlier run used.
+_packet_ids_by_conn: 'WeakKeyDictionary[Any, Iterator[int]]' = WeakKeyDictionary()
+_packet_ids_lock = Lock()
+
+
+def _generate_next_packet_id(conn: Any) -> int:
+    with _packet_ids_lock:
+        if (packet_ids := _packet_ids_by_conn.get(conn)) is None:
+            packet_ids = count(int(time() * 1000) % 2**31)
+            _packet_ids_by_conn[conn] = packet_ids
+        return next(packet_ids)
+
+
+# Called by whatever reads the connection whenever it sees an ack, to wake up the send that's waiting on it. conn is
+# whatever the packet was sent on.
+def record_ack(conn: Any, packet_id: int) -> None:
+    pending_acks.ack(conn, packet_id)
+
+
+FRAME_START = b'[[[['
+FRAME_END = b']]]]'
+FRAME_HEADER_LENGTH = len(FRAME_START) + 8
+RECEIVE_BUFFER_SIZE = 65536
+
+
+class FrameDecoder:
+    """
+    Splits the stream of bytes coming in on one socket into messages. Reads go straight into a preallocated buffer with
+    recv_into, taking as much as the socket has ready, and every complete frame already in the buffer is handed out
+    before the socket is read again.
+
+    Anything that isn't a well-formed frame is skipped up to the next frame marker, so a desynced stream picks back
+    up at the next message instead of losing everything after it.
+    """
+
+    def __init__(self, socket: Any, buffer_size: int = RECEIVE_BUFFER_SIZE) -> None:
+        self._socket = socket
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._lock = Lock()
+
+    # Returns the compressed body of the next frame
+    def receive(self) -> bytes:
+        with self._lock:
+            while (frame := self._next_frame()) is None:
+                self._fill()
+            return frame
+
+    def _next_frame(self) -> Optional[bytes]:
+        while True:
+            marker = self._buffer.find(FRAME_START, self._start, self._end)
+            if marker == -1:
+                # The last few bytes might be the beginning of a marker
+                self._start = max(self._start, self._end - len(FRAME_START) + 1)
+                return None
+            self._start = marker
+            body_start = marker + FRAME_HEADER_LENGTH
+            if self._end < body_start:
+                return None
+            raw_length = bytes(self._view[marker + len(FRAME_START):body_start])
+            if not raw_length.isdigit():
+                self._start = marker + 1
+                continue
+            body_end = body_start + int(raw_length)
+            frame_end = body_end + len(FRAME_END)
+            if self._end < frame_end:
+                self._make_room_for(frame_end - self._start)
+                return None
+            if self._view[body_end:frame_end] != FRAME_END:
+                self._start = marker + 1
+                continue
+            self._start = frame_end
+            return bytes(self._view[body_start:body_end])
+
+    def _make_room_for(self, frame_length: int) -> None:
+        if frame_length <= len(self._buffer):
+            return
+        self._view.release()
+        new_buffer = bytearray(max(frame_length, 2 * len(self._buffer)))
+        new_buffer[:self._end - self._start] = self._buffer[self._start:self._end]
+        self._buffer = new_buffer
+        self._view = memoryview(self._buffer)
+        self._end -= self._start
+        self._start = 0
+
+    def _fill(self) -> None:
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buffer):
+            unread_length = self._end - self._start
+            self._view[:unread_length] = self._view[self._start:self._end]
+            self._start, self._end = 0, unread_length
+        num_bytes_read = self._socket.recv_into(self._view[self._end:])
+        if num_bytes_read == 0:
+            raise ConnectionError('Connection closed')
+        self._end += num_bytes_read
+
+
+_frame_decoders_by_socket: 'WeakKeyDictionary[Any, FrameDecoder]' = WeakKeyDictionary()
+_frame_decoders_lock = Lock()
+
+# What each connection has agreed to be sent. Everyone starts out with text, and anything can always be received.
+_packet_formats_by_conn: 'WeakKeyDictionary[Any, PacketFormat]' = WeakKeyDictionary()
+
+
+def set_packet_format(conn: Any, packet_format: PacketFormat) -> None:
+    _packet_formats_by_conn[conn] = packet_format
+
+
+def get_packet_format(conn: Any) -> PacketFormat:
+    return _packet_formats_by_conn.get(conn, PacketFormat.TEXT)
+
+
+_rtt_estimators_by_conn: 'WeakKeyDictionary[Any, RttEstimator]' = WeakKeyDictionary()
+_rtt_estimators_lock = Lock()
+
+
+def get_rtt_estimator(conn: Any) -> RttEstimator:
+    with _rtt_estimators_lock:
+        if (rtt_estimator := _rtt_estimators_by_conn.get(conn)) is None:
+            rtt_estimator = RttEstimator()
+            _rtt_estimators_by_conn[conn] = rtt_estimator
+        return rtt_estimator
+
+
+# Packets that can't be parsed are skipped, so one bad packet doesn't take the rest of the message down with it
+def decode_message(message: bytes) -> list[Packet]:
+    if message[:1] == bytes([BINARY_PACKET_VERSION]):
+        return [Packet.from_bytes(message)]
+    packets: list[Packet] = []
+    for datum in zlib.decompress(message).decode().split(';'):
+        if datum:
+            try:
+                packets.append(Packet.from_str(datum))
+            except Exception as e:
+                print(f'Ignoring {datum[:LOG_CUTOFF]} because of exception: {e}')
+    return packets
+
+
+def receive_packets(socket: Any) -> list[Packet]:
+    with _frame_decoders_lock:
+        if (frame_decoder := _frame_decoders_by_socket.get(socket)) is None:
+            frame_decoder = FrameDecoder(socket)
+            _frame_decoders_by_socket[socket] = frame_decoder
+    message = frame_decoder.receive()
+    metrics.inc('bytes_received_total', len(message))
+    return decode_message(message)
+
+
+# Anything before the next frame marker is skipped, so a desynced stream picks back up at the next message
+async def areceive_packets(reader: asyncio.StreamReader) -> list[Packet]:
+    while True:
+        try:
+            await reader.readuntil(FRAME_START)
+            break
+        except asyncio.LimitOverrunError as e:
+            await reader.readexactly(e.consumed)
+    total_length_of_message = int(await reader.readexactly(8))
+    message = await reader.readexactly(total_length_of_message)
+    await reader.readexactly(4)
+    metrics.inc('bytes_received_total', len(message))
+    return decode_message(message)
+
 
+def _frame_message(message: bytes) -> bytes:
+    return FRAME_START + bytes(f"{len(message):08}", 'utf-8') + message + FRAME_END
 
-def packet_ack_redis_key(packet_id: int) -> str:
-    return f'packet_ack|{packet_id}'
 
+def frame_packet(packet: Packet, packet_format: PacketFormat) -> bytes:
+    if packet_format == PacketFormat.BINARY:
+        return _frame_message(packet.to_bytes())
+    return _frame_message(zlib.compress(bytes(packet.to_str(), 'utf-8')))
 
-def packet_handled_redis_key(packet_id: int, *, for_client: Optional[int]) -> str:
-    for_client_suffix = f'|{for_client}' if for_client is not None else ''
-    return f'packet_handled|{packet_id}{for_client_suffix}'
 
+def _record_sent(framed_message: bytes) -> None:
+    metrics.inc('packets_sent_total')
+    metrics.inc('bytes_sent_total', len(framed_message))
 
-def receive_compressed_message(socket: Any) -> str:
-    try:
-        prepreamble = socket.recv(1).decode()
-    except UnicodeDecodeError:
-        return ''
-    if prepreamble != '[':
-        return ''
-    try:
-        preamble = socket.recv(11).decode()
-    except UnicodeDecodeError:
-        return ''
-    if preamble[:3] != '[[[':
-        return ''
-    
-    total_length_of_message = int(preamble[3:])
-    length_read_so_far = 0
-    chunk_size = 256
-    messages: list[bytes] = []
-    while length_read_so_far < total_length_of_message:
-        next_chunk_length = max(min(chunk_size, total_length_of_message - length_read_so_far), 0)
-        message = socket.recv(next_chunk_length)
-        messages.append(message)
-        length_read_so_far += len(message)
-    
-    socket.recv(4)
-    
-    return zlib.decompress(b''.join(messages)).decode()
 
+def _send_packet(conn: Any, packet: Packet) -> None:
+    framed_message = frame_packet(packet, get_packet_format(conn))
+    _record_sent(framed_message)
+    conn.sendall(framed_message)
 
-def _send_compressed_message(conn: Any, compressed_message: bytes) -> None:
-    print(len(compressed_message))
-    conn.sendall(b'[[[[' + bytes(f"{len(compressed_message):08}", 'utf-8') + compressed_message + b']]]]')
 
-
-# Returns the boolean of whether or not the message was successfully sent (i.e. an ack was received)
-def _send_with_retry_inner(conn: Any, packet: Packet, wait_time: float, *, 
-                           client_id: Optional[int], game_name: Optional[str] = None) -> bool:
-    packet_id = packet.id
-    assert packet_id is not None
-    # print(f'Sending {packet}')
-    if DROP_CHANCE and random.random() < DROP_CHANCE:
-        return False    
-    _send_compressed_message(conn, zlib.compress(bytes(packet.to_str(), 'utf-8')))
-
-    sleep(wait_time)
-
-    # We're relying on a different process to listen for acks and write to redis when one is seen
-    ack_redis_key = packet_ack_redis_key(packet_id)
-    if rget(ack_redis_key, client_id=client_id, game_name=game_name):
-        return True
-    return False
+MAX_SEND_ATTEMPTS = 3
 
 
-# Returns the boolean of whether or not the message was successfully sent (i.e. an ack was received)
+# Returns the boolean of whether or not the message was successfully sent (i.e. an ack was received). Each re-send
+# waits twice as long as the last, starting from however long an ack usually takes on this connection.
 def send_with_retry(conn: Any, message: str, client_id: Optional[int], game_name: Optional[str] = None) -> bool:
     if TEST_LAG:
         sleep(TEST_LAG)
-    packet_id = _generate_next_packet_id(client_id=client_id, game_name=game_name)
+    packet_id = _generate_next_packet_id(conn)
     packet = Packet(id=packet_id, client_id=client_id, payload=message)
-    wait_times = [0.2, 0.4, 0.8]
-    for i, wait_time in enumerate(wait_times):
-        if _send_with_retry_inner(conn, packet, wait_time, client_id=client_id, game_name=game_name):
-            return True
-        # debug_msg = f'Did not get a response in {wait_time} for {packet}'
-        # if i < len(wait_times) - 1:
-        #     debug_msg = f'{debug_msg}, retrying...'
-        # print(debug_msg)
-    return False
+    rtt_estimator = get_rtt_estimator(conn)
+    wait_time = rtt_estimator.ack_timeout()
+    ack_received = pending_acks.expect(conn, packet_id)
+    try:
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            if attempt > 0:
+                metrics.inc('packet_resends_total')
+            sent_at = monotonic()
+            if not (DROP_CHANCE and random.random() < DROP_CHANCE):
+                _send_packet(conn, packet)
+            if ack_received.wait(wait_time):
+                # Once we've re-sent, there's no telling which send the ack was for
+                if attempt == 0:
+                    rtt = monotonic() - sent_at
+                    rtt_estimator.add_sample(rtt)
+                    metrics.observe('ack_rtt_seconds', rtt)
+                return True
+            wait_time = min(wait_time * 2, MAX_ACK_TIMEOUT)
+        metrics.inc('packets_unacked_total')
+        return False
+    finally:
+        pending_acks.forget(conn, packet_id)
 
 
 def send_with_retry_on_delay(conn: Any, delay: float, message: str, client_id: Optional[int], game_name: Optional[str] = None) -> bool:
@@ -151,7 +372,7 @@ def send_with_test_lag(conn: Any, message: str, lag: float, *, client_id: Option
     sleep(lag)
     packet = Packet(client_id=client_id, payload=message)
     # print(f'Sending without retry {packet}')    
-    conn.sendall(zlib.compress(bytes(packet.to_str(), 'utf-8')))
+    _send_packet(conn, packet)
 
 def send_without_retry(conn: Any, message: str, *, client_id: Optional[int]) -> None:
     if DROP_CHANCE and random.random() < DROP_CHANCE:
@@ -161,22 +382,100 @@ def send_without_retry(conn: Any, message: str, *, client_id: Optional[int]) ->
     else:
         packet = Packet(client_id=client_id, payload=message)
         # print(f'Sending without retry {packet}')    
-        _send_compressed_message(conn, zlib.compress(bytes(packet.to_str(), 'utf-8')))
+        _send_packet(conn, packet)
+
+
+# Encodes and frames a message once, so that the same bytes can be written to any number of connections
+def frame_message_without_retry(message: str, *, client_id: Optional[int], 
+                                packet_format: PacketFormat = PacketFormat.TEXT) -> bytes:
+    return frame_packet(Packet(client_id=client_id, payload=message), packet_format)
+
+
+def send_framed_message_without_retry(conn: Any, framed_message: bytes) -> None:
+    if DROP_CHANCE and random.random() < DROP_CHANCE:
+        return
+    if TEST_LAG:
+        sleep(TEST_LAG)
+    conn.sendall(framed_message)
 
 
 def send_ack(conn: Any, packet_id: int) -> None:
     packet = Packet(id=packet_id, is_ack=True)
     # print(f'Acking {packet}')
-    _send_compressed_message(conn, zlib.compress(bytes(packet.to_str(), 'utf-8')))
+    _send_packet(conn, packet)
+
+
+# Asks the other end to send us binary packets from now on, and starts sending it binary packets once it agrees.
+# Anything that doesn't know about binary packets won't ack this, so we just keep talking text to it.
+def negotiate_packet_format(conn: Any, client_id: Optional[int], game_name: Optional[str] = None) -> PacketFormat:
+    if USE_BINARY_PACKETS and send_with_retry(conn, f'packet_format|{PacketFormat.BINARY.value}', client_id, game_name=game_name):
+        set_packet_format(conn, PacketFormat.BINARY)
+    return get_packet_format(conn)
+
+
+# Async versions of the above, for the asyncio server
+async def asend_framed_message_without_retry(writer: asyncio.StreamWriter, framed_message: bytes) -> None:
+    if DROP_CHANCE and random.random() < DROP_CHANCE:
+        return
+    if TEST_LAG:
+        await asyncio.sleep(TEST_LAG)
+    writer.write(framed_message)
+    await writer.drain()
+
+
+async def asend_without_retry(writer: asyncio.StreamWriter, message: str, *, client_id: Optional[int]) -> None:
+    framed_message = frame_message_without_retry(message, client_id=client_id, packet_format=get_packet_format(writer))
+    _record_sent(framed_message)
+    await asend_framed_message_without_retry(writer, framed_message)
+
+
+async def asend_ack(writer: asyncio.StreamWriter, packet_id: int) -> None:
+    framed_message = frame_packet(Packet(id=packet_id, is_ack=True), get_packet_format(writer))
+    _record_sent(framed_message)
+    writer.write(framed_message)
+    await writer.drain()
+
+
+# Returns the boolean of whether or not the message was successfully sent (i.e. an ack was received)
+async def asend_with_retry(writer: asyncio.StreamWriter, message: str, *, delay: float = 0.0) -> bool:
+    await asyncio.sleep(delay + TEST_LAG)
+    packet_id = _generate_next_packet_id(writer)
+    packet = Packet(id=packet_id, payload=message)
+    rtt_estimator = get_rtt_estimator(writer)
+    wait_time = rtt_estimator.ack_timeout()
+    ack_received = pending_acks.aexpect(writer, packet_id)
+    try:
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            if attempt > 0:
+                metrics.inc('packet_resends_total')
+            sent_at = monotonic()
+            framed_message = frame_packet(packet, get_packet_format(writer))
+            _record_sent(framed_message)
+            writer.write(framed_message)
+            await writer.drain()
+            try:
+                await asyncio.wait_for(ack_received.wait(), wait_time)
+            except asyncio.TimeoutError:
+                wait_time = min(wait_time * 2, MAX_ACK_TIMEOUT)
+                continue
+            if attempt == 0:
+                rtt = monotonic() - sent_at
+                rtt_estimator.add_sample(rtt)
+                metrics.observe('ack_rtt_seconds', rtt)
+            return True
+        metrics.inc('packets_unacked_total')
+        return False
+    finally:
+        pending_acks.forget(writer, packet_id)
 
 
 # game_name only used by AI players
 def send_command(conn: Any, command: Command, *, client_id: int, game_name: Optional[str] = None) -> Command:
     if conn is not None:
         store_command(command, for_client=client_id, client_id=client_id)
-        command_str = f'command|{json.dumps(command.to_json())}'
+        command_str = f'command|{encode_command(command)}'
         print(f'Sending command: {command_str}\n')
-        start_new_thread(send_with_retry, (conn, f'command|{json.dumps(command.to_json())}', client_id))
+        start_new_thread(send_with_retry, (conn, f'command|{encode_command(command)}', client_id))
     else:
         # AI players are run directly on the server and so have direct access to the server db
         store_command(command=command, for_client=client_id, client_id=None, game_name=game_name)
@@ -185,9 +484,7 @@ def send_command(conn: Any, command: Command, *, client_id: int, game_name: Opti
 
 
 def _generate_next_command_id(client_id: Optional[int], game_name: Optional[str] = None) -> int:
-    next_command_id = int(rget('next_command_id', client_id=client_id, game_name=game_name) or '0') + 2
-    rset('next_command_id', next_command_id, client_id=client_id)
-    return next_command_id
+    return client_state.next_command_id()
 
 
 # game_name only used by AI players
@@ -46,14 +46,14 @@ class Player():
         self.speed = speed
         self.arrows_puncturing = arrows_puncturing if arrows_puncturing is not None else []
 
-    def draw(self, g: pygame.surface.Surface, x_offset: int, y_offset: int, team: Optional[Team] = None):
+    def draw(self, g: pygame.surface.Surface, x_offset: int, y_offset: int, team: Optional[Team] = None) -> pygame.Rect:
         x = int(math.ceil(self.x - x_offset - self.width / 2))
         y = int(math.ceil(self.y - y_offset - self.height / 2))
-        pygame.draw.rect(g, team_to_color(team), (x, y, self.width, self.height), 0)
+        rect = pygame.draw.rect(g, team_to_color(team), (x, y, self.width, self.height), 0)
         pygame.draw.rect(g, (0,0,0), (x, y, self.width, self.height), width=2)
         for arrow in self.arrows_puncturing:
-            draw_arrow(g, ARROW_COLOR, (arrow[0][0] + self.x - x_offset, arrow[0][1] + self.y - y_offset), (arrow[1][0] + self.x - x_offset, arrow[1][1] + self.y - y_offset))
-        draw_text_centered_on_rectangle(g, str(self.player_number), x, y, self.width, self.height, 35)
+            rect.union_ip(draw_arrow(g, ARROW_COLOR, (arrow[0][0] + self.x - x_offset, arrow[0][1] + self.y - y_offset), (arrow[1][0] + self.x - x_offset, arrow[1][1] + self.y - y_offset)))
+        return rect.union(draw_text_centered_on_rectangle(g, str(self.player_number), x, y, self.width, self.height, 35))
 
     def make_valid_position(self, w: int, h: int) -> None:
         self.x = max(0, self.x)
@@ -0,0 +1,137 @@
+from collections import deque
+from contextlib import contextmanager
+import csv
+from functools import wraps
+import json
+from threading import Lock
+from time import perf_counter, time
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+import pygame
+
+from asset_cache import asset_cache
+from settings import PROFILE_CLIENT
+
+
+# Frames the overlay's numbers are worked out over: about ten seconds' worth
+FRAME_HISTORY = 600
+# Frames kept for the trace file, about half an hour's worth, after which the oldest are dropped
+MAX_TRACE_FRAMES = 100_000
+# The numbers change every frame, so the overlay only re-renders them this often (in seconds) to stay readable
+OVERLAY_REFRESH_INTERVAL = 0.5
+OVERLAY_FONT_SIZE = 18
+# How many sections the overlay lists, slowest first
+OVERLAY_SECTIONS = 12
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class Profiler:
+    """
+    Times each frame and the named sections of it (inference, input, each draw_* method, digests and so on), for
+    the overlay drawn over the game and the trace file written when it quits. Does nothing unless it's enabled, so
+    that the sections can stay in the hot paths.
+
+    Sections can nest, and each one's time includes whatever's nested inside it. A section that runs more than once
+    in a frame is counted once, with all of its time. Everything is in milliseconds.
+    """
+
+    def __init__(self, enabled: bool = PROFILE_CLIENT) -> None:
+        self.enabled = enabled
+        self._lock = Lock()
+        self._section_times: dict[str, float] = {}
+        self._frame_started_at: Optional[float] = None
+        self._frames: deque[tuple[float, dict[str, float]]] = deque(maxlen=FRAME_HISTORY)
+        self._trace: deque[dict[str, float]] = deque(maxlen=MAX_TRACE_FRAMES)
+        self._overlay_surfaces: list[Any] = []
+        self._overlay_refreshed_at = 0.0
+
+    @contextmanager
+    def section(self, name: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        started_at = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (perf_counter() - started_at) * 1000
+            with self._lock:
+                self._section_times[name] = self._section_times.get(name, 0.0) + elapsed
+
+    # Called once a frame has been drawn. The first frame only starts the clock.
+    def end_frame(self) -> None:
+        if not self.enabled:
+            return
+        now = perf_counter()
+        with self._lock:
+            section_times, self._section_times = self._section_times, {}
+            if self._frame_started_at is not None:
+                frame_time = (now - self._frame_started_at) * 1000
+                self._frames.append((frame_time, section_times))
+                self._trace.append({'time': time(), 'frame': frame_time, **section_times})
+            self._frame_started_at = now
+
+    def overlay_lines(self) -> list[str]:
+        with self._lock:
+            frames = list(self._frames)
+        if not frames:
+            return []
+        frame_times = [frame_time for frame_time, _ in frames]
+        lines = [f'{1000 * len(frame_times) / sum(frame_times):.0f} fps, '
+                 f'p50 {_percentile(frame_times, 0.5):.1f} ms, p99 {_percentile(frame_times, 0.99):.1f} ms']
+        # Frames a section didn't run in count as 0, so that the means add up to where the frame time goes
+        section_names = {name for _, section_times in frames for name in section_times}
+        times_by_section = {name: [section_times.get(name, 0.0) for _, section_times in frames] for name in section_names}
+        means = {name: sum(times) / len(times) for name, times in times_by_section.items()}
+        for name in sorted(section_names, key=lambda name: -means[name])[:OVERLAY_SECTIONS]:
+            lines.append(f'{name}: {means[name]:.2f} ms, p99 {_percentile(times_by_section[name], 0.99):.2f} ms')
+        return lines
+
+    def draw_overlay(self, canvas: Any, x: int, y: int) -> Optional[pygame.Rect]:
+        if not self.enabled:
+            return None
+        if time() - self._overlay_refreshed_at >= OVERLAY_REFRESH_INTERVAL:
+            font = asset_cache.font(OVERLAY_FONT_SIZE)
+            self._overlay_surfaces = [font.render(line, True, (0, 0, 0)) for line in self.overlay_lines()]
+            self._overlay_refreshed_at = time()
+        rects = []
+        for surface in self._overlay_surfaces:
+            rects.append(canvas.blit(surface, (x, y)))
+            y += surface.get_height()
+        return rects[0].unionall(rects[1:]) if rects else None
+
+    # Writes every frame kept so far, as JSON, or as CSV if path ends in .csv, with a column for each section
+    def dump(self, path: str) -> None:
+        with self._lock:
+            trace = list(self._trace)
+        if path.endswith('.csv'):
+            section_names = sorted({name for row in trace for name in row} - {'time', 'frame'})
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=['time', 'frame', *section_names], restval=0.0)
+                writer.writeheader()
+                writer.writerows(trace)
+        else:
+            with open(path, 'w') as f:
+                json.dump({'frames': trace}, f)
+
+
+profiler = Profiler()
+
+
+# Times every call to the decorated function as the named section
+def profiled(name: str) -> Callable[[F], F]:
+    def decorator(f: F) -> F:
+        @wraps(f)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with profiler.section(name):
+                return f(*args, **kwargs)
+        return wrapper  # type: ignore
+    return decorator
@@ -6,6 +6,7 @@ from typing import TYPE_CHECKING, Optional, Union
 import pygame
 from direction import to_optional_direction
 from utils import to_optional_int
+from spatial_grid import SpatialGrid
 
 from direction import Direction
 if TYPE_CHECKING:
@@ -14,9 +15,9 @@ if TYPE_CHECKING:
 
 def draw_arrow(screen, colour, start, end):
     # https://stackoverflow.com/questions/43527894/drawing-arrowheads-which-follow-the-direction-of-the-line-in-pygame
-    pygame.draw.line(screen,colour,start,end,2)
+    line_rect = pygame.draw.line(screen,colour,start,end,2)
     rotation = math.degrees(math.atan2(start[1]-end[1], end[0]-start[0]))+90
-    pygame.draw.polygon(screen, (0, 100, 0), ((end[0]+20*math.sin(math.radians(rotation)), end[1]+20*math.cos(math.radians(rotation))), (end[0]+20*math.sin(math.radians(rotation-120)), end[1]+20*math.cos(math.radians(rotation-120))), (end[0]+20*math.sin(math.radians(rotation+120)), end[1]+20*math.cos(math.radians(rotation+120)))))
+    return line_rect.union(pygame.draw.polygon(screen, (0, 100, 0), ((end[0]+20*math.sin(math.radians(rotation)), end[1]+20*math.cos(math.radians(rotation))), (end[0]+20*math.sin(math.radians(rotation-120)), end[1]+20*math.cos(math.radians(rotation-120))), (end[0]+20*math.sin(math.radians(rotation+120)), end[1]+20*math.cos(math.radians(rotation+120))))))
 
 
 class ProjectileType(Enum):
@@ -46,7 +47,7 @@ class Projectile:
         # client_ids of friendly players
         self.friends = friends if friends is not None else []
 
-    def draw(self, g: pygame.surface.Surface, x_offset: int, y_offset: int):
+    def draw(self, g: pygame.surface.Surface, x_offset: int, y_offset: int) -> Optional[pygame.Rect]:
         if self.type == ProjectileType.ARROW:
             color = ARROW_COLOR
             arrow_length = ARROW_LENGTH
@@ -57,7 +58,8 @@ class Projectile:
                                                vector_from_source_to_dest[1] / vector_from_source_to_dest_mag)
             start = (end[0] - unit_vector_from_source_to_dest[0] * arrow_length, 
                      end[1] - unit_vector_from_source_to_dest[1] * arrow_length)
-            draw_arrow(g, color, start, end)
+            return draw_arrow(g, color, start, end)
+        return None
 
     def get_start_of_arrow(self) -> list[int]:
         end = (self.x, self.y)
@@ -109,4 +111,16 @@ def projectile_intersects_player(projectile: Projectile, player: 'Player') -> bo
             and projectile.y > player.y - player.height/2 + 1
             and projectile.y < player.y + player.height/2 - 1):
         return True
-    return False
\ No newline at end of file
+    return False
+
+
+# Every (projectile, player) pair where the projectile is hitting a player it isn't friendly to. Each player is only
+# checked against the projectiles in the grid cells around it.
+def find_projectile_hits(players: list['Player'], projectile_grid: SpatialGrid[Projectile]) -> list[tuple[Projectile, 'Player']]:
+    hits: list[tuple[Projectile, 'Player']] = []
+    for player in players:
+        for projectile in projectile_grid.query_box(player.x - player.width/2, player.y - player.height/2, 
+                                                    player.x + player.width/2, player.y + player.height/2):
+            if projectile_intersects_player(projectile, player) and player.client_id not in projectile.friends:
+                hits.append((projectile, player))
+    return hits
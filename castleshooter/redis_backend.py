@@ -0,0 +1,210 @@
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Mapping, Optional
+
+import redis as r
+import redis.asyncio as ar
+import redis_lock as rl
+
+from storage_backend import BatchOp, StorageBackend
+from utils import to_optional_str
+
+
+# Appends to one entity's log, trims everything before the cutoff out of it and out of the index, and bumps the
+# entity's time in the index, all atomically on the redis server, in one round trip. Entries that are already in the
+# log are the same sorted set member, so they're not added twice. If anything was new, the entity id is published on
+# the log name's channel. Returns how many entries were new.
+# KEYS: the entity's log, the index. ARGV: the cutoff, the entity id, its latest time, then time and entry pairs.
+_LOG_APPEND_SCRIPT = """
+local num_added = redis.call('ZADD', KEYS[1], unpack(ARGV, 4))
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+redis.call('ZADD', KEYS[2], 'GT', ARGV[3], ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+if num_added > 0 then
+    redis.call('PUBLISH', KEYS[2], ARGV[2])
+end
+return num_added
+"""
+
+
+def _get_log_append_args(entity_id: int, entries: Mapping[bytes, float], *, trim_before: float) -> list[Any]:
+    args: list[Any] = [f'({trim_before}', str(entity_id), max(entries.values())]
+    for entry, entry_time in entries.items():
+        args.extend([entry_time, entry])
+    return args
+
+
+# Log appends go through the log append script, which the pipeline loads before it runs if redis doesn't have it yet
+def _queue_batch(pipe: Any, ops: list[BatchOp], log_append_script: Any) -> None:
+    for op, args in ops:
+        if op == 'log_append':
+            log_key, index_key, entity_id, entries, trim_before = args
+            pipe.scripts.add(log_append_script)
+            pipe.evalsha(log_append_script.sha, 2, log_key, index_key,
+                         *_get_log_append_args(entity_id, entries, trim_before=trim_before))
+        else:
+            getattr(pipe, op)(*args)
+
+
+def _queue_mset_and_publish(pipe: Any, values: Mapping[str, str]) -> None:
+    for key, value in values.items():
+        pipe.publish(key, value)
+    pipe.mset(values)
+
+
+def _decode_ring_at_or_before(at_or_before: list[bytes], lowest: list[bytes]) -> Optional[str]:
+    values = at_or_before or lowest
+    return values[0].decode() if values else None
+
+
+class RedisBackend(StorageBackend):
+    """
+    Keeps everything in redis, so that any number of server processes can share it. Logs and rings are sorted sets
+    scored by time, and every operation is one round trip, pipelined or scripted where it takes more than one command.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 6379, db: int = 0) -> None:
+        self.redis = r.Redis(connection_pool=r.ConnectionPool(host=host, port=port, db=db))
+        # Only used by the asyncio server
+        self.async_redis: 'ar.Redis[bytes]' = ar.Redis(connection_pool=ar.ConnectionPool(host=host, port=port, db=db))
+        self._log_append_script = self.redis.register_script(_LOG_APPEND_SCRIPT)
+        self._alog_append_script = self.async_redis.register_script(_LOG_APPEND_SCRIPT)
+
+    def get(self, key: str) -> Optional[str]:
+        return to_optional_str(self.redis.get(key))
+
+    def mget(self, keys: list[str]) -> list[Optional[str]]:
+        return [to_optional_str(value) for value in self.redis.mget(keys)] if keys else []
+
+    def set_and_publish(self, key: str, value: str) -> bool:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.publish(key, value)
+        pipe.set(key, value)
+        _, result = pipe.execute()
+        return bool(result)
+
+    def mset_and_publish(self, values: Mapping[str, str]) -> None:
+        pipe = self.redis.pipeline(transaction=False)
+        _queue_mset_and_publish(pipe, values)
+        pipe.execute()
+
+    def incr(self, key: str) -> int:
+        return self.redis.incr(key)
+
+    def run_batch(self, ops: list[BatchOp], *, transaction: bool) -> list[Any]:
+        pipe = self.redis.pipeline(transaction=transaction)
+        _queue_batch(pipe, ops, self._log_append_script)
+        return pipe.execute()
+
+    def log_append(self, log_key: str, index_key: str, entity_id: int, entries: Mapping[bytes, float], *,
+                   trim_before: float) -> int:
+        return int(self._log_append_script(keys=[log_key, index_key], args=_get_log_append_args(entity_id, entries, trim_before=trim_before)))
+
+    def log_read(self, index_key: str, log_key_for: Callable[[int], str]) -> dict[int, list[bytes]]:
+        entity_ids = [int(raw_entity_id) for raw_entity_id in self.redis.zrange(index_key, 0, -1)]
+        pipe = self.redis.pipeline(transaction=False)
+        for entity_id in entity_ids:
+            pipe.zrange(log_key_for(entity_id), 0, -1)
+        return {entity_id: entries for entity_id, entries in zip(entity_ids, pipe.execute()) if entries}
+
+    def ring_push(self, key: str, value: str, score: float, *, capacity: int) -> None:
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zadd(key, {value: score})
+        pipe.zremrangebyrank(key, 0, -capacity - 1)
+        pipe.execute()
+
+    def ring_at_or_before(self, key: str, score: float) -> Optional[str]:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrevrangebyscore(key, score, '-inf', start=0, num=1)
+        pipe.zrange(key, 0, 0)
+        return _decode_ring_at_or_before(*pipe.execute())
+
+    def listen(self, channels: list[str], callback: Callable[[str, Optional[str]], None],
+               break_when: Optional[Callable[[], bool]] = None) -> None:
+        pubsub = self.redis.pubsub()
+        for channel in channels:
+            pubsub.subscribe(channel)
+        for item in pubsub.listen():
+            if item['type'] == 'message':
+                raw_channel = to_optional_str(item['channel'])
+                assert raw_channel is not None
+                callback(raw_channel, to_optional_str(item['data']))
+            if break_when is not None and break_when():
+                break
+
+    @contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        lock = rl.Lock(self.redis, key)
+        lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def flushall(self) -> None:
+        self.redis.flushall()
+
+    async def aget(self, key: str) -> Optional[str]:
+        return to_optional_str(await self.async_redis.get(key))
+
+    async def amget(self, keys: list[str]) -> list[Optional[str]]:
+        return [to_optional_str(value) for value in await self.async_redis.mget(keys)] if keys else []
+
+    async def aset_and_publish(self, key: str, value: str) -> bool:
+        pipe = self.async_redis.pipeline(transaction=False)
+        pipe.publish(key, value)
+        pipe.set(key, value)
+        _, result = await pipe.execute()
+        return bool(result)
+
+    async def amset_and_publish(self, values: Mapping[str, str]) -> None:
+        pipe = self.async_redis.pipeline(transaction=False)
+        _queue_mset_and_publish(pipe, values)
+        await pipe.execute()
+
+    async def aincr(self, key: str) -> int:
+        return await self.async_redis.incr(key)
+
+    async def arun_batch(self, ops: list[BatchOp], *, transaction: bool) -> list[Any]:
+        pipe = self.async_redis.pipeline(transaction=transaction)
+        _queue_batch(pipe, ops, self._alog_append_script)
+        return await pipe.execute()
+
+    async def alog_append(self, log_key: str, index_key: str, entity_id: int, entries: Mapping[bytes, float], *,
+                          trim_before: float) -> int:
+        return int(await self._alog_append_script(keys=[log_key, index_key],
+                                                  args=_get_log_append_args(entity_id, entries, trim_before=trim_before)))
+
+    async def alog_read(self, index_key: str, log_key_for: Callable[[int], str]) -> dict[int, list[bytes]]:
+        entity_ids = [int(raw_entity_id) for raw_entity_id in await self.async_redis.zrange(index_key, 0, -1)]
+        pipe = self.async_redis.pipeline(transaction=False)
+        for entity_id in entity_ids:
+            pipe.zrange(log_key_for(entity_id), 0, -1)
+        return {entity_id: entries for entity_id, entries in zip(entity_ids, await pipe.execute()) if entries}
+
+    # Listens until it's cancelled, and then gives its connection back
+    async def alisten(self, channels: list[str], callback: Callable[[str, Optional[str]], Awaitable[None]]) -> None:
+        pubsub = self.async_redis.pubsub()
+        try:
+            await pubsub.subscribe(*channels)
+            async for item in pubsub.listen():
+                if item['type'] == 'message':
+                    raw_channel = to_optional_str(item['channel'])
+                    assert raw_channel is not None
+                    await callback(raw_channel, to_optional_str(item['data']))
+        finally:
+            try:
+                await pubsub.unsubscribe()
+            finally:
+                await pubsub.close()
+
+    @asynccontextmanager
+    async def alock(self, key: str) -> AsyncIterator[None]:
+        lock = self.async_redis.lock(key)
+        await lock.acquire()
+        try:
+            yield
+        finally:
+            await lock.release()
+
+    async def aflushall(self) -> None:
+        await self.async_redis.flushall()
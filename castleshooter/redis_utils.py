@@ -1,12 +1,32 @@
-import redis as r
-from typing import Any, Callable, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, ContextManager, Iterator, Mapping, Optional
 
-from contextlib import contextmanager
-import redis_lock as rl
+from contextlib import asynccontextmanager, contextmanager
+from time import perf_counter
+from memory_backend import MemoryBackend
+from metrics import metrics
+from redis_backend import RedisBackend
+from settings import STORAGE_BACKEND
+from storage_backend import BatchOp, StorageBackend
 from utils import to_optional_str
 
-redis = r.Redis(connection_pool=r.ConnectionPool(host='localhost', port=6379, db=0))
-pretend_redis_dict: dict[str, Optional[str]] = {}
+
+def _make_storage_backend(name: str) -> StorageBackend:
+    if name == 'redis':
+        return RedisBackend()
+    elif name == 'memory':
+        return MemoryBackend()
+    else:
+        raise ValueError(f'Unknown storage backend: {name}')
+
+
+# Where the server keeps everything. Clients never touch it; they keep what they know in client_utils.client_state.
+storage = _make_storage_backend(STORAGE_BACKEND)
+
+
+# Every storage operation is timed, as storage_op_seconds
+def _timed(op: str) -> ContextManager[None]:
+    return metrics.timer('storage_op_seconds', op=op)
+
 
 def _get_redis_key_prefix(*, client_id: Optional[int], game_name: Optional[str]) -> str:
     return f'client:{client_id}' if client_id is not None else f'server:{game_name}'
@@ -23,47 +43,159 @@ def _get_redis_key_inverse(redis_key: str, *, client_id: Optional[int], game_nam
     return redis_key[len(prefix) + 1:]
 
 
+# Can only be called from the server
 def rset(key: str, value: Any, *, client_id: Optional[int], game_name: Optional[str] = None) -> Optional[bool]:
-    if client_id is not None:
-        old_value = pretend_redis_dict.get(key)
-        new_value = to_optional_str(value)
-        pretend_redis_dict[key] = to_optional_str(value)
-        return old_value != new_value
-
-    assert game_name is not None
-    redis_key = _get_redis_key(key, client_id=client_id, game_name=game_name)
-    redis.publish(redis_key, str(value))
-    return redis.set(_get_redis_key(key, client_id=client_id, game_name=game_name), str(value))
+    assert client_id is None and game_name is not None
+    with _timed('set'):
+        return storage.set_and_publish(_get_redis_key(key, client_id=client_id, game_name=game_name), str(value))
 
 
+# Can only be called from the server
 def rget(key: str, *, client_id: Optional[int], game_name: Optional[str] = None) -> Optional[str]:
-    if client_id is not None:
-        return pretend_redis_dict.get(key)
+    assert client_id is None and game_name is not None
+    with _timed('get'):
+        return storage.get(_get_redis_key(key, client_id=client_id, game_name=game_name))
 
-    assert game_name is not None
-    return (val.decode() 
-            if (val := redis.get(_get_redis_key(key, client_id=client_id, game_name=game_name))) is not None 
-            else None)
+
+# Can only be called from the server. One round trip for all of the keys, rather than one each.
+def rmget(keys: list[str], *, game_name: str) -> list[Optional[str]]:
+    if not keys:
+        return []
+    with _timed('mget'):
+        return storage.mget([_get_redis_key(key, client_id=None, game_name=game_name) for key in keys])
+
+
+# Can only be called from the server. Publishes every value the way rset does, all in one round trip.
+def rmset(values: Mapping[str, Any], *, game_name: str) -> None:
+    if values:
+        with _timed('mset'):
+            storage.mset_and_publish(_get_redis_values(values, game_name=game_name))
+
+
+def _get_redis_values(values: Mapping[str, Any], *, game_name: str) -> dict[str, str]:
+    return {_get_redis_key(key, client_id=None, game_name=game_name): str(value) for key, value in values.items()}
+
+
+class BatchedGet:
+    """
+    The value of a get queued in a RedisBatch, which is only there once the batch has been flushed.
+    """
+
+    def __init__(self) -> None:
+        self._value: Optional[str] = None
+        self._flushed = False
+
+    @property
+    def value(self) -> Optional[str]:
+        assert self._flushed, 'The batch this get is in has not been flushed yet'
+        return self._value
+
+    def _resolve(self, raw_value: Any) -> None:
+        self._value = to_optional_str(raw_value)
+        self._flushed = True
+
+
+class RedisBatch:
+    """
+    Gets, sets, publishes and log appends queued up to go to storage together in one pipeline when the batch is flushed, instead
+    of taking a round trip each. They're run in the order they were queued, so subscribers see publishes in that
+    order too. Only the server has a batch, so every key is in some game's namespace. Use redis_batch or
+    aredis_batch to get one.
+    """
+
+    def __init__(self) -> None:
+        self.ops: list[BatchOp] = []
+        self._gets: list[tuple[int, BatchedGet]] = []
+
+    def rget(self, key: str, *, game_name: str) -> BatchedGet:
+        batched_get = BatchedGet()
+        self._gets.append((len(self.ops), batched_get))
+        self.ops.append(('get', (_get_redis_key(key, client_id=None, game_name=game_name),)))
+        return batched_get
+
+    # Publishes the value, the way rset does
+    def rset(self, key: str, value: Any, *, game_name: str) -> None:
+        self.publish(key, value, game_name=game_name)
+        self.ops.append(('set', (_get_redis_key(key, client_id=None, game_name=game_name), str(value))))
+
+    def rmset(self, values: Mapping[str, Any], *, game_name: str) -> None:
+        if values:
+            redis_values = _get_redis_values(values, game_name=game_name)
+            self.ops.extend(('publish', (redis_key, value)) for redis_key, value in redis_values.items())
+            self.ops.append(('mset', (redis_values,)))
+
+    def publish(self, key: str, value: Any, *, game_name: str) -> None:
+        self.ops.append(('publish', (_get_redis_key(key, client_id=None, game_name=game_name), str(value))))
+
+    # Appends to the entity's log the way rlog_append does
+    def rlog_append(self, log_name: str, entity_id: int, entries: Mapping[Any, float], *, trim_before: float, game_name: str) -> None:
+        if entries:
+            self.ops.append(('log_append', (_get_redis_log_key(log_name, entity_id, game_name=game_name),
+                                            _get_redis_key(log_name, client_id=None, game_name=game_name), entity_id, entries,
+                                            trim_before)))
+
+    def _resolve(self, results: list[Any]) -> None:
+        for index, batched_get in self._gets:
+            batched_get._resolve(results[index])
+
+
+# Everything queued in the batch is sent when the block exits, as a MULTI transaction if transaction is set
+@contextmanager
+def redis_batch(*, transaction: bool = False) -> Iterator[RedisBatch]:
+    batch = RedisBatch()
+    yield batch
+    if batch.ops:
+        with _timed('batch'):
+            results = storage.run_batch(batch.ops, transaction=transaction)
+        batch._resolve(results)
+
+
+# Append-only, time-ordered logs. Each entity (player or projectile) gets its own sorted set scored by entry time,
+# and the log name itself holds a sorted set of the entity ids that have been written to recently, so that appending
+# never has to touch other entities' entries. Can only be called from the server.
+def _get_redis_log_key(log_name: str, entity_id: int, *, game_name: str) -> str:
+    return _get_redis_key(f'{log_name}:{entity_id}', client_id=None, game_name=game_name)
+
+
+# entries maps each entry to its time. Entries that are already in the entity's log aren't added again, and if
+# anything was new, the entity id is published on the log name's channel. Returns how many entries were new.
+def rlog_append(log_name: str, entity_id: int, entries: Mapping[Any, float], *, trim_before: float, game_name: str) -> int:
+    if not entries:
+        return 0
+    with _timed('log_append'):
+        return storage.log_append(_get_redis_log_key(log_name, entity_id, game_name=game_name), 
+                                  _get_redis_key(log_name, client_id=None, game_name=game_name), entity_id, entries, 
+                                  trim_before=trim_before)
+
+
+def rlog_read(log_name: str, *, game_name: str) -> dict[int, list[bytes]]:
+    with _timed('log_read'):
+        return storage.log_read(_get_redis_key(log_name, client_id=None, game_name=game_name), 
+                                lambda entity_id: _get_redis_log_key(log_name, entity_id, game_name=game_name))
+
+
+# Fixed-capacity rings of values ordered by a score (a timestamp, say), as sorted sets, so that looking up the value
+# for a score is O(log n). Pushing past capacity drops the lowest-scored values. Can only be called from the server.
+def rring_push(key: str, value: str, score: float, *, capacity: int, game_name: str) -> None:
+    with _timed('ring_push'):
+        storage.ring_push(_get_redis_key(key, client_id=None, game_name=game_name), value, score, capacity=capacity)
+
+
+# The highest-scored value at or below score, or the lowest-scored one if they're all above it
+def rring_at_or_before(key: str, score: float, *, game_name: str) -> Optional[str]:
+    with _timed('ring_at_or_before'):
+        return storage.ring_at_or_before(_get_redis_key(key, client_id=None, game_name=game_name), score)
 
 
 # Can only be called from the server
 def rlisten(keys: list[str], callback: Callable[[str, Optional[str]], None], game_name: str, break_when: Optional[Callable[[], bool]] = None) -> None:
-    pubsub = redis.pubsub()
-    for key in keys:
-        pubsub.subscribe(_get_redis_key(key, client_id=None, game_name=game_name))
-    for item in pubsub.listen():
-        if item['type'] == 'message':
-            raw_channel = to_optional_str(item['channel'])
-            assert raw_channel is not None
-            channel = _get_redis_key_inverse(raw_channel, client_id=None, game_name=game_name)
-            data = to_optional_str(item['data'])
-            callback(channel, data)
-        if break_when is not None and break_when():
-            break
+    storage.listen([_get_redis_key(key, client_id=None, game_name=game_name) for key in keys],
+                   lambda raw_channel, data: callback(_get_redis_key_inverse(raw_channel, client_id=None, game_name=game_name), data),
+                   break_when)
 
 
 def flushall() -> None:
-    redis.flushall()
+    storage.flushall()
 
 
 # Can only be called from the server; if called with a non-null client_id, just does nothing
@@ -72,9 +204,79 @@ def redis_lock(key: str, *, client_id: Optional[int], game_name: Optional[str] =
     if client_id is not None:
         yield
     assert game_name is not None
-    lock = rl.Lock(redis, _get_redis_key(key, client_id=None, game_name=game_name))
-    lock.acquire()
-    try:
+    started_at = perf_counter()
+    with storage.lock(_get_redis_key(key, client_id=None, game_name=game_name)):
+        metrics.observe('lock_wait_seconds', perf_counter() - started_at, key=key)
+        yield
+
+
+# Async versions of the server-side helpers above, for the asyncio server. These always act on the server's storage.
+async def arset(key: str, value: Any, *, game_name: str) -> Optional[bool]:
+    with _timed('set'):
+        return await storage.aset_and_publish(_get_redis_key(key, client_id=None, game_name=game_name), str(value))
+
+
+async def arget(key: str, *, game_name: str) -> Optional[str]:
+    with _timed('get'):
+        return await storage.aget(_get_redis_key(key, client_id=None, game_name=game_name))
+
+
+async def armget(keys: list[str], *, game_name: str) -> list[Optional[str]]:
+    if not keys:
+        return []
+    with _timed('mget'):
+        return await storage.amget([_get_redis_key(key, client_id=None, game_name=game_name) for key in keys])
+
+
+async def armset(values: Mapping[str, Any], *, game_name: str) -> None:
+    if values:
+        with _timed('mset'):
+            await storage.amset_and_publish(_get_redis_values(values, game_name=game_name))
+
+
+@asynccontextmanager
+async def aredis_batch(*, transaction: bool = False) -> AsyncIterator[RedisBatch]:
+    batch = RedisBatch()
+    yield batch
+    if batch.ops:
+        with _timed('batch'):
+            results = await storage.arun_batch(batch.ops, transaction=transaction)
+        batch._resolve(results)
+
+
+async def aincr(key: str, *, game_name: str) -> int:
+    with _timed('incr'):
+        return await storage.aincr(_get_redis_key(key, client_id=None, game_name=game_name))
+
+
+async def arlog_append(log_name: str, entity_id: int, entries: Mapping[Any, float], *, trim_before: float, game_name: str) -> int:
+    if not entries:
+        return 0
+    with _timed('log_append'):
+        return await storage.alog_append(_get_redis_log_key(log_name, entity_id, game_name=game_name), 
+                                         _get_redis_key(log_name, client_id=None, game_name=game_name), entity_id, entries, 
+                                         trim_before=trim_before)
+
+
+async def arlog_read(log_name: str, *, game_name: str) -> dict[int, list[bytes]]:
+    with _timed('log_read'):
+        return await storage.alog_read(_get_redis_key(log_name, client_id=None, game_name=game_name), 
+                                       lambda entity_id: _get_redis_log_key(log_name, entity_id, game_name=game_name))
+
+
+async def arlisten(keys: list[str], callback: Callable[[str, Optional[str]], Awaitable[None]], game_name: str) -> None:
+    async def _callback(raw_channel: str, data: Optional[str]) -> None:
+        await callback(_get_redis_key_inverse(raw_channel, client_id=None, game_name=game_name), data)
+    await storage.alisten([_get_redis_key(key, client_id=None, game_name=game_name) for key in keys], _callback)
+
+
+async def aflushall() -> None:
+    await storage.aflushall()
+
+
+@asynccontextmanager
+async def aredis_lock(key: str, *, game_name: str) -> Any:
+    started_at = perf_counter()
+    async with storage.alock(_get_redis_key(key, client_id=None, game_name=game_name)):
+        metrics.observe('lock_wait_seconds', perf_counter() - started_at, key=key)
         yield
-    finally:
-        lock.release()
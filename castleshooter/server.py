@@ -2,37 +2,46 @@ from datetime import datetime, timedelta
 import json
 import zlib
 from team import get_team_for_client_id
-from utils import SNAPSHOTS_CREATED_EVERY, LOG_CUTOFF, SPECIAL_LOBBY_MANAGER_GAME_NAME, GAME_HEIGHT, GAME_WIDTH
-from command import Command, store_command, CommandType, server_store_player_commands
+from utils import LOG_CUTOFF, SPECIAL_LOBBY_MANAGER_GAME_NAME, GAME_HEIGHT, GAME_WIDTH
+from command import (
+    Command, batch_server_store_player_commands, decode_command, decode_commands, store_command, CommandType,
+    forget_server_command_logs, keep_server_command_logs, server_store_player_commands
+)
 from settings import PORT, SERVER
 import socket
 from typing import Any, Optional
-from redis_utils import rset, rget, redis_lock, flushall, rlisten
+from redis_utils import rset, rget, redis_batch, redis_lock, flushall, rlisten
 import gevent
 from _thread import start_new_thread
 from time import sleep
+from threading import Lock
 from packet import (
-    Packet, send_with_retry, send_without_retry, send_ack, packet_ack_redis_key, 
-    packet_handled_redis_key, send_with_retry_on_delay, receive_compressed_message
+    Packet, send_with_retry, send_without_retry, send_ack, record_ack,
+    send_with_retry_on_delay, receive_packets, set_packet_format, PacketFormat
 )
-import game
 import random
 from team import Team
 import traceback
+from ack_registry import HandledPacketWindow
 from client_utils import get_client
 from game import Game
 from ai_personality import AiPersonality
-from utils import logs
+from broadcaster import find_broadcaster, get_broadcaster, stop_broadcaster
+from server_simulation import ServerSimulation
+from metrics import metrics, serve_metrics
+from settings import METRICS_PORT
 
-_SUBSCRIPTION_KEYS = ['active_players']
+SUBSCRIPTION_KEYS = ['active_players']
 
-_LOBBY_MANAGER_SUBSCRIPTION_KEYS = ['game_names']
+LOBBY_MANAGER_SUBSCRIPTION_KEYS = ['game_names']
 
-_GAME_NAMES_LOCK_REDIS_KEY = 'game_names_lock_redis_key'
+GAME_NAMES_LOCK_REDIS_KEY = 'game_names_lock_redis_key'
 
 
 active_connections_by_client_id_and_game_name: set[tuple[int, str]] = set()
 client_ids_to_game_name: dict[int, str] = {}
+simulations_by_game_name: dict[str, ServerSimulation] = {}
+ai_games_by_game_name: dict[str, list[Game]] = {}
 
 
 class Connection:
@@ -40,31 +49,88 @@ class Connection:
         self.id = id
         self.conn = conn
         self.addr = addr
+        self.handled_packets = HandledPacketWindow()
+        # Held while a packet is checked against handled_packets, handled and marked, since the lobby's thread and
+        # the game's thread can both be reading the connection while it moves into a game
+        self.handling_lock = Lock()
 
     def __repr__(self) -> str:
         return f"<Connection {self.id}: {self.addr}>"
 
 
-stored_data: list[str] = []
+# Returns a dict from game name to whether or not that game has started
+def _get_game_names() -> dict[str, bool]:
+    return json.loads(rget('game_names', client_id=None, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME) or '{}')
 
 
-def _clear_stored_data(stored_data: list[str]) -> None:
-    while stored_data:
-        del stored_data[0]
+# Fills the game up to 8 players with AI players, then splits everyone into teams and gives them player numbers
+def assign_teams(players_in_game: list[list]) -> tuple[list[int], dict[int, Team], dict[int, int], list[int], list[int]]:
+    players_in_game = list(players_in_game)
+    for i in range(max(8 - len(players_in_game), 0)):
+        # These will eventually be the AI players
+        players_in_game.append(['', 10000 + i])
 
+    print(players_in_game)
+    client_ids_in_game = [player_info[1] for player_info in players_in_game]
+    random.shuffle(client_ids_in_game)
+    client_id_to_team: dict[int, Team] = {}
+    client_id_to_player_number: dict[int, int] = {}
+    red_team = random.sample(client_ids_in_game, 4)
+    blue_team = [cid for cid in client_ids_in_game if cid not in red_team]
+    for i, client_id in enumerate(client_ids_in_game):
+        client_id_to_team[client_id] = Team.RED if client_id in red_team else Team.BLUE
+        client_id_to_player_number[client_id] = i + 1
+    return client_ids_in_game, client_id_to_team, client_id_to_player_number, red_team, blue_team
 
-# Returns a dict from game name to whether or not that game has started
-def _get_game_names() -> dict[str, bool]:
-    return json.loads(rget('game_names', client_id=None, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME) or '{}')
+
+def generate_initial_spawn_command(client_id: int, team: Team) -> Command:
+    return Command(1, CommandType.SPAWN, time=datetime.now(), client_id=client_id, 
+                   data={'x': random.randint(1, GAME_WIDTH), 
+                         'y': random.randint(1, GAME_HEIGHT),
+                         'team': team.value})
 
 
 def start_up_game_for_ai(ai_client_id: int, ai_team: Team, game_name: str) -> None:
     client = get_client(ai_client_id=ai_client_id, ai_team=ai_team, game_name=game_name)
     ai_personality = AiPersonality()
     game = Game(750, 750, client, None, ai_client_id=ai_client_id, ai_team=ai_team, ai_game_name=game_name, ai_personality=ai_personality)
+    ai_games_by_game_name.setdefault(game_name, []).append(game)
     game.run()
 
 
+def stop_ai_games(game_name: str) -> None:
+    for game in ai_games_by_game_name.pop(game_name, []):
+        game.running = False
+
+
+def _has_players(game_name: str) -> bool:
+    return any(for_game_name == game_name for _, for_game_name in active_connections_by_client_id_and_game_name)
+
+
+# A game is over once every (human) player has left it or lost their connection to it. Everything that was running
+# for it stops, and the server stops keeping its command logs.
+def _end_game(game_name: str) -> None:
+    print(f'Ending game: {game_name}')
+    if (simulation := simulations_by_game_name.pop(game_name, None)) is not None:
+        simulation.stop()
+    stop_broadcaster(game_name)
+    stop_ai_games(game_name)
+    forget_server_command_logs(game_name)
+
+
+# Takes a player whose connection has dropped out of their game, the same as if they'd left it
+def _leave_game_on_lost_connection(client_id: int, game_name: str) -> None:
+    with redis_lock(GAME_NAMES_LOCK_REDIS_KEY, client_id=None, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
+        if (client_id, game_name) not in active_connections_by_client_id_and_game_name:
+            return
+        active_connections_by_client_id_and_game_name.remove((client_id, game_name))
+        players_in_game = json.loads(rget('active_players', client_id=None, game_name=game_name) or '[]')
+        rset('active_players', json.dumps([player_info for player_info in players_in_game if player_info[1] != client_id]), 
+             client_id=None, game_name=game_name)
+        if not _has_players(game_name):
+            _end_game(game_name)
+
+
 class GameState:
     def set_active_players(self, active_connections_by_id: dict, game_name: str):
         client_ids = active_connections_by_id.keys()
@@ -79,7 +145,7 @@ class GameState:
         # Only the lobby manager should care about these packets
 
         if (payload.startswith('join_game') and game_name == SPECIAL_LOBBY_MANAGER_GAME_NAME):
-            with redis_lock(_GAME_NAMES_LOCK_REDIS_KEY, client_id=None, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
+            with redis_lock(GAME_NAMES_LOCK_REDIS_KEY, client_id=None, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
                 _, player_name, game_to_join_name = payload.split('|')
                 assert packet.client_id
                 connection_tup = (packet.client_id, game_to_join_name)
@@ -95,7 +161,7 @@ class GameState:
             return True
 
         elif payload.startswith('leave_game') and game_name == SPECIAL_LOBBY_MANAGER_GAME_NAME:
-            with redis_lock(_GAME_NAMES_LOCK_REDIS_KEY, client_id=None, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
+            with redis_lock(GAME_NAMES_LOCK_REDIS_KEY, client_id=None, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
                 _, player_name, game_to_leave_name = payload.split('|')
                 assert packet.client_id
                 connection_tup = (packet.client_id, game_to_leave_name)
@@ -110,10 +176,12 @@ class GameState:
                     client_ids_to_game_name[packet.client_id] = SPECIAL_LOBBY_MANAGER_GAME_NAME
                     sleep(0.02)
                     rset(f'active_players', json.dumps(players_in_game), client_id=None, game_name=game_to_leave_name)      
+                    if not _has_players(game_to_leave_name):
+                        _end_game(game_to_leave_name)
             return True
 
         elif payload.startswith('host_game') and game_name == SPECIAL_LOBBY_MANAGER_GAME_NAME:
-            with redis_lock(_GAME_NAMES_LOCK_REDIS_KEY, client_id=None, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
+            with redis_lock(GAME_NAMES_LOCK_REDIS_KEY, client_id=None, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
                 _, player_name, game_to_host_name = payload.split('|')
                 assert packet.client_id
                 connection_tup = (packet.client_id, game_to_host_name)
@@ -133,55 +201,32 @@ class GameState:
         # End "Only the lobby manager should care about these packets"
 
         elif payload.startswith('start_game') and game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME:
-            with redis_lock(_GAME_NAMES_LOCK_REDIS_KEY, client_id=None, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
+            with redis_lock(GAME_NAMES_LOCK_REDIS_KEY, client_id=None, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME):
                 all_game_names = _get_game_names()
                 if not all_game_names[game_name]:
                     all_game_names[game_name] = True
                     
                     players_in_game = json.loads(rget('active_players', client_id=None, game_name=game_name) or '[]')
-                    for i in range(max(8 - len(players_in_game), 0)):
-                        # These will eventually be the AI players
-                        players_in_game.append(['', 10000 + i])
-
-                    print(players_in_game)
                     print(f'game name: {game_name}')     
-                    client_ids_in_game = [player_info[1] for player_info in players_in_game]
-                    random.shuffle(client_ids_in_game)
-                    client_id_to_team: dict[int, Team] = {}
-                    client_id_to_player_number: dict[int, int] = {}
-                    red_team = random.sample(client_ids_in_game, 4)
-                    blue_team = [cid for cid in client_ids_in_game if cid not in red_team]
-                    for i, client_id in enumerate(client_ids_in_game):
-                        if client_id in red_team:
-                            team = Team.RED
-                        else:
-                            team = Team.BLUE
-                        client_id_to_team[client_id] = team
-                        player_number = i + 1
-                        client_id_to_player_number[client_id] = player_number
-                        rset(f'team:{client_id}', team.value, client_id=None, game_name=game_name)
-                        rset(f'player_number:{client_id}', player_number, client_id=None, game_name=game_name)
-                        rset(f'client_id:{player_number}', client_id, client_id=None, game_name=game_name)
-
-                    rset(f'red_team', json.dumps(red_team), client_id=None, game_name=game_name)
-                    rset(f'blue_team', json.dumps(blue_team), client_id=None, game_name=game_name)
-
-                    sleep(0.1)
-                    rset('client_id_to_team', json.dumps({k: v.value for k, v in client_id_to_team.items()}), client_id=None, game_name=game_name)
-                    sleep(0.1)
-                    rset('client_id_to_player_number', json.dumps(client_id_to_player_number), client_id=None, game_name=game_name)
-                    sleep(0.1)
-                    rset('game_started', '1', client_id=None, game_name=game_name)
-                    sleep(0.1)
-                    rset('game_names', json.dumps(all_game_names), client_id=None, game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME)
-
-                    for i, client_id in enumerate(client_ids_in_game):
-                        store_command(Command(1, CommandType.SPAWN, time=datetime.now(), client_id=client_id, 
-                                    data={'x': random.randint(1, GAME_WIDTH), 
-                                            'y': random.randint(1, GAME_HEIGHT),
-                                            'team': client_id_to_team[client_id].value}), for_client=client_id, client_id=None, game_name=game_name)
-                        sleep(0.1)                                            
-                    start_new_thread(_create_game_state_snaps, (game_name,))
+                    client_ids_in_game, client_id_to_team, client_id_to_player_number, red_team, blue_team = assign_teams(players_in_game)
+                    # Everything goes in one pipeline, which keeps the publishes in this order
+                    with redis_batch() as batch:
+                        for client_id in client_ids_in_game:
+                            player_number = client_id_to_player_number[client_id]
+                            batch.rmset({f'team:{client_id}': client_id_to_team[client_id].value,
+                                         f'player_number:{client_id}': player_number,
+                                         f'client_id:{player_number}': client_id}, game_name=game_name)
+                        batch.rmset({'red_team': json.dumps(red_team), 'blue_team': json.dumps(blue_team)}, game_name=game_name)
+                        batch.rset('client_id_to_team', json.dumps({k: v.value for k, v in client_id_to_team.items()}), game_name=game_name)
+                        batch.rset('client_id_to_player_number', json.dumps(client_id_to_player_number), game_name=game_name)
+                        batch.rset('game_started', '1', game_name=game_name)
+                        batch.rset('game_names', json.dumps(all_game_names), game_name=SPECIAL_LOBBY_MANAGER_GAME_NAME)
+                        batch_server_store_player_commands(
+                            batch, {client_id: [generate_initial_spawn_command(client_id, client_id_to_team[client_id])]
+                                    for client_id in client_ids_in_game}, game_name=game_name)
+
+                    keep_server_command_logs(game_name)
+                    start_new_thread(_run_server_simulation, (game_name,))
 
                     for i, client_id in enumerate(client_ids_in_game):
                         if client_id >= 10000:
@@ -194,43 +239,50 @@ class GameState:
             if all_game_names[game_name]:
                 _, data = payload.split('|')
                 assert packet.client_id is not None
-                print(f'Storing command {data} for game {game_name}')
-                store_command(Command.from_json(json.loads(data)), client_id=None, for_client=packet.client_id, game_name=game_name)
+                metrics.inc('commands_received_total', game=game_name)
+                store_command(decode_command(data), client_id=None, for_client=packet.client_id, game_name=game_name)
+            return True
+
+        elif payload.startswith('packet_format'):
+            _, raw_packet_format = payload.split('|')
+            set_packet_format(connection.conn, PacketFormat(raw_packet_format))
+            return True
+
+        elif payload.startswith('digest_ack') and game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME:
+            _, raw_version = payload.split('|')
+            assert packet.client_id is not None
+            if (broadcaster := find_broadcaster(game_name)) is not None:
+                broadcaster.ack(packet.client_id, int(raw_version))
             return True
 
         elif payload.startswith('all_commands_heartbeat') and game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME:
             _, data = payload.split('|')
             assert packet.client_id is not None
-            server_store_player_commands(json.loads(data), packet.client_id, game_name=game_name)
+            server_store_player_commands(decode_commands(data), packet.client_id, game_name=game_name)
 
         return False
             
-    def _handle_datum(self, connection: Connection, datum: str, game_name: str) -> None:
-        # print(f'received: {datum[:LOG_CUTOFF]}\n')
-        packet = Packet.from_str(datum)
+    def _handle_packet(self, connection: Connection, packet: Packet, game_name: str) -> None:
+        # print(f'received: {packet}\n')
         packet_id = packet.id
         payload = packet.payload
         if packet.is_ack:
             assert packet_id is not None
-            # Record in redis that the message has been acked
             # print(f'Received ack for {packet}')
-            rset(packet_ack_redis_key(packet_id), '1', client_id=None, game_name=game_name)
+            record_ack(connection.conn, packet_id)
         elif packet_id is None:
             assert payload is not None
             self.handle_payload_from_client(connection, payload, packet, game_name=game_name)
         else:
             assert payload is not None
-            with redis_lock(f'handle_payload_from_client|{packet.client_id}|{packet.id}', 
-                            client_id=None, game_name=game_name):
-                handled_redis_key = packet_handled_redis_key(packet_id, 
-                                                            for_client=packet.client_id)
+            with connection.handling_lock:
                 # Want to make sure not to handle the same packet twice due to a re-send, 
                 # if our ack didn't get through
-                if not rget(handled_redis_key, client_id=None, game_name=game_name):
+                if not connection.handled_packets.is_handled(packet_id):
                     handled = self.handle_payload_from_client(connection, payload, packet, game_name=game_name)
                     if handled:
                         send_ack(connection.conn, packet_id)
-                        rset(handled_redis_key, '1', client_id=None, game_name=game_name)
+                        connection.handled_packets.mark_handled(packet_id)
                     else:
                         pass
                         # print(f"Ignoring {packet} because we're not supposed to handle this one")
@@ -238,31 +290,14 @@ class GameState:
                     pass
                     # print(f'Ignoring {packet} because this packet has already been handled')
 
-    def handle_data_from_client(self, raw_data: str, connection: Connection, game_name: str) -> None:
-        for datum in raw_data.split(';'):
-            if datum:
-                global stored_data
-                # Sometimes packets get split by TCP or something, 
-                # so if we fail to process a packet successfully, we store it and instead try processing it concatenated
-                # to the next packet
-                try:
-                    self._handle_datum(connection, datum, game_name=game_name)
-                except Exception as e1:
-                    stored_data.append(datum)
-                    if len(stored_data) > 1:
-                        joint_datum = ''.join(stored_data)
-                        try:
-                            self._handle_datum(connection, ''.join(stored_data), game_name=game_name)
-                        except Exception as e2:
-                            print(f'Ignoring {joint_datum[:LOG_CUTOFF]} because of exception: {e2}')
-                            traceback.print_exc()
-                        else:
-                            _clear_stored_data(stored_data)
-                    else:
-                        print(f'Ignoring {datum[:LOG_CUTOFF]} because of exception: {e1}')
-                        traceback.print_exc()
-                else:
-                    _clear_stored_data(stored_data)
+    def handle_packets_from_client(self, packets: list[Packet], connection: Connection, game_name: str) -> None:
+        metrics.inc('packets_received_total', len(packets), game=game_name)
+        for packet in packets:
+            try:
+                self._handle_packet(connection, packet, game_name=game_name)
+            except Exception as e:
+                print(f'Ignoring {str(packet)[:LOG_CUTOFF]} because of exception: {e}')
+                traceback.print_exc()
 
 
 def _get_new_connection_id(active_connections_by_id: dict[int, Connection]) -> int:
@@ -275,18 +310,22 @@ def _handle_incoming_connection(connection: Connection, game_state: GameState, g
     print(f'handling incoming connection! ({for_client_id, game_name})')
     while True:
         try:
-            data = receive_compressed_message(connection.conn)
+            packets = receive_packets(connection.conn)
+        except ConnectionError as e:
+            print(f'breaking connection: ({for_client_id, game_name}): {e}')
+            if game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME:
+                _leave_game_on_lost_connection(for_client_id, game_name)
+            break
         except Exception as e:
             print(f'Error decompressing data: {e}')
-            data = ''
+            packets = []
             sleep(0.02)            
-        game_state.handle_data_from_client(data, connection, game_name=game_name)
+        game_state.handle_packets_from_client(packets, connection, game_name=game_name)
 
         if game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME and (for_client_id, game_name) not in active_connections_by_client_id_and_game_name:
             print(f'breaking connection: ({for_client_id, game_name})')
             break
 
-        print(active_connections_by_client_id_and_game_name)
         if game_name == SPECIAL_LOBBY_MANAGER_GAME_NAME:
             for client_id, for_game_name in active_connections_by_client_id_and_game_name:
                 if game_name != for_game_name and client_id == for_client_id:
@@ -305,37 +344,27 @@ def _handle_outgoing_active_players_connection(connection: Connection, game_name
         return False
 
     if game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME:
-        start_new_thread(_broadcast_digest, (connection, game_name))
+        start_new_thread(_subscribe_to_digest, (connection, game_name, for_client_id))
 
-    subscription_keys = _SUBSCRIPTION_KEYS if game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME else _LOBBY_MANAGER_SUBSCRIPTION_KEYS
+    subscription_keys = SUBSCRIPTION_KEYS if game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME else LOBBY_MANAGER_SUBSCRIPTION_KEYS
     rlisten(subscription_keys, _handle_change, game_name=game_name, break_when=_break_when if game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME else None)
 
+    if game_name != SPECIAL_LOBBY_MANAGER_GAME_NAME and (broadcaster := find_broadcaster(game_name)) is not None:
+        broadcaster.unsubscribe(for_client_id)
 
-def _create_game_state_snaps(game_name: str) -> None:
+
+def _run_server_simulation(game_name: str) -> None:
     if game_name == SPECIAL_LOBBY_MANAGER_GAME_NAME:
         return
-    while True:
-        game.infer_and_store_game_state_snap(game_name)
+    simulation = ServerSimulation(game_name)
+    simulations_by_game_name[game_name] = simulation
+    simulation.run()
 
-        sleep(SNAPSHOTS_CREATED_EVERY)
 
-
-def _broadcast_digest(connection: Connection, game_name: str) -> None:
+def _subscribe_to_digest(connection: Connection, game_name: str, for_client_id: int) -> None:
     sleep(3)
-    while True:
-        all_info_digest = {
-            "commands_by_player": rget("commands_by_player", client_id=None, game_name=game_name) or "{}",
-            "commands_by_projectile": rget("commands_by_projectile", client_id=None, game_name=game_name) or "{}",
-            "most_recent_game_state_snapshot": rget("most_recent_game_state_snapshot", client_id=None, game_name=game_name) or "",
-            "client_id_to_player_number": rget("client_id_to_player_number", client_id=None, game_name=game_name) or "",
-            "client_id_to_team": rget("client_id_to_team", client_id=None, game_name=game_name) or "",
-            "game_started": rget("game_started", client_id=None, game_name=game_name) or "",
-        }
-
-        send_without_retry(connection.conn, f'all_info_digest|{json.dumps(all_info_digest)}', client_id=None)
-        newline = "\n"
-        print(f'Logs: {newline.join(logs)}')
-        sleep(0.05)
+    if (for_client_id, game_name) in active_connections_by_client_id_and_game_name:
+        get_broadcaster(game_name).subscribe(connection.conn, for_client_id)
 
     # while True:
     #     active_players = game_state.get_active_players()
@@ -356,7 +385,9 @@ def server_loop(game_name: str) -> None:
     game_state = GameState()
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     
-    start_new_thread(_create_game_state_snaps, (game_name,))
+    start_new_thread(_run_server_simulation, (game_name,))
+    if METRICS_PORT is not None:
+        serve_metrics(METRICS_PORT)
     try:
         s.bind((socket.gethostbyname(socket.gethostname()), PORT))
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+from itertools import count
+from time import monotonic, sleep, time
+from typing import Optional
+
+from command import Command, CommandType, store_command
+from death_reason import DeathReason, death_reason_to_verb
+from game import GameSimulator, GameState, infer_and_store_game_state_snap, store_authoritative_state
+from metrics import metrics
+from player import Player
+from projectile import Projectile, ProjectileType, find_projectile_hits
+from spatial_grid import SpatialGrid
+from utils import SNAPSHOTS_CREATED_EVERY
+
+
+SERVER_SIMULATION_TICK_RATE = 30
+# Commands take a moment to get from clients to the server, so the simulation runs a little behind real time, so that
+# one that arrives late only rarely lands before the last tick and forces a replay
+SERVER_SIMULATION_DELAY = timedelta(milliseconds=100)
+# How long to remember that an arrow has already hit someone, until its REMOVE_PROJECTILE has certainly been run
+RESOLVED_PROJECTILE_MEMORY = timedelta(seconds=5)
+
+# Commands the server gives are odd, so that they never clash with the ones clients number (which are even)
+_server_command_ids = count(2 * (int(time()) % 2**30) + 1, 2)
+
+
+class ServerSimulation:
+    """
+    One game's world as the server sees it, advanced SERVER_SIMULATION_TICK_RATE times a second. The server decides
+    when an arrow hits someone, rather than the player who got hit, and stores the commands that follow from it like
+    any other. Every tick the state of every entity is published as authoritative_state, which clients render from
+    instead of replaying commands themselves. Also takes the game state snapshots that replays start from.
+    """
+
+    def __init__(self, game_name: str) -> None:
+        self.game_name = game_name
+        self._simulator = GameSimulator()
+        self._resolved_projectile_ids: dict[int, datetime] = {}
+        self._last_snapshot_at: Optional[float] = None
+        self.stopped = False
+
+    def run(self) -> None:
+        while not self.stopped:
+            started_at = monotonic()
+            with metrics.timer('simulation_tick_seconds', game=self.game_name):
+                self.tick()
+            sleep(max(1 / SERVER_SIMULATION_TICK_RATE - (monotonic() - started_at), 0))
+
+    # Stops run (or the loop the asyncio server runs ticks in) before its next tick
+    def stop(self) -> None:
+        self.stopped = True
+
+    def tick(self) -> GameState:
+        if self._last_snapshot_at is None or monotonic() - self._last_snapshot_at >= SNAPSHOTS_CREATED_EVERY:
+            with metrics.timer('snapshot_inference_seconds', game=self.game_name):
+                infer_and_store_game_state_snap(self.game_name)
+            self._last_snapshot_at = monotonic()
+
+        end_time = datetime.now() - SERVER_SIMULATION_DELAY
+        game_state = self._simulator.infer_game_state(end_time=end_time, game_name=self.game_name)
+        self._resolved_projectile_ids = {projectile_id: resolved_at for projectile_id, resolved_at in self._resolved_projectile_ids.items()
+                                         if resolved_at > end_time - RESOLVED_PROJECTILE_MEMORY}
+        for projectile, player in find_projectile_hits(game_state.players, SpatialGrid(game_state.projectiles)):
+            if projectile.type == ProjectileType.ARROW and projectile.id not in self._resolved_projectile_ids:
+                self._resolved_projectile_ids[projectile.id] = end_time
+                self._hit_with_arrow(projectile, player, end_time)
+
+        store_authoritative_state(self._simulator.authoritative_state(), game_name=self.game_name)
+        return game_state
+
+    def _hit_with_arrow(self, projectile: Projectile, player: Player, hit_at: datetime) -> None:
+        # Just after the tick, since everything up to it has already been run
+        command_time = hit_at + timedelta(microseconds=1)
+        start_of_arrow_x, start_of_arrow_y = projectile.get_start_of_arrow()
+        for command in [
+            Command(id=next(_server_command_ids), type=CommandType.EAT_ARROW, time=command_time, client_id=player.client_id,
+                    data={'arrow_start_x': start_of_arrow_x - player.x, 'arrow_start_y': start_of_arrow_y - player.y,
+                          'arrow_end_x': projectile.x - player.x, 'arrow_end_y': projectile.y - player.y,
+                          'player_id': player.client_id}),
+            Command(id=next(_server_command_ids), type=CommandType.REMOVE_PROJECTILE, time=command_time,
+                    client_id=player.client_id, data={'projectile_id': projectile.id}),
+            Command(id=next(_server_command_ids), type=CommandType.LOSE_HP, time=command_time, client_id=player.client_id,
+                    data={'killer_id': projectile.player_id, 'verb': death_reason_to_verb(DeathReason.ARROW), 'hp': 1}),
+        ]:
+            store_command(command, for_client=player.client_id, client_id=None, game_name=self.game_name)
+
@@ -1,4 +1,5 @@
 import socket
+from typing import Optional
 
 # TODO: make as input whether this is local or not
 SERVER = socket.gethostbyname(socket.gethostname())
@@ -7,4 +8,19 @@ PORT = 5555
 TEST_LAG = 0.0
 DROP_CHANCE = 0.0
 
+# Whether the client asks the server to switch to binary packets once it's connected
+USE_BINARY_PACKETS = True
+
+# Where the server keeps game state: 'redis', or 'memory' to keep it all in the server process, which is faster but
+# only works when there's a single server process
+STORAGE_BACKEND = 'redis'
+
+# Whether the client times its frames and the sections of them, shows the numbers over the game, and writes them all
+# to PROFILE_TRACE_PATH (as JSON, or CSV if it ends in .csv) when it quits
+PROFILE_CLIENT = False
+PROFILE_TRACE_PATH = 'client_trace.json'
+
+# Where the server serves its metrics, at http://localhost:<port>/metrics, or None not to serve them
+METRICS_PORT: Optional[int] = 9100
+
 from local_settings import *
@@ -0,0 +1,35 @@
+from bisect import bisect_right
+from datetime import datetime
+from threading import Lock
+from typing import Optional
+
+
+class SnapshotRing:
+    """
+    The most recent capacity game state snapshots, kept in time order so that finding the one to replay from for a
+    given time is a binary search. Adding a snapshot past capacity drops the oldest one.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._times: list[float] = []
+        self._raw_snaps: list[str] = []
+        self._lock = Lock()
+
+    def add(self, raw_snap: str, time: datetime) -> None:
+        timestamp = datetime.timestamp(time)
+        with self._lock:
+            index = bisect_right(self._times, timestamp)
+            self._times.insert(index, timestamp)
+            self._raw_snaps.insert(index, raw_snap)
+            if len(self._times) > self.capacity:
+                del self._times[0]
+                del self._raw_snaps[0]
+
+    # The latest snapshot at or before time, or the oldest one we have if they're all after it
+    def at_or_before(self, time: datetime) -> Optional[str]:
+        with self._lock:
+            if not self._raw_snaps:
+                return None
+            index = bisect_right(self._times, datetime.timestamp(time))
+            return self._raw_snaps[max(index - 1, 0)]
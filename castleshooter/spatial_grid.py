@@ -0,0 +1,101 @@
+from math import sqrt
+from operator import itemgetter
+from typing import Callable, Generic, Iterable, Iterator, Optional, Protocol, TypeVar, Union
+
+
+SPATIAL_GRID_CELL_SIZE = 100
+
+
+class Positioned(Protocol):
+    @property
+    def x(self) -> Union[int, float]: ...
+
+    @property
+    def y(self) -> Union[int, float]: ...
+
+
+T = TypeVar('T', bound=Positioned)
+
+
+class SpatialGrid(Generic[T]):
+    """
+    A uniform grid over the map, bucketing entities (players, projectiles, items, anything with an x and a y) by the
+    cell they're in, so that finding the ones near a point, in a box or along a segment only looks at the cells that
+    could hold them. Query cost depends on how crowded that part of the map is rather than on how many entities there
+    are. Only the cells that have something in them are stored, so the map can be any size.
+
+    Grids are cheap enough to rebuild every tick. Queries return entities in the order they were inserted, so code
+    that used to loop over a list of entities picks the same one out of a tie.
+    """
+
+    def __init__(self, entities: Iterable[T] = (), *, cell_size: int = SPATIAL_GRID_CELL_SIZE) -> None:
+        self.cell_size = cell_size
+        self._cells: dict[tuple[int, int], list[tuple[int, T]]] = {}
+        self._num_entities = 0
+        for entity in entities:
+            self.insert(entity)
+
+    def insert(self, entity: T) -> None:
+        self._cells.setdefault(self._cell_of(entity.x, entity.y), []).append((self._num_entities, entity))
+        self._num_entities += 1
+
+    def _cell_of(self, x: float, y: float) -> tuple[int, int]:
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def _candidates_in_box(self, min_x: float, min_y: float, max_x: float, max_y: float) -> Iterator[tuple[int, T]]:
+        min_cell_x, min_cell_y = self._cell_of(min_x, min_y)
+        max_cell_x, max_cell_y = self._cell_of(max_x, max_y)
+        # A huge box covers more cells than we have entities in, so just look at the ones we have
+        if (max_cell_x - min_cell_x + 1) * (max_cell_y - min_cell_y + 1) > len(self._cells):
+            for (cell_x, cell_y), entries in self._cells.items():
+                if min_cell_x <= cell_x <= max_cell_x and min_cell_y <= cell_y <= max_cell_y:
+                    yield from entries
+        else:
+            for cell_x in range(min_cell_x, max_cell_x + 1):
+                for cell_y in range(min_cell_y, max_cell_y + 1):
+                    yield from self._cells.get((cell_x, cell_y), ())
+
+    @staticmethod
+    def _in_insertion_order(entries: Iterable[tuple[int, T]]) -> list[T]:
+        return [entity for _, entity in sorted(entries, key=itemgetter(0))]
+
+    # Everything with min_x <= x <= max_x and min_y <= y <= max_y
+    def query_box(self, min_x: float, min_y: float, max_x: float, max_y: float) -> list[T]:
+        return self._in_insertion_order((i, entity) for i, entity in self._candidates_in_box(min_x, min_y, max_x, max_y)
+                                        if min_x <= entity.x <= max_x and min_y <= entity.y <= max_y)
+
+    # Everything strictly less than radius away from (x, y)
+    def query_radius(self, x: float, y: float, radius: float) -> list[T]:
+        return self._in_insertion_order((i, entity) for i, entity in self._candidates_in_box(x - radius, y - radius, x + radius, y + radius)
+                                        if sqrt((entity.x - x)**2 + (entity.y - y)**2) < radius)
+
+    # Everything strictly less than radius away from the segment from (start_x, start_y) to (end_x, end_y)
+    def query_segment(self, start_x: float, start_y: float, end_x: float, end_y: float, radius: float) -> list[T]:
+        candidates = self._candidates_in_box(min(start_x, end_x) - radius, min(start_y, end_y) - radius,
+                                             max(start_x, end_x) + radius, max(start_y, end_y) + radius)
+        return self._in_insertion_order((i, entity) for i, entity in candidates
+                                        if _distance_to_segment(entity.x, entity.y, start_x, start_y, end_x, end_y) < radius)
+
+    # The closest thing strictly less than radius away from (x, y) that satisfies where, if there is one
+    def nearest(self, x: float, y: float, radius: float, where: Optional[Callable[[T], bool]] = None) -> Optional[T]:
+        nearest_entity: Optional[T] = None
+        min_distance = radius
+        for entity in self.query_radius(x, y, radius):
+            if where is not None and not where(entity):
+                continue
+            distance = sqrt((entity.x - x)**2 + (entity.y - y)**2)
+            if distance < min_distance:
+                nearest_entity = entity
+                min_distance = distance
+        return nearest_entity
+
+
+def _distance_to_segment(x: float, y: float, start_x: float, start_y: float, end_x: float, end_y: float) -> float:
+    segment_x = end_x - start_x
+    segment_y = end_y - start_y
+    segment_length_squared = segment_x**2 + segment_y**2
+    if segment_length_squared == 0:
+        return sqrt((x - start_x)**2 + (y - start_y)**2)
+    # How far along the segment the closest point to (x, y) is, from 0 at the start to 1 at the end
+    t = max(0.0, min(1.0, ((x - start_x) * segment_x + (y - start_y) * segment_y) / segment_length_squared))
+    return sqrt((x - (start_x + t * segment_x))**2 + (y - (start_y + t * segment_y))**2)
@@ -0,0 +1,50 @@
+from bisect import bisect_right
+from datetime import datetime
+from threading import Lock
+from typing import Generic, Optional, Protocol, TypeVar
+
+
+class Timestamped(Protocol):
+    @property
+    def time(self) -> datetime: ...
+
+
+T = TypeVar('T', bound=Timestamped)
+
+
+class StateBuffer(Generic[T]):
+    """
+    The most recent capacity states the server has sent, kept in time order, so that the client can render the world
+    as of a moment between two of them. Adding a state past capacity drops the oldest one, and adding one with a
+    time we already have replaces it.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._times: list[float] = []
+        self._states: list[T] = []
+        self._lock = Lock()
+
+    def add(self, state: T) -> None:
+        timestamp = datetime.timestamp(state.time)
+        with self._lock:
+            index = bisect_right(self._times, timestamp)
+            if index > 0 and self._times[index - 1] == timestamp:
+                self._states[index - 1] = state
+                return
+            self._times.insert(index, timestamp)
+            self._states.insert(index, state)
+            if len(self._states) > self.capacity:
+                del self._times[0]
+                del self._states[0]
+
+    def latest(self) -> Optional[T]:
+        with self._lock:
+            return self._states[-1] if self._states else None
+
+    # The latest state at or before time and the earliest one after it, either of which can be None
+    def around(self, time: datetime) -> tuple[Optional[T], Optional[T]]:
+        with self._lock:
+            index = bisect_right(self._times, datetime.timestamp(time))
+            return (self._states[index - 1] if index > 0 else None,
+                    self._states[index] if index < len(self._states) else None)
@@ -0,0 +1,116 @@
+from abc import ABC, abstractmethod
+from typing import Any, AsyncContextManager, Awaitable, Callable, ContextManager, Mapping, Optional
+
+
+# One command in a batch: its name ('get', 'set', 'mset', 'publish' or 'log_append') and its arguments. A log_append's
+# arguments are log_append's, with trim_before last
+BatchOp = tuple[str, tuple[Any, ...]]
+
+
+class StorageBackend(ABC):
+    """
+    Where the server keeps everything: every game's keys, command logs and snapshot rings, and the pub/sub that tells
+    its threads about changes. redis_utils builds the keys and calls through to the backend chosen by
+    STORAGE_BACKEND in settings. Keys here are whole keys, prefixes and all, and values are strings, apart from log
+    entries, which are bytes.
+
+    The async versions are for the asyncio server, and by default just call the sync ones, which is right for a
+    backend that never waits on anything but its own locks. Everything else is abstract, so a backend that's missing
+    any of it can't be made at all.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def mget(self, keys: list[str]) -> list[Optional[str]]:
+        ...
+
+    @abstractmethod
+    def set_and_publish(self, key: str, value: str) -> bool:
+        ...
+
+    @abstractmethod
+    def mset_and_publish(self, values: Mapping[str, str]) -> None:
+        ...
+
+    @abstractmethod
+    def incr(self, key: str) -> int:
+        ...
+
+    # Returns one result per op, in order
+    @abstractmethod
+    def run_batch(self, ops: list[BatchOp], *, transaction: bool) -> list[Any]:
+        ...
+
+    # Appends entries (mapped to their times) to the entity's log, trims everything before trim_before out of it and
+    # the index, bumps the entity's time in the index, and publishes the entity id on index_key if anything was new.
+    # Returns how many entries were new.
+    @abstractmethod
+    def log_append(self, log_key: str, index_key: str, entity_id: int, entries: Mapping[bytes, float], *,
+                   trim_before: float) -> int:
+        ...
+
+    # Every entity in the index, mapped to its log's entries in time order
+    @abstractmethod
+    def log_read(self, index_key: str, log_key_for: Callable[[int], str]) -> dict[int, list[bytes]]:
+        ...
+
+    @abstractmethod
+    def ring_push(self, key: str, value: str, score: float, *, capacity: int) -> None:
+        ...
+
+    # The highest-scored value at or below score, or the lowest-scored one if they're all above it
+    @abstractmethod
+    def ring_at_or_before(self, key: str, score: float) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def listen(self, channels: list[str], callback: Callable[[str, Optional[str]], None],
+               break_when: Optional[Callable[[], bool]] = None) -> None:
+        ...
+
+    @abstractmethod
+    def lock(self, key: str) -> ContextManager[None]:
+        ...
+
+    @abstractmethod
+    def flushall(self) -> None:
+        ...
+
+    async def aget(self, key: str) -> Optional[str]:
+        return self.get(key)
+
+    async def amget(self, keys: list[str]) -> list[Optional[str]]:
+        return self.mget(keys)
+
+    async def aset_and_publish(self, key: str, value: str) -> bool:
+        return self.set_and_publish(key, value)
+
+    async def amset_and_publish(self, values: Mapping[str, str]) -> None:
+        self.mset_and_publish(values)
+
+    async def aincr(self, key: str) -> int:
+        return self.incr(key)
+
+    async def arun_batch(self, ops: list[BatchOp], *, transaction: bool) -> list[Any]:
+        return self.run_batch(ops, transaction=transaction)
+
+    async def alog_append(self, log_key: str, index_key: str, entity_id: int, entries: Mapping[bytes, float], *,
+                          trim_before: float) -> int:
+        return self.log_append(log_key, index_key, entity_id, entries, trim_before=trim_before)
+
+    async def alog_read(self, index_key: str, log_key_for: Callable[[int], str]) -> dict[int, list[bytes]]:
+        return self.log_read(index_key, log_key_for)
+
+    @abstractmethod
+    async def alisten(self, channels: list[str], callback: Callable[[str, Optional[str]], Awaitable[None]]) -> None:
+        ...
+
+    @abstractmethod
+    def alock(self, key: str) -> AsyncContextManager[None]:
+        ...
+
+    async def aflushall(self) -> None:
+        self.flushall()
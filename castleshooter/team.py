@@ -6,7 +6,7 @@ if TYPE_CHECKING:
     from player import Player
 
 from redis_utils import rget
-from client_utils import get_player_number_from_client_id
+from client_utils import client_state, get_player_number_from_client_id
 
 import json
 
@@ -48,12 +48,16 @@ def rotate_team(current_team: Optional[Team], my_team: Team) -> Optional[Team]:
 
 
 def get_true_teams(client_id: Optional[int], game_name: Optional[str] = None, exclude_my_client_id: Optional[int] = None) -> dict[Team, list[int]]:
-    red_team_cid = [cid for cid in json.loads(rget('red_team', client_id=client_id, game_name=game_name) or '[]') if cid != exclude_my_client_id]
+    if client_id is not None:
+        red_team_cid = [cid for cid in client_state.team_client_ids(Team.RED) if cid != exclude_my_client_id]
+        blue_team_cid = [cid for cid in client_state.team_client_ids(Team.BLUE) if cid != exclude_my_client_id]
+    else:
+        red_team_cid = [cid for cid in json.loads(rget('red_team', client_id=None, game_name=game_name) or '[]') if cid != exclude_my_client_id]
+        blue_team_cid = [cid for cid in json.loads(rget('blue_team', client_id=None, game_name=game_name) or '[]') if cid != exclude_my_client_id]
     assert red_team_cid
-    blue_team_cid = [cid for cid in json.loads(rget('blue_team', client_id=client_id, game_name=game_name) or '[]') if cid != exclude_my_client_id]
     assert blue_team_cid
 
     return {
-        Team.RED: [get_player_number_from_client_id(cid, client_id=client_id, game_name=game_name) for cid in red_team_cid], 
-        Team.BLUE: [get_player_number_from_client_id(cid, client_id=client_id, game_name=game_name) for cid in blue_team_cid],
+        Team.RED: [get_player_number_from_client_id(cid, client_id=client_id, game_name=game_name if client_id is None else None) for cid in red_team_cid], 
+        Team.BLUE: [get_player_number_from_client_id(cid, client_id=client_id, game_name=game_name if client_id is None else None) for cid in blue_team_cid],
     }
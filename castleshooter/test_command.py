@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+import json
+from typing import Any, Optional
+
+import pytest
+
+from command import (
+    _COMMAND_DATA_LAYOUTS, _COMMAND_FLAG_JSON, Command, CommandType, decode_command, decode_commands, encode_command,
+    encode_commands, pack_command, unpack_command
+)
+
+
+_SAMPLE_FIELD_VALUES = {'int': -1234, 'str': 'red', 'optional_str': 'north', 'int_list': [3, 5, 8]}
+
+_TIME = datetime(2023, 1, 2, 3, 4, 5, 678901)
+
+
+def _sample_data(command_type: CommandType) -> Optional[dict]:
+    layout = _COMMAND_DATA_LAYOUTS.get(command_type)
+    if layout is None:
+        return None
+    return {key: _SAMPLE_FIELD_VALUES[kind] for key, kind in layout}
+
+
+def _is_packed_as_json(packed: bytes) -> bool:
+    return packed[:1] == b'{' or bool(packed[1] & _COMMAND_FLAG_JSON)
+
+
+def _assert_round_trips(command: Command) -> None:
+    assert unpack_command(pack_command(command)).to_json() == command.to_json()
+    assert decode_command(encode_command(command)).to_json() == command.to_json()
+    # And through JSON, the way commands used to be sent and stored
+    assert Command.from_json(json.loads(json.dumps(command.to_json()))).to_json() == command.to_json()
+
+
+@pytest.mark.parametrize('command_type', list(CommandType))
+@pytest.mark.parametrize('client_id', [None, 17])
+def test_every_command_type_round_trips(command_type: CommandType, client_id: Optional[int]) -> None:
+    command = Command(42, command_type, time=_TIME, client_id=client_id, data=_sample_data(command_type))
+    _assert_round_trips(command)
+    assert not _is_packed_as_json(pack_command(command))
+
+
+def test_optional_str_can_be_none() -> None:
+    command = Command(2, CommandType.TURN, time=_TIME, client_id=1, data={'dir': None})
+    _assert_round_trips(command)
+    assert not _is_packed_as_json(pack_command(command))
+
+
+@pytest.mark.parametrize('command_type, data', [
+    # Coordinates that aren't ints
+    (CommandType.MOVE, {'x': 1.5, 'y': 2}),
+    # bools are ints as far as struct is concerned, but wouldn't come back out as bools
+    (CommandType.SET_SPEED, {'speed': True}),
+    # Fields the layout doesn't have, or is missing
+    (CommandType.TELEPORT, {'x': 1, 'y': 2, 'z': 3}),
+    (CommandType.SPAWN, {'x': 1, 'y': 2}),
+    # Strings too long for a length byte
+    (CommandType.DIE, {'killer_id': 1, 'verb': 'x' * 300}),
+    # Ints too big for 32 bits
+    (CommandType.REMOVE_PROJECTILE, {'projectile_id': 2**40}),
+    # Types that don't have a layout at all
+    (CommandType.SHOOT, {'x': 1, 'y': 2}),
+])
+def test_data_that_does_not_fit_its_layout_falls_back_to_json(command_type: CommandType, data: dict[str, Any]) -> None:
+    command = Command(4, command_type, time=_TIME, client_id=3, data=data)
+    _assert_round_trips(command)
+    assert _is_packed_as_json(pack_command(command))
+
+
+def test_command_ids_too_big_for_the_header_fall_back_to_json() -> None:
+    command = Command(2**33, CommandType.MOVE, time=_TIME, client_id=3, data={'x': 1, 'y': 2})
+    _assert_round_trips(command)
+    assert _is_packed_as_json(pack_command(command))
+
+
+def test_times_keep_their_microseconds() -> None:
+    command = Command(6, CommandType.MOVE, time=datetime.now(), client_id=3, data={'x': 1, 'y': 2})
+    assert unpack_command(pack_command(command)).time == command.time
+
+
+def test_legacy_json_commands_decode() -> None:
+    command = Command(8, CommandType.SPAWN, time=_TIME, client_id=5, data={'x': 10, 'y': 20, 'team': 'blue'})
+    raw_command = json.dumps(command.to_json())
+    assert unpack_command(raw_command.encode()).to_json() == command.to_json()
+    assert decode_command(raw_command).to_json() == command.to_json()
+
+
+def test_decode_commands_takes_both_formats() -> None:
+    commands = [
+        Command(10, CommandType.MOVE, time=_TIME, client_id=1, data={'x': 1, 'y': 2}),
+        Command(12, CommandType.MOVE, time=_TIME + timedelta(seconds=1), client_id=1, data={'x': 1.5, 'y': 2}),
+        Command(14, CommandType.SHOOT, time=_TIME + timedelta(seconds=2)),
+    ]
+    expected = [command.to_json() for command in commands]
+    assert [command.to_json() for command in decode_commands(encode_commands(commands))] == expected
+    assert [command.to_json() for command in decode_commands(json.dumps(expected))] == expected
+    assert decode_commands('') == []
+    assert decode_commands('[]') == []
@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta
+import random
+from typing import Optional
+
+import pytest
+
+from direction import Direction
+from game import GameSimulator, _move_player, _move_projectile
+from integrator import MIN_BATCH_SIZE, PlayerArrays, ProjectileArrays, can_move_in_batch
+from player import Player
+from projectile import Projectile, ProjectileType
+from team import Team
+from utils import GAME_HEIGHT, GAME_WIDTH
+
+
+_START = datetime(2023, 1, 2, 3, 4, 5, 678901)
+
+
+def _random_time(rng: random.Random) -> datetime:
+    return _START + timedelta(microseconds=rng.randint(0, 3_000_000))
+
+
+def _random_coordinate(rng: random.Random, size: int) -> int:
+    # Every so often off the map, or right on its edge
+    return rng.choice([rng.randint(0, size), rng.randint(-200, size + 200), 0, size])
+
+
+def _random_player(rng: random.Random, client_id: int) -> Player:
+    player = Player(client_id, _random_coordinate(rng, GAME_WIDTH), _random_coordinate(rng, GAME_HEIGHT), Team.RED, client_id,
+                    speed=rng.choice([0, 150, 200, 300, 450]))
+    kind = rng.choice(['dest', 'dest', 'direction', 'direction', 'still'])
+    if kind == 'dest':
+        # Sometimes right where the player already is, and sometimes close enough to reach
+        player.dest_x = rng.choice([player.x, player.x + rng.randint(-30, 30), _random_coordinate(rng, GAME_WIDTH)])
+        player.dest_y = rng.choice([player.y, player.y + rng.randint(-30, 30), _random_coordinate(rng, GAME_HEIGHT)])
+    elif kind == 'direction':
+        player.direction = rng.choice(list(Direction))
+    return player
+
+
+def _random_projectile(rng: random.Random, projectile_id: int) -> Projectile:
+    x, y = _random_coordinate(rng, GAME_WIDTH), _random_coordinate(rng, GAME_HEIGHT)
+    dest_x = rng.choice([x, x + rng.randint(-50, 50), _random_coordinate(rng, GAME_WIDTH)])
+    dest_y = rng.choice([y, y + rng.randint(-50, 50), _random_coordinate(rng, GAME_HEIGHT)])
+    return Projectile(projectile_id, x, y, ProjectileType.ARROW, 1, dest_x, dest_y, x, y)
+
+
+def _scalar_player_positions(players: list[Player], start_times: list[datetime], end_time: datetime) -> list[tuple[int, int]]:
+    positions = []
+    for player, start_time in zip(players, start_times):
+        player = player.copy()
+        _move_player(player, prev_time=start_time, next_time=end_time)
+        positions.append((player.x, player.y))
+    return positions
+
+
+def _scalar_projectile_positions(projectiles: list[Projectile], start_times: list[datetime],
+                                 end_time: datetime) -> list[Optional[tuple[int, int]]]:
+    positions: list[Optional[tuple[int, int]]] = []
+    for projectile, start_time in zip(projectiles, start_times):
+        moved_projectile = _move_projectile(projectile.copy(), prev_time=start_time, next_time=end_time)
+        positions.append((moved_projectile.x, moved_projectile.y) if moved_projectile is not None else None)
+    return positions
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('size', [1, MIN_BATCH_SIZE - 1, MIN_BATCH_SIZE, MIN_BATCH_SIZE + 1, 200])
+def test_player_arrays_match_move_player(seed: int, size: int) -> None:
+    rng = random.Random(seed)
+    players = [_random_player(rng, client_id) for client_id in range(size)]
+    start_times = [_random_time(rng) for _ in players]
+    player_arrays = PlayerArrays(players, start_times)
+    for _ in range(10):
+        end_time = max(start_times) + timedelta(microseconds=rng.choice([0, 1, rng.randint(0, 20_000_000)]))
+        assert list(zip(*player_arrays.positions_at(end_time))) == _scalar_player_positions(players, start_times, end_time)
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('size', [1, MIN_BATCH_SIZE - 1, MIN_BATCH_SIZE, MIN_BATCH_SIZE + 1, 200])
+def test_projectile_arrays_match_move_projectile(seed: int, size: int) -> None:
+    rng = random.Random(seed)
+    projectiles = [_random_projectile(rng, projectile_id) for projectile_id in range(size)]
+    start_times = [_random_time(rng) for _ in projectiles]
+    projectile_arrays = ProjectileArrays(projectiles, start_times)
+    for _ in range(10):
+        end_time = max(start_times) + timedelta(microseconds=rng.choice([0, 1, rng.randint(0, 10_000_000)]))
+        assert projectile_arrays.positions_at(end_time) == _scalar_projectile_positions(projectiles, start_times, end_time)
+
+
+def test_players_reaching_their_destination_stop_on_it() -> None:
+    players = [Player(1, 100, 100, Team.RED, 1, dest_x=110, dest_y=100), Player(2, 0, 0, Team.RED, 2, dest_x=3, dest_y=4)]
+    end_time = _START + timedelta(seconds=1)
+    assert list(zip(*PlayerArrays(players, [_START, _START]).positions_at(end_time))) == [(110, 100), (3, 4)]
+    assert _scalar_player_positions(players, [_START, _START], end_time) == [(110, 100), (3, 4)]
+
+
+def test_moving_players_are_clamped_to_the_map_but_standing_ones_are_not() -> None:
+    players = [
+        Player(1, 10, 10, Team.RED, 1, direction=Direction.NORTHWEST),
+        Player(2, GAME_WIDTH - 10, 10, Team.RED, 2, dest_x=GAME_WIDTH + 500, dest_y=10),
+        Player(3, -20, GAME_HEIGHT + 20, Team.RED, 3),
+    ]
+    end_time = _START + timedelta(seconds=5)
+    expected = [(0, 0), (GAME_WIDTH, 10), (-20, GAME_HEIGHT + 20)]
+    assert list(zip(*PlayerArrays(players, [_START] * 3).positions_at(end_time))) == expected
+    assert _scalar_player_positions(players, [_START] * 3, end_time) == expected
+
+
+def test_projectiles_are_gone_once_they_reach_their_destination() -> None:
+    projectiles = [Projectile(1, 0, 0, ProjectileType.ARROW, 1, 300, 400, 0, 0),
+                   Projectile(2, 0, 0, ProjectileType.ARROW, 1, 0, 0, 0, 0)]
+    assert ProjectileArrays(projectiles, [_START, _START]).positions_at(_START + timedelta(seconds=1)) == [(240, 320), None]
+    assert ProjectileArrays(projectiles, [_START, _START]).positions_at(_START + timedelta(seconds=2)) == [None, None]
+
+
+@pytest.mark.parametrize('size', [MIN_BATCH_SIZE - 1, MIN_BATCH_SIZE, MIN_BATCH_SIZE + 1])
+def test_simulator_only_batches_from_min_batch_size(size: int) -> None:
+    rng = random.Random(size)
+    simulator = GameSimulator()
+    players = [_random_player(rng, client_id) for client_id in range(size)]
+    projectiles = [_random_projectile(rng, projectile_id) for projectile_id in range(size)]
+    start_times = [_random_time(rng) for _ in range(size)]
+    simulator._player_anchors = {player.client_id: (player, start_time) for player, start_time in zip(players, start_times)}
+    simulator._projectile_anchors = {projectile.id: (projectile, start_time)
+                                     for projectile, start_time in zip(projectiles, start_times)}
+    simulator._rebuild_arrays()
+    assert (simulator._player_arrays is not None) == (size >= MIN_BATCH_SIZE)
+    assert (simulator._projectile_arrays is not None) == (size >= MIN_BATCH_SIZE)
+
+    end_time = max(start_times) + timedelta(seconds=1)
+    expected_player_positions = _scalar_player_positions(players, start_times, end_time)
+    expected_projectile_positions = [position for position in _scalar_projectile_positions(projectiles, start_times, end_time)
+                                     if position is not None]
+    assert [(player.x, player.y) for player in simulator._move_players(end_time)] == expected_player_positions
+    assert [(projectile.x, projectile.y) for projectile in simulator._move_projectiles(end_time)] == expected_projectile_positions
+
+
+def test_entities_with_coordinates_that_are_not_ints_are_not_batched() -> None:
+    assert can_move_in_batch(Player(1, 10, 10, Team.RED, 1, dest_x=20, dest_y=None))
+    assert not can_move_in_batch(Player(1, 10.5, 10, Team.RED, 1))  # type: ignore
+    assert not can_move_in_batch(Player(1, 10, 10, Team.RED, 1, dest_x=20.5, dest_y=3))  # type: ignore
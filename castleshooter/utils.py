@@ -4,8 +4,11 @@ from math import sin, cos, pi
 import random
 
 import pygame
+from asset_cache import asset_cache
 
 MAX_GAME_STATE_SNAPSHOTS = 5
+# The server keeps more, since it replays from whichever is closest to the time it's inferring
+MAX_SERVER_GAME_STATE_SNAPSHOTS = 8
 SNAPSHOTS_CREATED_EVERY = 1
 LOG_CUTOFF = 1000
 SPECIAL_LOBBY_MANAGER_GAME_NAME = 'lobby_manager'
@@ -31,27 +34,27 @@ def remove_nones(d: dict) -> dict:
     return {key: value for key, value in d.items() if value is not None}
 
 
-def draw_3_texts_centered_on_rectangle_inner(g: pygame.surface.Surface, text1: Any, text2: Any, text3: Any, x: int, y: int, width: int, height: int) -> None:
+def draw_3_texts_centered_on_rectangle_inner(g: pygame.surface.Surface, text1: Any, text2: Any, text3: Any, x: int, y: int, width: int, height: int) -> pygame.Rect:
     text1_rect = text1.get_rect()
     text2_rect = text2.get_rect()
     text3_rect = text3.get_rect()
     rectangle_center = (x + width/2, y + height/2)
     combined_width = text1_rect.width + text2_rect.width + text3_rect.width
-    g.blit(text1, (int(rectangle_center[0] - combined_width/2), int(rectangle_center[1] - text1_rect.height/2)))
-    g.blit(text2, (int(rectangle_center[0] - combined_width/2 + text1_rect.width), int(rectangle_center[1] - text1_rect.height/2)))
-    g.blit(text3, (int(rectangle_center[0] - combined_width/2 + text1_rect.width + text2_rect.width), int(rectangle_center[1] - text1_rect.height/2)))
+    return g.blit(text1, (int(rectangle_center[0] - combined_width/2), int(rectangle_center[1] - text1_rect.height/2))).unionall([
+        g.blit(text2, (int(rectangle_center[0] - combined_width/2 + text1_rect.width), int(rectangle_center[1] - text1_rect.height/2))),
+        g.blit(text3, (int(rectangle_center[0] - combined_width/2 + text1_rect.width + text2_rect.width), int(rectangle_center[1] - text1_rect.height/2))),
+    ])
 
 
-def draw_text_centered_on_rectangle_inner(g: pygame.surface.Surface, text: Any, x: int, y: int, width: int, height: int) -> None:
+def draw_text_centered_on_rectangle_inner(g: pygame.surface.Surface, text: Any, x: int, y: int, width: int, height: int) -> pygame.Rect:
     text_rect = text.get_rect()
     rectangle_center = (x + width/2, y + height/2)
-    g.blit(text, (int(rectangle_center[0] - text_rect.width/2), int(rectangle_center[1] - text_rect.height/2)))
+    return g.blit(text, (int(rectangle_center[0] - text_rect.width/2), int(rectangle_center[1] - text_rect.height/2)))
 
 
-def draw_text_centered_on_rectangle(g: pygame.surface.Surface, message: str, x: int, y: int, width: int, height: int, font_size: int) -> None:
-    font = pygame.font.SysFont('comicsans', font_size)
-    text = font.render(message, True, (0,0,0))
-    draw_text_centered_on_rectangle_inner(g, text, x, y, width, height)
+def draw_text_centered_on_rectangle(g: pygame.surface.Surface, message: str, x: int, y: int, width: int, height: int, font_size: int) -> pygame.Rect:
+    text = asset_cache.text(message, font_size)
+    return draw_text_centered_on_rectangle_inner(g, text, x, y, width, height)
 
 
 def draw_text_list(g: pygame.surface.Surface, messages: list[str], x: int, y: int, box_width: int, box_height: int, font_size: int) -> None:
@@ -1,7 +1,7 @@
-from typing import Any
+from typing import Any, Optional
 
 from enum import Enum
-import pygame
+from asset_cache import asset_cache
 
 
 DAGGER_RANGE = 100
@@ -13,10 +13,10 @@ class Weapon(Enum):
     FLASHLIGHT = 'flashlight'
 
 
-def weapon_to_pygame_image(weapon: Weapon) -> Any:
+def weapon_to_pygame_image(weapon: Weapon, size: Optional[tuple[int, int]] = None) -> Any:
     if weapon == Weapon.BOW:
-        return pygame.image.load('assets/bow_and_arrow.png')
+        return asset_cache.image('assets/bow_and_arrow.png', size)
     elif weapon == Weapon.DAGGER:
-        return pygame.image.load('assets/dagger.png')
+        return asset_cache.image('assets/dagger.png', size)
     elif weapon == Weapon.FLASHLIGHT:
-        return pygame.image.load('assets/flashlight.png')
+        return asset_cache.image('assets/flashlight.png', size)